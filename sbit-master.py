@@ -1,311 +1,1779 @@
-import boto3
 import re
+import os
+import math
+import asyncio
+import json
 import getpass
+import sqlite3
+import sys
+import time
+import random
+import argparse
+import datetime
+import csv
+import statistics
+import hashlib
+import concurrent.futures
+import threading
+import atexit
 
 MAX_DCS=8
 MIN_DCS=2
 MAX_VOLUME_SIZE=1500
 MIN_VOLUME_SIZE=1
+MAX_USER_COUNT=100000
 
 SECTION_SEPARATOR = '#'*60
 
-networkStackName = 'CapstoneNetworkStack-Demo'
-adStackName = 'CapstoneADStack-Demo'
-fsStackName = 'CapstoneFSStack-Demo'
-exchStackName = 'CapstoneExchStack-Demo'
+#Bounds (in seconds) on how often an in-flight stack is polled; stacks are polled less often
+#while they are far from their expected completion time
+MIN_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 120
+#Exponential backoff (in seconds, with full jitter) used when CloudFormation throttles describe_stacks
+THROTTLE_BASE_DELAY = 2
+THROTTLE_MAX_DELAY = 120
+THROTTLE_ERROR_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+#Most stacks whose events are fetched per poll; with many builds in flight, each stack's events are fetched
+#less often instead of adding one describe_stack_events call per stack to every poll
+MAX_EVENT_CALLS_PER_POLL = 10
+#Local database of past build timings, used to predict how long a build will take
+BUILD_HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.sbit', 'build-history.sqlite')
+#Spans and API counters from every run are appended here as JSON lines
+METRICS_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sbit', 'metrics')
+TRACE_PATH = os.path.join(METRICS_DIRECTORY, 'trace.jsonl')
+#Metrics from the latest run in Prometheus text format (ex. for the node_exporter textfile collector)
+PROMETHEUS_PATH = os.path.join(METRICS_DIRECTORY, 'sbit.prom')
+METRIC_DESCRIPTIONS = {
+    'sbit_aws_api_calls_total' : 'AWS API calls made, by service and operation',
+    'sbit_aws_throttles_total' : 'AWS API calls that were throttled',
+    'sbit_aws_sdk_retries_total' : 'Retries boto3 made on its own before returning',
+    'sbit_backoff_retries_total' : 'Calls SBIT retried after backing off, by error code',
+    'sbit_stack_phase_seconds' : 'Time spent in each phase of each stack (create call, wait for completion, delete)',
+    'sbit_wait_condition_seconds' : 'Time each WaitCondition took to be signalled',
+    'sbit_tenant_build_seconds' : 'Time from the first stack create to the last stack finishing, per tenant',
+    'sbit_last_run_timestamp_seconds' : 'When these metrics were written',
+}
+#Resource name under which a whole stack's build time is recorded
+STACK_RESOURCE = '(stack)'
+#Checkpoints record each tenant's build so an interrupted or failed build can be resumed
+CHECKPOINT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sbit', 'checkpoints')
+#Never written to checkpoint files; prompted for again when a resumed build needs them
+SECRET_FIELDS = ['adminPassword', 'restoreModePassword']
+#Template parameters that hold passwords; updates reuse the stack's current value instead of asking again
+SECRET_PARAMETERS = ['DomainAdminPassword', 'RestoreModePassword']
+#The AD and Exchange templates create the IAM role that lets Systems Manager run commands on DC1 and EXCH1
+STACK_CAPABILITIES = ['CAPABILITY_IAM']
+#Stack states that count as already built when resuming
+STACK_BUILT_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE']
+#Resuming also keeps a stack whose update rolled back (ex. a failed update or pool claim), which is left as it was
+STACK_KEPT_STATUSES = STACK_BUILT_STATUSES + ['UPDATE_ROLLBACK_COMPLETE']
+#Stacks in these states are still being built (or, for a claimed pool stack, updated) and can be waited on
+STACK_BUILDING_STATUSES = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS']
+#Stacks left behind by a build that never finished (builds use OnFailure=DO_NOTHING, so these pile up)
+STACK_FAILED_STATUSES = ['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED']
+#Small on-disk cache for AWS lookups that rarely change (key pairs, availability zones)
+AWS_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.sbit', 'aws-cache.json')
+AWS_CACHE_TTL = 60*60
+#Connections kept open per AWS client; shared by every stack operation and tenant in the process
+MAX_POOL_CONNECTIONS = 50
+#Threads that run blocking boto3 calls for the build event loop (see runStackGraphAsync); each needs a connection
+MAX_AWS_WORKERS = 16
+#Local copies of the CloudFormation templates, checked before anything is built
+TEMPLATE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_FILES = {
+    'network' : 'NetworkStackForCapstone.yaml',
+    'ad' : 'ADStackForCapstone.yaml',
+    'fs' : 'FSStackForCapstone.yaml',
+    'exchange' : 'ExchangeStackForCapstone.yaml',
+}
+#Parsed template Parameters sections, cached by the SHA-256 of the template's contents
+TEMPLATE_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sbit', 'template-cache')
+#Exchange needs ~32GB for its install; smaller drives fail deep inside the ~2hr build
+MIN_EXCH_VOLUME_SIZE = 32
+#Exchange 2016's Mailbox role needs 8GB of memory; setup refuses to install with less
+MIN_EXCH_MEMORY = 8
+#Constraints the templates don't declare but the builds depend on
+#MinMemoryGiB is checked against the instance type catalog
+LOCAL_PARAMETER_CONSTRAINTS = {
+    ('exchange', 'ExchDriveSize') : {'MinValue' : MIN_EXCH_VOLUME_SIZE},
+    ('exchange', 'ExchInstanceType') : {'MinMemoryGiB' : MIN_EXCH_MEMORY},
+}
+#Specs and hourly prices of EC2 instance types, bundled so sizing advice works offline (see InstanceCatalog)
+INSTANCE_CATALOG_PATH = os.path.join(TEMPLATE_DIRECTORY, 'InstanceTypeCatalog.json')
+#Default time allowed for a stack to build before giving up (matches the default boto3 waiter)
+DEFAULT_STACK_TIMEOUT = 60*60
+#The AD and FS templates describe two servers each (DC1/DC2, FS1/FS2); other counts are rendered from them
+TEMPLATE_SERVER_COUNT = 2
+SERVER_PREFIXES = {'ad' : 'DC', 'fs' : 'FS'}
+#Resources and parameters of server 2 that are copied for every extra server
+SERVER_CLONE_SUFFIXES = {
+    'ad' : ['', 'WaitCondition', 'WaitHandle', 'PrivIP', 'NetBIOSName'],
+    'fs' : ['', 'Volume', 'WaitCondition', 'WaitHandle', 'PrivIP', 'NetBIOSName'],
+}
+#Servers alternate between the two private subnets (one per AZ); each role numbers its hosts from its base
+PRIVATE_SUBNET_PREFIXES = ['172.16.0', '172.16.1']
+PRIVATE_IP_BASES = {'ad' : 10, 'fs' : 20}
+#A DHCP option set holds at most four DNS servers
+MAX_DNS_SERVERS = 4
+#Templates and the helper scripts they download are uploaded to S3 under content-addressed keys
+ARTIFACT_BUCKET_VARIABLE = 'SBIT_ARTIFACT_BUCKET'
+ARTIFACT_PREFIX = 'sbit'
+ARTIFACT_UPLOAD_WORKERS = 8
+#The bucket stays private; instances download helper scripts through presigned URLs valid this long (the SigV4 limit)
+#URLs signed with temporary credentials (ex. SSO or an assumed role) stop working when those credentials expire
+#instead, so every build signs its own rather than reusing an earlier build's
+ARTIFACT_URL_SECONDS = 7*24*60*60
+#Golden AMIs baked for each role, by region, role, and recipe version
+AMI_CATALOG_PATH = os.path.join(os.path.expanduser('~'), '.sbit', 'ami-catalog.json')
+#Added to the instance type a baked stack's build time is recorded under, so stock and baked builds are estimated apart
+BAKED_TIMING_SUFFIX = '+baked'
+BAKE_INSTANCE_TYPE = 't2.large'
+BAKE_POLL_INTERVAL = 30
+#Exchange's prerequisites and ~6GB install media take the longest to bake
+BAKE_TIMEOUT = 3*60*60
+#Warm pool of ready network stacks; every network stack uses the same CIDRs, only the customer IP differs
+NETWORK_POOL_PATH = os.path.join(os.path.expanduser('~'), '.sbit', 'network-pool.json')
+NETWORK_POOL_NAME_FORMAT = 'CapstoneNetworkPool-%s'
+POOL_TAG = 'sbit:pool'
+TENANT_TAG = 'sbit:tenant'
+#Documentation-only address (RFC 5737) that pool stacks hold until they are claimed
+POOL_PLACEHOLDER_IP = '198.51.100.1'
+#Replacing the customer gateway and VPN connection of a claimed stack
+POOL_CLAIM_SECONDS = 5*60
+#Pool stacks that can't be claimed and are deleted when the pool is refilled
+POOL_FAILED_STATUSES = STACK_FAILED_STATUSES + ['UPDATE_ROLLBACK_FAILED']
+
+#Stack names are derived per tenant so many environments can be built in the same account
+DEFAULT_TENANT = 'Demo'
+STACK_NAME_FORMATS = {
+    'network' : 'CapstoneNetworkStack-%s',
+    'ad' : 'CapstoneADStack-%s',
+    'fs' : 'CapstoneFSStack-%s',
+    'exchange' : 'CapstoneExchStack-%s',
+}
+STACK_LABELS = {
+    'network' : 'AWS Networking',
+    'ad' : 'Active Directory',
+    'fs' : 'File Servers',
+    'exchange' : 'Exchange Server',
+}
+#Tenant names become part of stack names, which allow only letters, numbers, and hyphens
+MAX_TENANT_NAME_LENGTH = 64
+#Default number of tenant environments built at once in batch mode; each uses four stacks
+DEFAULT_BATCH_CONCURRENCY = 5
+
+networkStackName = STACK_NAME_FORMATS['network'] % (DEFAULT_TENANT)
+adStackName = STACK_NAME_FORMATS['ad'] % (DEFAULT_TENANT)
+fsStackName = STACK_NAME_FORMATS['fs'] % (DEFAULT_TENANT)
+exchStackName = STACK_NAME_FORMATS['exchange'] % (DEFAULT_TENANT)
 
 #Should change these in the future to let user define all of this, skipping for now to save time
 fs1NetBIOSName = 'FS1'
 fs2NetBIOSName = 'FS2'
 
-'''
-DON'T FORGET TO UPDATE CLOUDFORMATION TEMPLATE LOCATIONS
-'''
-vpcTemplateUrl = 'https://s3.us-east-2.amazonaws.com/cf-templates-65d2poexw312-us-east-2/2018061awF-NetworkStackForCapstone-Demo.yamlheokzz890t'
-#vpcTemplateUrl = 'https://s3.us-east-2.amazonaws.com/cf-templates-65d2poexw312-us-east-2/2018058mgT-NetworkStackForCapstone.yaml1n1cy6uozdx'
-adTemplateUrl = 'https://s3.us-east-2.amazonaws.com/cf-templates-65d2poexw312-us-east-2/20180561gq-ADStackForCapstone.yamlo9snngbyqah'
-fsTemplateUrl = 'https://s3.us-east-2.amazonaws.com/cf-templates-65d2poexw312-us-east-2/2018058Q3h-FSStackForCapstone.yamlp4peztmldgk'
-exchTemplateUrl = 'https://s3.us-east-2.amazonaws.com/cf-templates-65d2poexw312-us-east-2/20180563jU-ExchangeStackForCapstone.yamlfzxo6az7b38'
-
-#EC2 object allows connection and manipulation of AWS EC2 resource types
-ec2 = boto3.resource('ec2')
+#AWS clients are created the first time they are needed (see getCloudFormationClient and getEc2Client),
+#so --help, validation, and dry runs never pay for importing boto3 or setting up a session
+awsSession = None
+#EC2 client allows lookup of AWS EC2 resources such as key pairs
+ec2Client = None
 #CloudFormation client allows creation of AWS resources in a stack by using CloudFormation templates
-cloudFormationClient = boto3.client('cloudformation')
+cloudFormationClient = None
+#S3 client uploads the templates and helper scripts stacks are built from
+s3Client = None
+#Systems Manager client sends user provisioning scripts to the tenant's servers
+ssmClient = None
+#AWS cache entries already refreshed by this process
+refreshedCacheKeys = set()
 
-def main():
+def main(resume=False):
     #Welcome message
     print(SECTION_SEPARATOR)
     print('Welcome to SBIT: The Small Business IT Server Builder!')
+
+    if(resume):
+        environment = resumeEnvironment(DEFAULT_TENANT)
+    else:
+        environment = promptForEnvironment()
+    buildEnvironment(environment, resume)
+
+#Gather data from user
+def promptForEnvironment():
     print('Please enter the following information and we\'ll get started.\n\n')
+    environment = {
+        'tenant' : DEFAULT_TENANT,
+        'domainName' : getDomainName('Enter your Domain Name (Ex. "example.com"): '),
+        'netBiosName' : getNetBiosName('Enter the NetBIOS name of the domain (Ex. "EXAMPLE"): '),
+        'keyPair' : getKeyPairName('Enter the name of the Key Pair (used when accessing instances): '),
+        'numDcs' : getNumDcs('How many Domain Controllers? [Leave blank to use default of 2]: '),
+        'numFileServers' : getNumFileServers('How many File Servers? [Leave blank to use default of 2]: '),
+        'volumeSize' : getVolumeSize('How much storage would you like (in GiBs) on file servers?: '),
+        'exchVolumeSize' : getExchVolumeSize('How much storage would you like (in GiBs) on the Exchange server?: '),
+        'users' : getUserCount('How many users will the environment have? [Leave blank to use the default instance types]: '),
+    }
+    #The defaults offered are the cheapest types that fit the number of users
+    defaultInstanceTypes = getDefaultInstanceTypes(environment['users'], int(environment['volumeSize']))
+    environment.update({
+        'dcInstanceType' : getInstanceType('Enter the instance type to use for Domain Controllers [Default: %s]: ' % (defaultInstanceTypes['dcInstanceType']), defaultInstanceTypes['dcInstanceType']),
+        'fsInstanceType' : getInstanceType('Enter the instance type to use for File Servers [Default: %s]: ' % (defaultInstanceTypes['fsInstanceType']), defaultInstanceTypes['fsInstanceType']),
+        'exchInstanceType' : getInstanceType('Enter the instance type to use for Exchange servers [Default: %s]: ' % (defaultInstanceTypes['exchInstanceType']), defaultInstanceTypes['exchInstanceType']),
+        'adminUsername' : getUsername('Enter a username for the domain administrator account (separate account from the default "Administrator" account): '),
+        'adminPassword' : getPassword('Enter a password for the domain administrator account: '),
+        'restoreModePassword' : getPassword('Enter a password for Active Directory Restore Mode: '),
+        'publicIp' : getIpAddress('Enter the public IP of the firewall: '),
+    })
+    return environment
 
-    #Gather data from user
-    userDomainName = getDomainName('Enter your Domain Name (Ex. "example.com"): ')
-    userDomainNetBIOSName = getNetBiosName('Enter the NetBIOS name of the domain (Ex. "EXAMPLE"): ')
-    userKeyPair = getKeyPairName('Enter the name of the Key Pair (used when accessing instances): ')
-    userNumDcs = getNumDcs('How many Domain Controllers? [Leave blank to use default of 2]: ')
-    userNumFileServers = getNumFileServers('How many File Servers? [Leave blank to use default of 2]: ')
-    userVolumeSize = getVolumeSize('How much storage would you like (in GiBs) on file servers?: ')
-    userExchVolumeSize = getVolumeSize('How much storage would you like (in GiBs) on the Exchange server?: ') #Not Validated, Lowest possible size=32GB (Leaves ~31MB free space)
-    userDcInstanceType = getInstanceType('Enter the instance type to use for Domain Controllers [Default: t2.micro]: ')
-    userFsInstanceType = getInstanceType('Enter the instance type to use for File Servers [Default: t2.micro]: ')
-    userExchangeInstanceType = getInstanceType('Enter the instance type to use for Exchange servers [Default: r4.large]: ')
-    userDomainAdminUsername = getUsername('Enter a username for the domain administrator account (separate account from the default "Administrator" account): ')
-    userDomainAdminPassword = getPassword('Enter a password for the domain administrator account: ')
-    userRestoreModePassword = getPassword('Enter a password for Active Directory Restore Mode: ')
-    userPublicIp = getIpAddress('Enter the public IP of the firewall: ')
+#Reload the answers given for an earlier build of the tenant from its checkpoint
+#Passwords are never saved, so they are prompted for again
+def resumeEnvironment(tenant):
+    checkpoint = loadCheckpoint(tenant)
+    if(checkpoint is None):
+        raise SystemExit('No checkpoint found at %s; there is no build to resume.' % (getCheckpointPath(tenant)))
+    print('Resuming the build for %s.\n' % (checkpoint['environment']['domainName']))
+    environment = dict(checkpoint['environment'])
+    environment['adminPassword'] = getPassword('Enter the password for the domain administrator account: ')
+    environment['restoreModePassword'] = getPassword('Enter the password for Active Directory Restore Mode: ')
+    return environment
 
-    #Inform the user of the ETA to completion
-    print('\nBuilding Environment...\nEstimated time to full completion: ~2.5hr')
+#Build (or finish building) every stack in a single environment
+def buildEnvironment(environment, resume=False):
+    #Each stack is created as soon as the stacks it depends on are complete:
+    #Network -> AD -> (File Servers and Exchange, built concurrently)
+    stackGraph = createStackGraph(environment)
+    #Use golden AMIs from "sbit-master.py bake" where there are any
+    applyBakedImages(stackGraph)
+    preflightErrors = preflightStackGraph(stackGraph)
+    if(preflightErrors):
+        print('\nThese values would be rejected by the CloudFormation templates; nothing was built:')
+        for error in preflightErrors:
+            print('  ' + error)
+        raise SystemExit(1)
+    if(resume):
+        #Skip stacks that are already built, reattach to ones still building, and rebuild failed ones
+        inspectExistingStacks(stackGraph)
+    #Upload any templates or scripts that changed since the last build
+    publishStackTemplates(stackGraph)
 
-    #Build VPC and other networking resources
-    buildNetworkStack(userPublicIp)
+    #Replace the default ETAs with predictions from past builds of the same configuration
+    buildHistory = BuildHistory()
+    if(not resume):
+        claimPooledNetworks(stackGraph, [environment], buildHistory)
+    applyBuildEstimates(stackGraph, buildHistory)
 
-    #Build Active Directory and Domain Controllers
-    buildADStack(networkStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userRestoreModePassword, userDcInstanceType, userKeyPair)
-    
-    #Build File Servers and configure a Namespace and Replication
-    fsResponse = buildFSStack(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userFsInstanceType, userVolumeSize, userKeyPair)
-    
-    #Build Exchange server and configure mailboxes
-    exchResponse = buildExchStack(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userExchangeInstanceType, userExchVolumeSize, userKeyPair)
-    
-    waitForFsAndExch(fsResponse, exchResponse)
+    #Inform the user of the ETA to completion
+    print('\nBuilding Environment...\nEstimated time to full completion: ~%s' % (formatDuration(estimateCriticalPath(stackGraph))))
+
+    #Follow stack events so progress is shown as each resource is created
+    eventTail = StackEventTail()
+    try:
+        runStackGraph(stackGraph, StackPoller(eventTail=eventTail), onProgress=lambda graph, node: saveCheckpoint(environment, graph))
+    except Exception:
+        print('\nThe build did not finish. Run again with --resume to pick up where it left off.')
+        raise
+    finally:
+        eventTail.printDurationBreakdown()
+        recordBuildTimings(stackGraph, eventTail, buildHistory)
+        buildHistory.close()
 
     #Announce script completion
     print(SECTION_SEPARATOR)
     print('Build complete!!!\nEnjoy your new servers!\n(For more information and next steps, see the Documentation.)')
     print(SECTION_SEPARATOR)
 
+#Names of the four stacks that make up a tenant's environment
+def getStackNames(tenant):
+    return {role : nameFormat % (tenant) for role, nameFormat in STACK_NAME_FORMATS.items()}
+
+#Describe the stacks that make up one environment and the order they must be built in
+#environment holds the validated values gathered by main() or read from a batch manifest
+def createStackGraph(environment):
+    tenant = environment['tenant']
+    stackNames = getStackNames(tenant)
+    #Environments given a stack from the network pool keep using it
+    if(environment.get('networkStackName')):
+        stackNames['network'] = environment['networkStackName']
+    #Label stacks with the tenant when building anything other than the single interactive environment
+    labelPrefix = '' if tenant == DEFAULT_TENANT else '%s: ' % (tenant)
+    stackGraph = [
+        {
+            'name' : stackNames['network'],
+            'label' : labelPrefix + STACK_LABELS['network'],
+            'group' : tenant,
+            'dependsOn' : [],
+            'parameters' : getNetworkStackParameters(environment['publicIp']),
+            'role' : 'network',
+            'timingKey' : ('', 0, 0),
+            'expectedSeconds' : 5*60,
+            'eta' : '~4-6 min.'
+        },
+        {
+            'name' : stackNames['ad'],
+            'label' : labelPrefix + STACK_LABELS['ad'],
+            'group' : tenant,
+            'dependsOn' : [stackNames['network']],
+            'parameters' : getADStackParameters(stackNames['network'], environment['domainName'], environment['netBiosName'], environment['adminUsername'], environment['adminPassword'], environment['restoreModePassword'], environment['dcInstanceType'], environment['keyPair'], environment['numDcs']),
+            'role' : 'ad',
+            'serverCount' : environment['numDcs'],
+            'timingKey' : (environment['dcInstanceType'], 0, environment['numDcs']),
+            'expectedSeconds' : 28*60,
+            'eta' : '~25-30 min.'
+        },
+        {
+            'name' : stackNames['fs'],
+            'label' : labelPrefix + STACK_LABELS['fs'],
+            'group' : tenant,
+            'dependsOn' : [stackNames['network'], stackNames['ad']],
+            'parameters' : getFSStackParameters(stackNames['network'], stackNames['ad'], environment['domainName'], environment['netBiosName'], environment['adminUsername'], environment['adminPassword'], environment['fsInstanceType'], environment['volumeSize'], environment['keyPair'], environment['numFileServers']),
+            'role' : 'fs',
+            'serverCount' : environment['numFileServers'],
+            'timingKey' : (environment['fsInstanceType'], int(environment['volumeSize']), environment['numFileServers']),
+            'expectedSeconds' : 12*60,
+            'eta' : '~10-15 min.'
+        },
+        {
+            'name' : stackNames['exchange'],
+            'label' : labelPrefix + STACK_LABELS['exchange'],
+            'group' : tenant,
+            'dependsOn' : [stackNames['network'], stackNames['ad']],
+            'parameters' : getExchStackParameters(stackNames['network'], stackNames['ad'], environment['domainName'], environment['netBiosName'], environment['adminUsername'], environment['adminPassword'], environment['exchInstanceType'], environment['exchVolumeSize'], environment['keyPair']),
+            'role' : 'exchange',
+            'timingKey' : (environment['exchInstanceType'], int(environment['exchVolumeSize']), 1),
+            'expectedSeconds' : 110*60,
+            'eta' : '~1.75-2 hr. (~105-120 min.)',
+            #Exchange takes ~2hr, longer than the default timeout allows
+            'timeoutSeconds' : 3*60*60
+        },
+    ]
+    buildFunctions = {'network' : buildNetworkStack, 'ad' : buildADStack, 'fs' : buildFSStack, 'exchange' : buildExchStack}
+    for node in stackGraph:
+        #Server counts other than two are built from a rendered template
+        if(node['role'] in SERVER_PREFIXES and node['serverCount'] != TEMPLATE_SERVER_COUNT):
+            node['template'] = renderServerTemplate(node['role'], node['serverCount'])
+        #templateUrl is set when the templates are uploaded, just before the build (see publishStackTemplates)
+        node['create'] = (lambda node: lambda: buildFunctions[node['role']](node['name'], node['parameters'], node.get('templateUrl')))(node)
+    return stackGraph
+
+#Create every stack in stackGraph as soon as all of the stacks it depends on reach CREATE_COMPLETE
+#All in-flight stacks are watched together by one StackPoller, so total build time is the critical
+#path of the graph instead of the sum of every stack's build time
+#Stacks may be tagged with a 'group' (ex. one per tenant); at most maxConcurrentGroups groups are built at once
+#Each node's final status is stored in node['status']; stacks whose parents failed are marked SKIPPED
+#Nodes marked by inspectExistingStacks are not created again: built stacks are skipped and stacks
+#still building are watched until they finish
+#Nodes with an 'action' other than Build (ex. Update) are reported as such; their 'create' starts that operation
+#Stacks that depend on a node with 'dependentsStartOnCreate' start as soon as its 'create' call succeeds instead
+#of waiting for it to finish (ex. claiming a pool network stack, whose update the other stacks don't rely on)
+#onProgress, if given, is called with the graph and the changed node every time a stack's status changes
+#Returns the number of CloudFormation API calls the build used
+def runStackGraph(stackGraph, poller=None, maxConcurrentGroups=None, raiseOnFailure=True, onProgress=None):
+    return asyncio.run(runStackGraphAsync(stackGraph, poller, maxConcurrentGroups, raiseOnFailure, onProgress))
+
+#The build engine behind runStackGraph: each stack's build is a coroutine, and every stack of every tenant
+#shares one event loop, one StackPoller, and one stack event tail
+#Blocking boto3 calls run in a pool of at most maxWorkers threads, so one process can drive dozens of
+#environments at once without a thread (or a process) per build
+async def runStackGraphAsync(stackGraph, poller=None, maxConcurrentGroups=None, raiseOnFailure=True, onProgress=None, maxWorkers=MAX_AWS_WORKERS):
+    if(poller is None):
+        poller = StackPoller()
+    nodesByName = {node['name'] : node for node in stackGraph}
+    for node in stackGraph:
+        for parent in node['dependsOn']:
+            if(not parent in nodesByName):
+                raise ValueError('Stack %s depends on unknown stack %s' % (node['name'], parent))
+        node['status'] = 'PENDING'
+    #Builds waiting on each other in a cycle would wait forever, so refuse to start them
+    unbuiltStacks = set(nodesByName)
+    while(True):
+        buildableStacks = [name for name in unbuiltStacks if not any(parent in unbuiltStacks for parent in nodesByName[name]['dependsOn'])]
+        if(not buildableStacks):
+            break
+        unbuiltStacks.difference_update(buildableStacks)
+    if(unbuiltStacks):
+        raise ValueError('Stack graph contains a dependency cycle; cannot build: %s' % (', '.join(sorted(unbuiltStacks))))
+
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(maxWorkers)
+    #Resolved with each stack's final status once it is built, fails, or is skipped
+    stackResults = {name : loop.create_future() for name in nodesByName}
+    #Resolved with whether stacks that depend on each stack can start
+    readyResults = {name : loop.create_future() for name in nodesByName}
+    #Resolved by pollStacks when CloudFormation reports an in-flight stack has finished
+    pollResults = {}
+    pollTask = None
+    groupSizes = {}
+    for node in stackGraph:
+        groupSizes[node.get('group')] = groupSizes.get(node.get('group'), 0) + 1
+    groupsFinished = {group : 0 for group in groupSizes}
+    startedGroups = set()
+    groupSlots = asyncio.Condition()
+    activeGroups = 0
+    createCalls = 0
+    #Spans are reported in wall-clock time, whatever clock the poller uses
+    wallClockOffset = time.time() - poller.clock()
+
+    #Wait for one of the maxConcurrentGroups slots, unless the group already has one
+    async def startGroup(group, waitForSlot=True):
+        nonlocal activeGroups
+        async with groupSlots:
+            if(waitForSlot):
+                await groupSlots.wait_for(lambda: group in startedGroups or maxConcurrentGroups is None or activeGroups < maxConcurrentGroups)
+            if(not group in startedGroups):
+                startedGroups.add(group)
+                activeGroups += 1
+
+    async def finishStack(node, stackStatus):
+        nonlocal activeGroups
+        node['status'] = stackStatus
+        group = node.get('group')
+        groupsFinished[group] += 1
+        if(groupsFinished[group] == groupSizes[group] and group in startedGroups):
+            async with groupSlots:
+                activeGroups -= 1
+                groupSlots.notify_all()
+        if(onProgress is not None):
+            onProgress(stackGraph, node)
+        stackResults[node['name']].set_result(stackStatus)
+        if(not readyResults[node['name']].done()):
+            readyResults[node['name']].set_result(stackStatus in STACK_BUILT_STATUSES)
+
+    #One task polls for every in-flight stack; it runs whenever any stack is being watched
+    async def pollStacks():
+        try:
+            while(poller.trackedStacks):
+                for stackName, stackStatus in await poller.waitForAnyAsync(executor):
+                    pollResults.pop(stackName).set_result(stackStatus)
+        except Exception as error:
+            for pollResult in pollResults.values():
+                pollResult.set_exception(error)
+            pollResults.clear()
+
+    def watchStack(node):
+        nonlocal pollTask
+        pollResults[node['name']] = loop.create_future()
+        poller.track(node['stackId'], node['name'], node.get('expectedSeconds', MIN_POLL_INTERVAL), node.get('timeoutSeconds', DEFAULT_STACK_TIMEOUT))
+        if(pollTask is None or pollTask.done()):
+            pollTask = loop.create_task(pollStacks())
+        return pollResults[node['name']]
+
+    async def buildStack(node):
+        nonlocal createCalls
+        existingStatus = node.get('existingStatus')
+        #Pick up stacks left behind by an earlier run
+        if(existingStatus in STACK_KEPT_STATUSES):
+            await startGroup(node.get('group'), waitForSlot=False)
+            print('\n%s... Already built, skipping.' % (node['label']))
+            await finishStack(node, 'CREATE_COMPLETE')
+            return
+        if(existingStatus in STACK_BUILDING_STATUSES):
+            await startGroup(node.get('group'), waitForSlot=False)
+            node['status'] = 'CREATE_IN_PROGRESS'
+            node['stackId'] = node['existingStackId']
+            node['startTime'] = poller.clock()
+            print('\n%s... Still building, waiting for it to finish.' % (node['label']))
+        else:
+            #Skip the stack as soon as any parent fails, without waiting for the others
+            for parentResult in asyncio.as_completed([readyResults[parent] for parent in node['dependsOn']]):
+                if(not await parentResult):
+                    await finishStack(node, 'SKIPPED')
+                    return
+            await startGroup(node.get('group'))
+            createStartTime = poller.clock()
+            try:
+                stackResponse = await poller.runBlocking(executor, callWithBackoff, node['create'], poller.sleep)
+            except getClientError() as error:
+                buildMetrics.addSpan('create', wallClockOffset + createStartTime, poller.clock() - createStartTime, tenant=node.get('group'), stack=node['name'], role=node.get('role'), action=node.get('action', 'Build'), status=error.response['Error']['Code'])
+                if(raiseOnFailure):
+                    raise
+                node['statusReason'] = str(error)
+                print('\n%s... %s Failed! (%s)' % (node['label'], node.get('action', 'Build'), error))
+                await finishStack(node, 'CREATE_FAILED')
+                return
+            createCalls += 1
+            node['status'] = 'CREATE_IN_PROGRESS'
+            node['stackId'] = stackResponse['StackId']
+            node['startTime'] = poller.clock()
+            buildMetrics.addSpan('create', wallClockOffset + createStartTime, node['startTime'] - createStartTime, tenant=node.get('group'), stack=node['name'], role=node.get('role'), action=node.get('action', 'Build'), status='OK')
+            if(node.get('dependentsStartOnCreate')):
+                readyResults[node['name']].set_result(True)
+            if(onProgress is not None):
+                onProgress(stackGraph, node)
+            if('eta' in node):
+                print('Estimated time to build this component: %s' % (node['eta']))
+
+        stackStatus = await watchStack(node)
+        node['buildSeconds'] = poller.clock() - node['startTime']
+        buildMetrics.addSpan('wait', wallClockOffset + node['startTime'], node['buildSeconds'], tenant=node.get('group'), stack=node['name'], role=node.get('role'), action=node.get('action', 'Build'), status=stackStatus)
+        if(stackStatus in STACK_BUILT_STATUSES):
+            print('\n%s... %s Complete!' % (node['label'], node.get('action', 'Build')))
+        else:
+            print('\n%s... %s Failed! (status: %s)' % (node['label'], node.get('action', 'Build'), stackStatus))
+        await finishStack(node, stackStatus)
+        if(stackStatus not in STACK_BUILT_STATUSES and raiseOnFailure):
+            raise RuntimeError('Stack %s failed to build (status: %s)' % (node['name'], stackStatus))
+
+    describeCallsBefore = poller.apiCalls
+    eventCallsBefore = poller.eventTail.apiCalls if poller.eventTail is not None else 0
+    buildTasks = [loop.create_task(buildStack(node)) for node in stackGraph]
+    try:
+        await asyncio.gather(*buildTasks)
+    finally:
+        #A failure stops the whole build (raiseOnFailure); stacks already created keep building in AWS
+        for task in buildTasks + ([pollTask] if pollTask is not None else []):
+            task.cancel()
+        await asyncio.gather(*buildTasks, *([pollTask] if pollTask is not None else []), return_exceptions=True)
+        executor.shutdown()
+
+    describeCalls = poller.apiCalls - describeCallsBefore
+    eventCalls = (poller.eventTail.apiCalls if poller.eventTail is not None else 0) - eventCallsBefore
+    apiCalls = createCalls + describeCalls + eventCalls
+    print('CloudFormation API calls used: %d (%d create, %d describe, %d events, %d throttled)' % (apiCalls, createCalls, describeCalls, eventCalls, poller.throttles))
+    return apiCalls
+
+#Call function, retrying with exponential backoff and full jitter while AWS throttles the request
+def callWithBackoff(function, sleep=time.sleep, maxAttempts=8):
+    for attempt in range(1, maxAttempts + 1):
+        try:
+            return function()
+        except getClientError() as error:
+            if(error.response['Error']['Code'] not in THROTTLE_ERROR_CODES or attempt == maxAttempts):
+                raise
+            buildMetrics.count('sbit_backoff_retries_total', {'code' : error.response['Error']['Code']})
+            sleep(random.uniform(0, min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2 ** attempt)))
+
+#Watches any number of in-flight stacks with a single paginated describe_stacks call per tick
+#instead of one boto3 waiter (and one stream of API calls) per stack
+class StackPoller:
+    def __init__(self, client=None, clock=time.monotonic, sleep=time.sleep, eventTail=None):
+        self.client = client
+        self.eventTail = eventTail
+        self.clock = clock
+        self.sleep = sleep
+        self.trackedStacks = {}
+        self.apiCalls = 0
+        self.throttles = 0
+        self.consecutiveThrottles = 0
+        self.callsInFlight = 0
+
+    #Start watching a stack that is expected to finish building in roughly expectedSeconds
+    def track(self, stackId, stackName, expectedSeconds, timeoutSeconds=DEFAULT_STACK_TIMEOUT):
+        now = self.clock()
+        stack = {
+            'name' : stackName,
+            'startTime' : now,
+            'expectedSeconds' : expectedSeconds,
+            'deadline' : now + timeoutSeconds,
+        }
+        stack['nextPoll'] = now + self.pollInterval(stack, now)
+        stack['nextEventPoll'] = stack['nextPoll']
+        self.trackedStacks[stackId] = stack
+        if(self.eventTail is not None):
+            self.eventTail.follow(stackId, stackName)
+
+    #Poll rarely while a stack is far from its expected completion time and often once it is close
+    #The last poll before that time lands on it, instead of up to MIN_POLL_INTERVAL after it
+    def pollInterval(self, stack, now):
+        remainingSeconds = stack['startTime'] + stack['expectedSeconds'] - now
+        pollInterval = min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, remainingSeconds / 4))
+        if(0 < remainingSeconds < pollInterval):
+            return remainingSeconds
+        return pollInterval
+
+    #Wait until at least one tracked stack leaves its in-progress state, without blocking the event loop
+    #Returns a list of (stackName, stackStatus) for every stack that finished
+    #Only the describe_stacks and describe_stack_events calls run in executor; tracked stacks, event cursors,
+    #and call counts are only ever touched on the event loop's thread, so track() can be called at any time
+    async def waitForAnyAsync(self, executor):
+        if(not self.trackedStacks):
+            raise ValueError('No stacks are being watched')
+        while(True):
+            nextPoll = min(stack['nextPoll'] for stack in self.trackedStacks.values())
+            now = self.clock()
+            if(nextPoll > now):
+                await self.sleepAsync(nextPoll - now)
+            stackStatuses, apiCalls, throttleCode = await self.runBlocking(executor, self.fetchStackStatuses)
+            self.apiCalls += apiCalls
+            if(throttleCode is not None):
+                await self.sleepAsync(self.backOff(throttleCode))
+                continue
+            self.consecutiveThrottles = 0
+            finishedStacks = await self.updateTrackedStacks(executor, stackStatuses)
+            if(finishedStacks):
+                return finishedStacks
+
+    #Stop tracking the stacks stackStatuses shows have finished, and schedule the next poll of the others
+    #Returns a list of (stackName, stackStatus) for the finished stacks
+    async def updateTrackedStacks(self, executor, stackStatuses):
+        finishedStacks = []
+        now = self.clock()
+        for stackId, stack in list(self.trackedStacks.items()):
+            stackStatus = stackStatuses.get(stackId)
+            if(stackStatus is not None and not stackStatus.endswith('_IN_PROGRESS')):
+                finishedStacks.append((stackId, stackStatus))
+            elif(now > stack['deadline']):
+                finishedStacks.append((stackId, 'TIMED_OUT'))
+            else:
+                stack['nextPoll'] = now + self.pollInterval(stack, now)
+        if(self.eventTail is not None):
+            finishedStackIds = set(stackId for stackId, stackStatus in finishedStacks)
+            await self.pollEvents(executor, [stackId for stackId in self.trackedStacks if stackId not in finishedStackIds], now)
+
+        finishedStackNames = []
+        for stackId, stackStatus in finishedStacks:
+            if(self.eventTail is not None):
+                await self.unfollow(executor, stackId)
+            finishedStackNames.append((self.trackedStacks.pop(stackId)['name'], stackStatus))
+        return finishedStackNames
+
+    #Fetch new events for the in-progress stacks in stackIds whose own poll interval has passed, most overdue
+    #first and at most MAX_EVENT_CALLS_PER_POLL of them; the rest wait for a later tick
+    #Skipped events are not lost: the next fetch pages back to the stack's cursor, and unfollow fetches the rest
+    #Event calls share the describe_stacks throttle budget: a throttled call backs off the same way
+    async def pollEvents(self, executor, stackIds, now):
+        dueStackIds = sorted([stackId for stackId in stackIds if self.trackedStacks[stackId]['nextEventPoll'] <= now], key=lambda stackId: self.trackedStacks[stackId]['nextEventPoll'])
+        for stackId in dueStackIds[:MAX_EVENT_CALLS_PER_POLL]:
+            try:
+                await self.fetchEvents(executor, stackId)
+            except getClientError() as error:
+                if(error.response['Error']['Code'] not in THROTTLE_ERROR_CODES):
+                    raise
+                await self.sleepAsync(self.backOff(error.response['Error']['Code']))
+                return
+            #The stack may have been untracked while its events were being fetched
+            if(stackId in self.trackedStacks):
+                self.trackedStacks[stackId]['nextEventPoll'] = now + self.pollInterval(self.trackedStacks[stackId], now)
+
+    #Print a finished stack's final events and stop following it
+    #The final events are needed for the duration breakdown, so throttling is waited out (as in callWithBackoff)
+    async def unfollow(self, executor, stackId, maxAttempts=8):
+        for attempt in range(1, maxAttempts + 1):
+            try:
+                await self.fetchEvents(executor, stackId)
+                break
+            except getClientError() as error:
+                if(error.response['Error']['Code'] not in THROTTLE_ERROR_CODES or attempt == maxAttempts):
+                    raise
+                await self.sleepAsync(self.backOff(error.response['Error']['Code']))
+        self.eventTail.unfollow(stackId)
+
+    #Fetch a followed stack's new events in executor, then print and record them on the event loop
+    async def fetchEvents(self, executor, stackId):
+        if(stackId in self.eventTail.followedStacks):
+            newEvents, apiCalls = await self.runBlocking(executor, self.eventTail.fetchNewEvents, stackId, self.eventTail.lastEventIds.get(stackId))
+            self.eventTail.recordEvents(stackId, newEvents, apiCalls)
+
+    #Run a blocking boto3 call in executor without blocking the event loop
+    async def runBlocking(self, executor, function, *args):
+        self.callsInFlight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        finally:
+            self.callsInFlight -= 1
+
+    #Wait without blocking the event loop
+    #A simulated clock (anything other than time.sleep) only moves once every other task has had its turn
+    #and every call in the executor has returned, so simulated stacks start when they would in real time
+    async def sleepAsync(self, seconds):
+        if(self.sleep is time.sleep):
+            await asyncio.sleep(seconds)
+            return
+        while(True):
+            for turn in range(10):
+                await asyncio.sleep(0)
+            if(not self.callsInFlight):
+                break
+            await asyncio.sleep(0.001)
+        self.sleep(seconds)
+
+    #Block until at least one stack being deleted finishes; deadlines maps each stack ID to when to give up on it
+    #Returns a list of (stackId, stackStatus) where stackStatus is DELETE_COMPLETE, DELETE_FAILED, or TIMED_OUT
+    #Deleted stacks drop out of describe_stacks listings, so a missing stack counts as deleted
+    def waitForAnyDeletion(self, deadlines):
+        while(True):
+            self.sleep(MIN_POLL_INTERVAL)
+            stackStatuses = self.describeStacks()
+            if(stackStatuses is None):
+                continue
+            finishedStacks = []
+            now = self.clock()
+            for stackId, deadline in deadlines.items():
+                stackStatus = stackStatuses.get(stackId, 'DELETE_COMPLETE')
+                if(stackStatus in ['DELETE_COMPLETE', 'DELETE_FAILED']):
+                    finishedStacks.append((stackId, stackStatus))
+                elif(now > deadline):
+                    finishedStacks.append((stackId, 'TIMED_OUT'))
+            if(finishedStacks):
+                return finishedStacks
+
+    #Fetch the status of every stack in the account, keyed by stack ID
+    #Returns None (after backing off) if CloudFormation throttled the request
+    def describeStacks(self):
+        stackStatuses, apiCalls, throttleCode = self.fetchStackStatuses()
+        self.apiCalls += apiCalls
+        if(throttleCode is not None):
+            self.sleep(self.backOff(throttleCode))
+            return None
+        self.consecutiveThrottles = 0
+        return stackStatuses
+
+    #Page through describe_stacks; returns (stack statuses keyed by stack ID, calls made, None), or
+    #(None, calls made, error code) if CloudFormation throttled a request
+    #Only makes API calls and changes nothing, so it is safe to run on an executor thread
+    def fetchStackStatuses(self):
+        client = self.client if self.client is not None else getCloudFormationClient()
+        stackStatuses = {}
+        apiCalls = 0
+        try:
+            for page in client.get_paginator('describe_stacks').paginate():
+                apiCalls += 1
+                for stack in page['Stacks']:
+                    stackStatuses[stack['StackId']] = stack['StackStatus']
+        except getClientError() as error:
+            if(error.response['Error']['Code'] not in THROTTLE_ERROR_CODES):
+                raise
+            return None, apiCalls + 1, error.response['Error']['Code']
+        return stackStatuses, apiCalls, None
+
+    #Count a throttled call and return how long to back off, further with each throttle in a row
+    def backOff(self, errorCode):
+        self.throttles += 1
+        buildMetrics.count('sbit_backoff_retries_total', {'code' : errorCode})
+        self.consecutiveThrottles += 1
+        #Full jitter keeps many concurrent builds from retrying in lock-step
+        backoffCeiling = min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2 ** self.consecutiveThrottles)
+        return random.uniform(0, backoffCeiling)
+
+#Streams new stack events as they happen and times how long each resource took to create
+#A cursor (the newest EventId seen) is kept per stack, so already-seen events are never downloaded again
+class StackEventTail:
+    def __init__(self, client=None):
+        self.client = client
+        self.followedStacks = {}
+        self.lastEventIds = {}
+        self.resourceTimings = {}
+        self.apiCalls = 0
+
+    def follow(self, stackId, stackName):
+        self.followedStacks[stackId] = stackName
+
+    def unfollow(self, stackId):
+        self.followedStacks.pop(stackId, None)
+
+    #Fetch the stack's events newer than lastEventId, oldest first
+    #Returns (events, describe_stack_events calls made); raises ClientError if CloudFormation throttles a request
+    #Only makes API calls and changes nothing, so it is safe to run on an executor thread (see StackPoller.fetchEvents)
+    def fetchNewEvents(self, stackId, lastEventId):
+        client = self.client if self.client is not None else getCloudFormationClient()
+        newEvents = []
+        apiCalls = 0
+        #describe_stack_events returns the newest events first, so stop paging at the cursor
+        for page in client.get_paginator('describe_stack_events').paginate(StackName=stackId):
+            apiCalls += 1
+            reachedCursor = False
+            for event in page['StackEvents']:
+                if(event['EventId'] == lastEventId):
+                    reachedCursor = True
+                    break
+                newEvents.append(event)
+            if(reachedCursor):
+                break
+        newEvents.reverse()
+        return newEvents, apiCalls
+
+    #Print events fetched by fetchNewEvents, time the resources they finish, and move the stack's cursor past them
+    def recordEvents(self, stackId, newEvents, apiCalls):
+        self.apiCalls += apiCalls
+        stackName = self.followedStacks[stackId]
+        if(newEvents):
+            self.lastEventIds[stackId] = newEvents[-1]['EventId']
+        for event in newEvents:
+            resourceKey = (stackName, event['LogicalResourceId'])
+            resourceStatus = event['ResourceStatus']
+            if(resourceStatus == 'CREATE_IN_PROGRESS' and resourceKey not in self.resourceTimings):
+                self.resourceTimings[resourceKey] = {'type' : event['ResourceType'], 'start' : event['Timestamp'], 'end' : None, 'status' : resourceStatus}
+            elif(resourceKey in self.resourceTimings and not resourceStatus.endswith('_IN_PROGRESS')):
+                self.resourceTimings[resourceKey]['end'] = event['Timestamp']
+                self.resourceTimings[resourceKey]['status'] = resourceStatus
+
+            line = '  [%s] %s (%s): %s' % (stackName, event['LogicalResourceId'], event['ResourceType'], resourceStatus)
+            timing = self.resourceTimings.get(resourceKey)
+            if(timing is not None and timing['end'] is not None):
+                line += ' after %s' % (formatDuration((timing['end'] - timing['start']).total_seconds()))
+            if(event.get('ResourceStatusReason') and resourceStatus.endswith('_FAILED')):
+                line += ' - %s' % (event['ResourceStatusReason'])
+            print(line)
+
+    #Print how long each resource took to create, slowest first
+    def printDurationBreakdown(self):
+        finishedResources = [(key, timing) for key, timing in self.resourceTimings.items() if timing['end'] is not None]
+        if(not finishedResources):
+            return
+        finishedResources.sort(key=lambda item: item[1]['end'] - item[1]['start'], reverse=True)
+        print('\n' + SECTION_SEPARATOR)
+        print('Build time by resource (slowest first):')
+        for (stackName, logicalId), timing in finishedResources:
+            print('  %10s  %-35s %-40s %s' % (formatDuration((timing['end'] - timing['start']).total_seconds()), logicalId, timing['type'], stackName))
+        print(SECTION_SEPARATOR)
+
+#Format a number of seconds as "1h 02m 03s", "2m 03s" or "3s"
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if(hours):
+        return '%dh %02dm %02ds' % (hours, minutes, seconds)
+    if(minutes):
+        return '%dm %02ds' % (minutes, seconds)
+    return '%ds' % (seconds)
+
+#Spans (timed phases of the build) and counters (AWS API calls, throttles, retries) for one run of the builder
+#export appends every record to a JSON lines trace, so runs accumulate for later analysis (see printMetricsSummary),
+#and rewrites a Prometheus text file describing the latest run for a local scraper
+class BuildMetrics:
+    def __init__(self):
+        self.runId = '%d-%d' % (time.time(), os.getpid())
+        self.spans = []
+        self.counters = {}
+        #Spans and counters are recorded from the event loop and from boto3 worker threads
+        self.lock = threading.Lock()
+
+    def count(self, name, labels=None, amount=1):
+        counterKey = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[counterKey] = self.counters.get(counterKey, 0) + amount
+
+    #Record a finished span; startTime is in seconds since the epoch
+    def addSpan(self, name, startTime, seconds, **attributes):
+        with self.lock:
+            self.spans.append(dict(attributes, name=name, start=startTime, seconds=seconds))
+
+    def export(self, tracePath=TRACE_PATH, prometheusPath=PROMETHEUS_PATH):
+        if(not self.spans and not self.counters):
+            return
+        self.writeJsonLines(tracePath)
+        self.writePrometheus(prometheusPath)
+
+    def writeJsonLines(self, tracePath=TRACE_PATH):
+        os.makedirs(os.path.dirname(tracePath), exist_ok=True)
+        with open(tracePath, 'a') as traceFile:
+            for span in self.spans:
+                traceFile.write(json.dumps(dict(span, type='span', run=self.runId), sort_keys=True) + '\n')
+            for (name, labels), value in sorted(self.counters.items()):
+                traceFile.write(json.dumps({'type' : 'counter', 'run' : self.runId, 'time' : time.time(), 'name' : name, 'labels' : dict(labels), 'value' : value}, sort_keys=True) + '\n')
+
+    def writePrometheus(self, prometheusPath=PROMETHEUS_PATH):
+        samples = {}
+        for (name, labels), value in self.counters.items():
+            samples.setdefault(name, []).append((dict(labels), value))
+        phaseSeconds = {}
+        tenantTimes = {}
+        for span in self.spans:
+            if(span['name'] == 'waitCondition'):
+                spanKey = ('sbit_wait_condition_seconds', (('resource', span['resource']), ('role', span['role']), ('tenant', span['tenant'] or '')))
+            else:
+                spanKey = ('sbit_stack_phase_seconds', (('phase', span['name']), ('role', span.get('role') or ''), ('tenant', span.get('tenant') or '')))
+            total, spanCount = phaseSeconds.get(spanKey, (0, 0))
+            phaseSeconds[spanKey] = (total + span['seconds'], spanCount + 1)
+            if(span['name'] in ['create', 'wait'] and span.get('tenant')):
+                startTime, endTime = tenantTimes.get(span['tenant'], (span['start'], span['start']))
+                tenantTimes[span['tenant']] = (min(startTime, span['start']), max(endTime, span['start'] + span['seconds']))
+        for (name, labels), (total, spanCount) in phaseSeconds.items():
+            samples.setdefault(name + '_sum', []).append((dict(labels), total))
+            samples.setdefault(name + '_count', []).append((dict(labels), spanCount))
+        samples['sbit_tenant_build_seconds'] = [({'tenant' : tenant}, endTime - startTime) for tenant, (startTime, endTime) in tenantTimes.items()]
+        samples['sbit_last_run_timestamp_seconds'] = [({}, time.time())]
+
+        families = {}
+        for name in samples:
+            families.setdefault(re.sub('_(sum|count)$', '', name), []).append(name)
+        lines = []
+        for familyName, names in sorted(families.items()):
+            lines.append('# HELP %s %s' % (familyName, METRIC_DESCRIPTIONS.get(familyName, familyName)))
+            lines.append('# TYPE %s %s' % (familyName, 'counter' if familyName.endswith('_total') else 'gauge' if familyName in samples else 'summary'))
+            for name in sorted(names):
+                for labels, value in sorted(samples[name], key=lambda sample: sorted(sample[0].items())):
+                    labelText = ','.join('%s="%s"' % (label, str(labelValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, labelValue in sorted(labels.items()))
+                    lines.append('%s%s %s' % (name, '{%s}' % (labelText) if labelText else '', repr(float(value))))
+        os.makedirs(os.path.dirname(prometheusPath), exist_ok=True)
+        with open(prometheusPath + '.tmp', 'w') as prometheusFile:
+            prometheusFile.write('\n'.join(lines) + '\n')
+        os.replace(prometheusPath + '.tmp', prometheusPath)
+
+#Spans and counters for this run, exported when the command finishes
+buildMetrics = BuildMetrics()
+
+#Count every AWS API call made through boto3 (registered on the session's after-call event)
+def recordAwsCall(service, operation, errorCode=None, retryAttempts=0):
+    labels = {'service' : service, 'operation' : operation}
+    buildMetrics.count('sbit_aws_api_calls_total', labels)
+    if(errorCode in THROTTLE_ERROR_CODES):
+        buildMetrics.count('sbit_aws_throttles_total', labels)
+    if(retryAttempts):
+        buildMetrics.count('sbit_aws_sdk_retries_total', labels, retryAttempts)
+
+def onAwsCall(http_response, parsed, model, event_name, **kwargs):
+    recordAwsCall(event_name.split('.')[1], model.name, parsed.get('Error', {}).get('Code'), parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+#Show where time and API calls went in the runs recorded in the trace over the last sinceHours hours
+def printMetricsSummary(tracePath=TRACE_PATH, sinceHours=24*7, top=10):
+    sinceTime = time.time() - sinceHours*60*60
+    phaseSeconds = {}
+    tenantTimes = {}
+    counters = {}
+    runs = set()
+    try:
+        with open(tracePath) as traceFile:
+            records = [json.loads(line) for line in traceFile if line.strip()]
+    except FileNotFoundError:
+        records = []
+    for record in records:
+        if(record.get('start', record.get('time', 0)) < sinceTime):
+            continue
+        runs.add(record['run'])
+        if(record['type'] == 'counter'):
+            counterKey = (record['name'], record['labels'].get('operation', record['labels'].get('code', '')))
+            counters[counterKey] = counters.get(counterKey, 0) + record['value']
+            continue
+        phaseKey = (record['name'], record.get('role') or '-', record.get('resource', ''))
+        phaseSeconds.setdefault(phaseKey, []).append(record['seconds'])
+        if(record['name'] in ['create', 'wait'] and record.get('tenant')):
+            tenantKey = (record['run'], record['tenant'])
+            startTime, endTime = tenantTimes.get(tenantKey, (record['start'], record['start']))
+            tenantTimes[tenantKey] = (min(startTime, record['start']), max(endTime, record['start'] + record['seconds']))
+
+    print(SECTION_SEPARATOR)
+    print('%d run%s in the last %d hours (%s)' % (len(runs), '' if len(runs) == 1 else 's', sinceHours, tracePath))
+    print('\nTime by phase (slowest total first):')
+    print('  %-14s %-9s %-28s %6s %12s %12s' % ('Phase', 'Role', 'Resource', 'Count', 'Mean', 'Total'))
+    for (phase, role, resource), seconds in sorted(phaseSeconds.items(), key=lambda item: sum(item[1]), reverse=True)[:top*2]:
+        print('  %-14s %-9s %-28s %6d %12s %12s' % (phase, role, resource, len(seconds), formatDuration(statistics.mean(seconds)), formatDuration(sum(seconds))))
+    print('\nSlowest tenant builds:')
+    for (run, tenant), (startTime, endTime) in sorted(tenantTimes.items(), key=lambda item: item[1][1] - item[1][0], reverse=True)[:top]:
+        print('  %-20s %12s  (run %s)' % (tenant, formatDuration(endTime - startTime), run))
+    print('\nAWS API budget:')
+    for (name, operation), value in sorted(counters.items(), key=lambda item: (item[0][0], -item[1])):
+        print('  %-30s %-28s %8d' % (name, operation, value))
+    print(SECTION_SEPARATOR)
+
+#Records how long each stack and WaitCondition took to build, keyed by the configuration that was
+#built, so future ETAs can be predicted from percentiles of past runs
+class BuildHistory:
+    def __init__(self, path=BUILD_HISTORY_PATH):
+        if(path != ':memory:'):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS build_timings (
+                recorded_at REAL NOT NULL,
+                stack_role TEXT NOT NULL,
+                resource TEXT NOT NULL,
+                instance_type TEXT NOT NULL,
+                volume_size INTEGER NOT NULL,
+                server_count INTEGER NOT NULL,
+                seconds REAL NOT NULL
+            )''')
+        #Covers every lookup below, including the ORDER BY seconds used for percentiles,
+        #so predictions are answered from the index alone regardless of how many builds are stored
+        self.connection.execute('''
+            CREATE INDEX IF NOT EXISTS build_timings_lookup
+            ON build_timings (stack_role, resource, instance_type, volume_size, server_count, seconds)''')
+        self.connection.execute('''
+            CREATE INDEX IF NOT EXISTS build_timings_by_type
+            ON build_timings (stack_role, resource, instance_type, seconds)''')
+        #One row per environment that asked the network pool for a stack; pool_stack is NULL on a miss
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS pool_claims (
+                claimed_at REAL NOT NULL,
+                tenant TEXT NOT NULL,
+                pool_stack TEXT
+            )''')
+        self.connection.commit()
+
+    def record(self, stackRole, resource, timingKey, seconds):
+        instanceType, volumeSize, serverCount = timingKey
+        self.connection.execute(
+            'INSERT INTO build_timings VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (time.time(), stackRole, resource, instanceType, volumeSize, serverCount, seconds))
+
+    def recordPoolClaim(self, tenant, poolStackName):
+        self.connection.execute('INSERT INTO pool_claims VALUES (?, ?, ?)', (time.time(), tenant, poolStackName))
+
+    #Returns (hits, misses) for claims made since sinceTime
+    def poolClaimCounts(self, sinceTime=0):
+        hits, claims = self.connection.execute('SELECT COUNT(pool_stack), COUNT(*) FROM pool_claims WHERE claimed_at >= ?', (sinceTime,)).fetchone()
+        return hits, claims - hits
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    #Return the requested percentiles (0-1) of past build times for the closest matching configuration
+    #Falls back from an exact match, to the same instance type, to any build of the same role
+    #Returns (percentile values, number of builds) or (None, 0) if nothing has been recorded
+    def estimate(self, stackRole, resource, timingKey, percentiles=(0.5, 0.9)):
+        instanceType, volumeSize, serverCount = timingKey
+        lookups = [
+            ('stack_role = ? AND resource = ? AND instance_type = ? AND volume_size = ? AND server_count = ?', (stackRole, resource, instanceType, volumeSize, serverCount)),
+            ('stack_role = ? AND resource = ? AND instance_type = ?', (stackRole, resource, instanceType)),
+            ('stack_role = ? AND resource = ?', (stackRole, resource)),
+        ]
+        for whereClause, arguments in lookups:
+            buildCount = self.connection.execute('SELECT COUNT(*) FROM build_timings WHERE ' + whereClause, arguments).fetchone()[0]
+            if(buildCount == 0):
+                continue
+            values = []
+            for percentile in percentiles:
+                offset = int(round(percentile * (buildCount - 1)))
+                values.append(self.connection.execute('SELECT seconds FROM build_timings WHERE ' + whereClause + ' ORDER BY seconds LIMIT 1 OFFSET ?', arguments + (offset,)).fetchone()[0])
+            return values, buildCount
+        return None, 0
+
+#Set each stack's expected build time and ETA from the median and 90th percentile of past builds
+#Stacks without any history keep their default estimates
+def applyBuildEstimates(stackGraph, buildHistory):
+    for node in stackGraph:
+        if(not 'role' in node):
+            continue
+        (estimate, buildCount) = buildHistory.estimate(node['role'], STACK_RESOURCE, node['timingKey'])
+        if(estimate is None):
+            continue
+        median, slow = estimate
+        node['expectedSeconds'] = median
+        node['eta'] = '~%s-%s (based on %d past build%s)' % (formatDuration(median), formatDuration(slow), buildCount, '' if buildCount == 1 else 's')
+
+#Longest chain of expected build times through the stack graph
+def estimateCriticalPath(stackGraph):
+    nodesByName = {node['name'] : node for node in stackGraph}
+    finishTimes = {}
+    def startTime(node):
+        return max([readyTime(parent) for parent in node['dependsOn']] or [0])
+    #When the stacks that depend on stackName can start (see dependentsStartOnCreate in runStackGraph)
+    def readyTime(stackName):
+        if(nodesByName[stackName].get('dependentsStartOnCreate')):
+            return startTime(nodesByName[stackName])
+        return finishTime(stackName)
+    def finishTime(stackName):
+        if(not stackName in finishTimes):
+            node = nodesByName[stackName]
+            finishTimes[stackName] = node.get('expectedSeconds', 0) + startTime(node)
+        return finishTimes[stackName]
+    return max(finishTime(node['name']) for node in stackGraph)
+
+#Save the build time of every completed stack and each of its WaitConditions
+#Failed and timed-out stacks are left out of the history; their times say nothing about how long a build takes
+#Neither are stacks a resumed build reattached to, which were only watched for the end of their build
+def recordBuildTimings(stackGraph, eventTail, buildHistory):
+    for node in stackGraph:
+        if(not 'role' in node or not 'buildSeconds' in node or node.get('status') not in STACK_BUILT_STATUSES or node.get('existingStatus') is not None):
+            continue
+        buildHistory.record(node['role'], STACK_RESOURCE, node['timingKey'], node['buildSeconds'])
+        for (stackName, logicalId), timing in eventTail.resourceTimings.items():
+            if(stackName != node['name'] or timing['type'] != 'AWS::CloudFormation::WaitCondition' or timing['end'] is None):
+                continue
+            buildMetrics.addSpan('waitCondition', timing['start'].timestamp(), (timing['end'] - timing['start']).total_seconds(), tenant=node.get('group'), stack=node['name'], role=node['role'], resource=logicalId, status=timing['status'])
+            if(timing['status'] == 'CREATE_COMPLETE'):
+                buildHistory.record(node['role'], logicalId, node['timingKey'], (timing['end'] - timing['start']).total_seconds())
+    buildHistory.commit()
+
+#Shared boto3 session; boto3 itself is only imported the first time AWS is needed
+def getAwsSession():
+    global awsSession
+    if(awsSession is None):
+        import boto3
+        awsSession = boto3.session.Session()
+        awsSession.events.register('after-call', onAwsCall)
+    return awsSession
+
+#botocore's ClientError, imported the first time an AWS error is caught or raised so startup never loads botocore
+def getClientError():
+    from botocore.exceptions import ClientError
+    return ClientError
+
+#Client configuration shared by every AWS client: a connection pool large enough for concurrent builds
+def getAwsClientConfig():
+    from botocore.config import Config
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+
+def getCloudFormationClient():
+    global cloudFormationClient
+    if(cloudFormationClient is None):
+        cloudFormationClient = getAwsSession().client('cloudformation', config=getAwsClientConfig())
+    return cloudFormationClient
+
+def getEc2Client():
+    global ec2Client
+    if(ec2Client is None):
+        ec2Client = getAwsSession().client('ec2', config=getAwsClientConfig())
+    return ec2Client
+
+def getS3Client():
+    global s3Client
+    if(s3Client is None):
+        s3Client = getAwsSession().client('s3', config=getAwsClientConfig())
+    return s3Client
+
+def getSsmClient():
+    global ssmClient
+    if(ssmClient is None):
+        ssmClient = getAwsSession().client('ssm', config=getAwsClientConfig())
+    return ssmClient
+
+#Return a cached AWS lookup, calling lookup() and saving its result if the entry is missing or expired
+#Entries are keyed by the profile and region the session resolved (from the environment or the AWS config
+#files), so a region set only in ~/.aws/config never shares another region's entries
+def getCachedAwsValue(name, lookup, refresh=False):
+    session = getAwsSession()
+    cacheKey = '%s:%s:%s' % (name, session.profile_name, session.region_name)
+    try:
+        with open(AWS_CACHE_PATH) as cacheFile:
+            cache = json.load(cacheFile)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+    entry = cache.get(cacheKey)
+    #Never refresh the same entry twice in one run, however many lookups miss
+    if(refresh and cacheKey in refreshedCacheKeys):
+        refresh = False
+    if(entry is not None and entry['expires'] > time.time() and not refresh):
+        return entry['value']
+
+    value = lookup()
+    refreshedCacheKeys.add(cacheKey)
+    cache[cacheKey] = {'expires' : time.time() + AWS_CACHE_TTL, 'value' : value}
+    os.makedirs(os.path.dirname(AWS_CACHE_PATH), exist_ok=True)
+    with open(AWS_CACHE_PATH + '.tmp', 'w') as cacheFile:
+        json.dump(cache, cacheFile)
+    os.replace(AWS_CACHE_PATH + '.tmp', AWS_CACHE_PATH)
+    return value
+
+#Availability zones in the current region (cached on disk for AWS_CACHE_TTL seconds)
+def getAvailabilityZones(refresh=False):
+    def lookupAvailabilityZones():
+        zones = getEc2Client().describe_availability_zones(Filters=[{'Name' : 'state', 'Values' : ['available']}])['AvailabilityZones']
+        return sorted(zone['ZoneName'] for zone in zones)
+    return getCachedAwsValue('availability-zones', lookupAvailabilityZones, refresh)
+
+#Path of the checkpoint file for a tenant's build
+def getCheckpointPath(tenant):
+    return os.path.join(CHECKPOINT_DIRECTORY, '%s.json' % (tenant))
+
+#Write the environment (without passwords) and the state of each of its stacks to the tenant's checkpoint
+def saveCheckpoint(environment, stackGraph):
+    checkpoint = {
+        'savedAt' : time.time(),
+        'environment' : {field : value for field, value in environment.items() if field not in SECRET_FIELDS},
+        'stacks' : {node['name'] : {'status' : node.get('status'), 'stackId' : node.get('stackId')} for node in stackGraph if node.get('group') == environment['tenant']},
+    }
+    checkpointPath = getCheckpointPath(environment['tenant'])
+    os.makedirs(os.path.dirname(checkpointPath), exist_ok=True)
+    #Write then rename so a killed process never leaves a half-written checkpoint
+    with open(checkpointPath + '.tmp', 'w') as checkpointFile:
+        json.dump(checkpoint, checkpointFile, indent=2)
+    os.replace(checkpointPath + '.tmp', checkpointPath)
+
+#Returns the tenant's saved checkpoint, or None if it has never been built
+def loadCheckpoint(tenant):
+    try:
+        with open(getCheckpointPath(tenant)) as checkpointFile:
+            return json.load(checkpointFile)
+    except FileNotFoundError:
+        return None
+
+#Match the stacks in stackGraph against stacks that already exist (one describe_stacks listing for all)
+#Stacks in STACK_FAILED_STATUSES are deleted so they can be created again; stacks in STACK_KEPT_STATUSES and
+#STACK_BUILDING_STATUSES are marked for runStackGraph to skip or reattach to
+#Stacks in any other in-progress state (ex. rolling back an update, or being deleted) are waited on first, then
+#matched by the state they end up in; stacks left in a state resuming can't fix (ex. UPDATE_ROLLBACK_FAILED) stop it
+#Stacks that depend on a failed stack import its exports, so it cannot be deleted while they exist; they are
+#torn down first (in the same order as the destroy command) and rebuilt with it
+#Returns the nodes that still need to be created
+def inspectExistingStacks(stackGraph, poller=None):
+    if(poller is None):
+        poller = StackPoller()
+    client = poller.client if poller.client is not None else getCloudFormationClient()
+    nodesByName = {node['name'] : node for node in stackGraph}
+    def listExistingStacks():
+        existingStacks = {}
+        for page in callWithBackoff(lambda: list(client.get_paginator('describe_stacks').paginate()), poller.sleep):
+            poller.apiCalls += 1
+            for stack in page['Stacks']:
+                if(stack['StackName'] in nodesByName):
+                    existingStacks[stack['StackName']] = stack
+        return existingStacks
+
+    existingStacks = listExistingStacks()
+    deadline = poller.clock() + DEFAULT_STACK_TIMEOUT
+    reportedStatuses = {}
+    while(True):
+        settlingStacks = {stackName : stack['StackStatus'] for stackName, stack in existingStacks.items() if stack['StackStatus'].endswith('_IN_PROGRESS') and stack['StackStatus'] not in STACK_BUILDING_STATUSES}
+        if(not settlingStacks):
+            break
+        if(poller.clock() > deadline):
+            raise RuntimeError('Timed out waiting for %s to finish; resume again once they have' % (', '.join('%s (%s)' % (stackName, stackStatus) for stackName, stackStatus in sorted(settlingStacks.items()))))
+        for stackName, stackStatus in settlingStacks.items():
+            if(reportedStatuses.get(stackName) != stackStatus):
+                print('%s... %s, waiting for it to finish.' % (nodesByName[stackName]['label'], stackStatus))
+                reportedStatuses[stackName] = stackStatus
+        poller.sleep(MIN_POLL_INTERVAL)
+        existingStacks = listExistingStacks()
+
+    failedStackNames = set(stackName for stackName, stack in existingStacks.items() if stack['StackStatus'] in STACK_FAILED_STATUSES)
+    rebuiltStackNames = set(failedStackNames)
+    dependentsAdded = True
+    while(dependentsAdded):
+        dependentsAdded = False
+        for node in stackGraph:
+            if(node['name'] in existingStacks and not node['name'] in rebuiltStackNames and any(parent in rebuiltStackNames for parent in node['dependsOn'])):
+                rebuiltStackNames.add(node['name'])
+                dependentsAdded = True
+    unresumableStacks = ['%s (%s)' % (stackName, stack['StackStatus']) for stackName, stack in sorted(existingStacks.items()) if not stackName in rebuiltStackNames and stack['StackStatus'] not in STACK_KEPT_STATUSES + STACK_BUILDING_STATUSES]
+    if(unresumableStacks):
+        raise RuntimeError('%s cannot be resumed; fix them in the CloudFormation console (ex. continue the update rollback) or delete them, and resume again' % (', '.join(unresumableStacks)))
+
+    teardownGraph = []
+    nodesToCreate = []
+    for node in stackGraph:
+        stack = existingStacks.get(node['name'])
+        node.pop('existingStatus', None)
+        if(stack is None):
+            nodesToCreate.append(node)
+        elif(not node['name'] in rebuiltStackNames):
+            node['existingStatus'] = stack['StackStatus']
+            node['existingStackId'] = stack['StackId']
+        else:
+            if(node['name'] in failedStackNames):
+                print('%s... Previous build ended in %s, deleting it so it can be rebuilt.' % (node['label'], stack['StackStatus']))
+            else:
+                print('%s... Depends on a stack being rebuilt, deleting it so it can be rebuilt too.' % (node['label']))
+            teardownGraph.append({'name' : node['name'], 'stackId' : stack['StackId'], 'stackStatus' : stack['StackStatus'], 'label' : node['label'], 'group' : node.get('group'), 'role' : node.get('role')})
+            nodesToCreate.append(node)
+    if(teardownGraph):
+        teardownNodesByName = {teardownNode['name'] : teardownNode for teardownNode in teardownGraph}
+        for teardownNode in teardownGraph:
+            teardownNode['deleteAfter'] = [teardownNodesByName[node['name']]['stackId'] for node in stackGraph if node['name'] in teardownNodesByName and teardownNode['name'] in node['dependsOn']]
+        runTeardownGraph(teardownGraph, poller)
+        undeletedStacks = [teardownNode['name'] for teardownNode in teardownGraph if teardownNode['status'] != 'DELETE_COMPLETE']
+        if(undeletedStacks):
+            raise RuntimeError('Could not delete %s to rebuild them; delete them in the CloudFormation console (or with "sbit-master.py destroy") and resume again' % (', '.join(undeletedStacks)))
+    return nodesToCreate
+
+#Check every stack's parameters against its local template (Parameters, AllowedValues, AllowedPattern,
+#length and value limits) so a bad value is rejected in seconds instead of part way through a build
+#Returns a list of problems; an empty list means the graph passed
+def preflightStackGraph(stackGraph):
+    errors = []
+    for node in stackGraph:
+        if(not node.get('role') in TEMPLATE_FILES):
+            continue
+        for error in checkStackParameters(node['role'], node['parameters'], node.get('serverCount')):
+            errors.append('%s: %s' % (node['label'], error))
+    return errors
+
+#serverCount selects the rendered template for AD and FS stacks (see renderServerTemplate)
+#Parameters sent with UsePreviousValue keep the value the deployed stack already accepted, so only their names are checked
+def checkStackParameters(stackRole, parameters, serverCount=None):
+    templateParameters = getTemplateParameters(stackRole, serverCount)
+    errors = []
+    passedValues = {parameter['ParameterKey'] : parameter.get('ParameterValue') for parameter in parameters}
+    previousValues = set(parameter['ParameterKey'] for parameter in parameters if parameter.get('UsePreviousValue'))
+    for parameterName in passedValues:
+        if(not parameterName in templateParameters):
+            errors.append('%s does not accept a parameter named %s' % (TEMPLATE_FILES[stackRole], parameterName))
+    for parameterName, definition in templateParameters.items():
+        definition = dict(definition, **LOCAL_PARAMETER_CONSTRAINTS.get((stackRole, parameterName), {}))
+        if(not parameterName in passedValues):
+            if(not 'Default' in definition):
+                errors.append('%s requires a value and none was given' % (parameterName))
+            continue
+        if(parameterName in previousValues):
+            continue
+        value = str(passedValues[parameterName])
+        if('AllowedValues' in definition and value not in [str(allowed) for allowed in definition['AllowedValues']]):
+            errors.append('%s must be one of %s (got %s)' % (parameterName, ', '.join(str(allowed) for allowed in definition['AllowedValues']), value))
+        #CloudFormation patterns must match the whole value
+        if('AllowedPattern' in definition and re.fullmatch(definition['AllowedPattern'], value) is None):
+            errors.append('%s does not match the pattern %s (got %s)' % (parameterName, definition['AllowedPattern'], value))
+        if('MinLength' in definition and len(value) < int(definition['MinLength'])):
+            errors.append('%s must be at least %s characters long' % (parameterName, definition['MinLength']))
+        if('MaxLength' in definition and len(value) > int(definition['MaxLength'])):
+            errors.append('%s must be at most %s characters long' % (parameterName, definition['MaxLength']))
+        if(definition.get('Type') == 'Number' or 'MinValue' in definition or 'MaxValue' in definition):
+            try:
+                number = float(value)
+            except ValueError:
+                errors.append('%s must be a number (got %s)' % (parameterName, value))
+                continue
+            if('MinValue' in definition and number < float(definition['MinValue'])):
+                errors.append('%s must be at least %s (got %s)' % (parameterName, definition['MinValue'], value))
+            if('MaxValue' in definition and number > float(definition['MaxValue'])):
+                errors.append('%s must be at most %s (got %s)' % (parameterName, definition['MaxValue'], value))
+        if('MinMemoryGiB' in definition):
+            instanceType = getInstanceCatalog().get(value)
+            if(instanceType is not None and instanceType['memoryGiB'] < definition['MinMemoryGiB']):
+                errors.append('%s must have at least %s GiB of memory (%s has %s GiB)' % (parameterName, definition['MinMemoryGiB'], value, instanceType['memoryGiB']))
+    return errors
+
+#A stack's local template, parsed at most once per version of the file
+#Parsed templates are cached in memory and on disk, keyed by the hash of the template's contents
+#Returns (templateHash, template)
+parsedTemplates = {}
+def getParsedTemplate(stackRole):
+    with open(os.path.join(TEMPLATE_DIRECTORY, TEMPLATE_FILES[stackRole]), 'rb') as templateFile:
+        templateBytes = templateFile.read()
+    templateHash = hashlib.sha256(templateBytes).hexdigest()
+    if(templateHash in parsedTemplates):
+        return templateHash, parsedTemplates[templateHash]
+
+    cachePath = os.path.join(TEMPLATE_CACHE_DIRECTORY, templateHash + '.template.json')
+    try:
+        with open(cachePath) as cacheFile:
+            template = json.load(cacheFile)
+    except (FileNotFoundError, ValueError):
+        template = parseTemplate(templateBytes)
+        os.makedirs(TEMPLATE_CACHE_DIRECTORY, exist_ok=True)
+        with open(cachePath + '.tmp', 'w') as cacheFile:
+            json.dump(template, cacheFile, default=str)
+        os.replace(cachePath + '.tmp', cachePath)
+    parsedTemplates[templateHash] = template
+    return templateHash, template
+
+#Parameters section of the template a stack will be built from
+def getTemplateParameters(stackRole, serverCount=None):
+    if(stackRole in SERVER_PREFIXES and serverCount is not None):
+        return renderServerTemplate(stackRole, serverCount).get('Parameters') or {}
+    return getParsedTemplate(stackRole)[1].get('Parameters') or {}
+
+#Parse a CloudFormation YAML template, keeping short-form intrinsic functions (!Ref, !Sub, ...) as plain values
+def parseTemplate(templateBytes):
+    try:
+        import yaml
+    except ImportError:
+        raise SystemExit('Checking templates before a build requires PyYAML (pip install pyyaml).')
+    class TemplateLoader(yaml.SafeLoader):
+        pass
+    def constructIntrinsic(loader, tagSuffix, node):
+        if(isinstance(node, yaml.ScalarNode)):
+            value = loader.construct_scalar(node)
+        elif(isinstance(node, yaml.SequenceNode)):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        #Templates are uploaded as JSON, where GetAtt only has the list form
+        if(tagSuffix == 'GetAtt' and isinstance(value, str)):
+            value = value.split('.', 1)
+        return {'Fn::' + tagSuffix if tagSuffix != 'Ref' else 'Ref' : value}
+    TemplateLoader.add_multi_constructor('!', constructIntrinsic)
+    #Keep values such as "AWSTemplateFormatVersion: 2010-09-09" as strings rather than dates
+    TemplateLoader.add_constructor('tag:yaml.org,2002:timestamp', lambda loader, node: loader.construct_scalar(node))
+    return yaml.load(templateBytes, Loader=TemplateLoader)
+
+#Private IPs for a role's servers: server 1 in subnet 1, server 2 in subnet 2, server 3 back in subnet 1...
+#(ex. DCs get 172.16.0.10, 172.16.1.10, 172.16.0.11, ...)
+def allocatePrivateIps(stackRole, serverCount):
+    return ['%s.%d' % (PRIVATE_SUBNET_PREFIXES[index % 2], PRIVATE_IP_BASES[stackRole] + index // 2) for index in range(serverCount)]
+
+#Template for an AD or FS stack with serverCount servers
+#Servers past the second are copies of server 2, renamed, and moved to the first subnet/AZ for odd numbers
+#so they alternate between AZs like their IPs; rendered templates are cached per template version and count
+renderedTemplates = {}
+def renderServerTemplate(stackRole, serverCount):
+    templateHash, template = getParsedTemplate(stackRole)
+    if(serverCount == TEMPLATE_SERVER_COUNT):
+        return template
+    if((templateHash, serverCount) in renderedTemplates):
+        return renderedTemplates[(templateHash, serverCount)]
+
+    prefix = SERVER_PREFIXES[stackRole]
+    rendered = json.loads(json.dumps(template))
+    #Names of server 2's resources (DC2, DC2WaitHandle, ...) but not the security group it shares with later servers
+    secondServerName = re.compile(r'(?<![A-Za-z0-9])%s2(?![0-9]|SecurityGroup)' % (prefix))
+    for serverNumber in range(TEMPLATE_SERVER_COUNT + 1, serverCount + 1):
+        for suffix in SERVER_CLONE_SUFFIXES[stackRole]:
+            section = 'Parameters' if suffix in ['PrivIP', 'NetBIOSName'] else 'Resources'
+            cloneText = secondServerName.sub('%s%d' % (prefix, serverNumber), json.dumps(template[section][prefix + '2' + suffix]))
+            if(serverNumber % 2 == 1):
+                cloneText = cloneText.replace('PrivSub2', 'PrivSub1').replace('SecondaryAZ', 'PrimaryAZ').replace(prefix + '2SecurityGroup', prefix + '1SecurityGroup')
+            clone = json.loads(cloneText)
+            if(suffix == 'NetBIOSName'):
+                clone['Description'] = 'The NetBIOS name for %s%d.' % (prefix, serverNumber)
+            rendered[section]['%s%d%s' % (prefix, serverNumber, suffix)] = clone
+
+    if(stackRole == 'ad'):
+        wireDomainControllers(rendered, serverCount)
+    else:
+        wireDfsMembers(rendered, serverCount)
+    renderedTemplates[(templateHash, serverCount)] = rendered
+    return rendered
+
+#Point DHCP at the extra DCs and let DCs that share a security group reach each other
+def wireDomainControllers(template, serverCount):
+    resources = template['Resources']
+    for serverNumber in range(TEMPLATE_SERVER_COUNT + 1, serverCount + 1):
+        #Only DC2 has to update DC1's DNS servers; later DCs just point themselves at DC1
+        del resources['DC%d' % (serverNumber)]['Metadata']['AWS::CloudFormation::Init']['finalize']['commands']['b-update-dns-servers-dc1']
+    resources['DHCPOptions']['DependsOn'] = ['DC%dWaitCondition' % (serverNumber) for serverNumber in range(1, serverCount + 1)]
+    resources['DHCPOptions']['Properties']['DomainNameServers'] = [{'Ref' : 'DC%dPrivIP' % (serverNumber)} for serverNumber in range(1, min(serverCount, MAX_DNS_SERVERS) + 1)]
+    #Each DC security group only admits the other subnet; DCs in the same subnet now share a group
+    for securityGroup in ['DC1SecurityGroup', 'DC2SecurityGroup']:
+        resources[securityGroup + 'PeerIngress'] = {
+            'Type' : 'AWS::EC2::SecurityGroupIngress',
+            'Properties' : {'GroupId' : {'Ref' : securityGroup}, 'IpProtocol' : '-1', 'SourceSecurityGroupId' : {'Ref' : securityGroup}},
+        }
+
+#Rewrite FS1's DFS script for every file server: one namespace target per server and a full mesh of
+#replication connections, with FS1 as the primary member
+def wireDfsMembers(template, serverCount):
+    files = template['Resources']['FS1']['Metadata']['AWS::CloudFormation::Init']['setup']['files']
+    members = []
+    for serverNumber in range(1, serverCount + 1):
+        members += ['"', {'Ref' : 'FS%dNetBIOSName' % (serverNumber)}, '.$DomainName"', ',' if serverNumber < serverCount else '); ']
+    eachOtherMember = 'foreach($Member in $Members[1..($Members.Count-1)]){ '
+    files['c:\\cfn\\scripts\\Configure-Dfs.ps1']['content'] = {'Fn::Join' : ['', ['$DomainName="', {'Ref' : 'DomainDNSName'}, '"; ', '$Members=@('] + members + [
+        '$rGroupName="SBITReplicationGroup"; ',
+        '$rFolderName="SBITReplicatedFolder"; ',
+        'New-DfsnRoot -Path "\\\\$DomainName\\AWSShares" -TargetPath "\\\\$($Members[0])\\AWSShares" -Type DomainV2 ',
+        '-Description "Namespace for file servers created by SBIT." -EnableAccessBasedEnumeration $true; ',
+        eachOtherMember + 'New-DfsnRootTarget -Path "\\\\$DomainName\\AWSShares" -TargetPath "\\\\$Member\\AWSShares" }; ',
+        'New-DfsReplicationGroup -DomainName $DomainName -GroupName $rGroupName | ',
+        'New-DfsReplicatedFolder -FolderName $rFolderName -DomainName $DomainName | ',
+        'Add-DfsrMember -DomainName $DomainName -ComputerName $Members[0]; ',
+        eachOtherMember + 'Add-DfsrMember -GroupName $rGroupName -DomainName $DomainName -ComputerName $Member }; ',
+        'for($i = 0; $i -lt $Members.Count; $i++){ for($j = $i + 1; $j -lt $Members.Count; $j++){ ',
+        'Add-DfsrConnection -DomainName $DomainName -GroupName $rGroupName -SourceComputerName $Members[$i] -DestinationComputerName $Members[$j] } }; ',
+        'Set-DfsrMembership -GroupName $rGroupName -FolderName $rFolderName -ComputerName $Members[0] ',
+        '-ContentPath "z:\\AWSShares" -PrimaryMember $true -Force; ',
+        eachOtherMember + 'Set-DfsrMembership -GroupName $rGroupName -FolderName $rFolderName -ComputerName $Member ',
+        '-ContentPath "z:\\AWSShares" -Force }',
+    ]]}
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Bucket that templates and helper scripts are uploaded to: SBIT_ARTIFACT_BUCKET if set, otherwise one
+#named after the account and region, created on first use (cached on disk for AWS_CACHE_TTL seconds)
+def getArtifactBucket(s3=None):
+    if(os.environ.get(ARTIFACT_BUCKET_VARIABLE)):
+        return os.environ[ARTIFACT_BUCKET_VARIABLE]
+    def lookup():
+        client = s3 if s3 is not None else getS3Client()
+        accountId = getAwsSession().client('sts').get_caller_identity()['Account']
+        return createArtifactBucket(client, 'sbit-artifacts-%s-%s' % (accountId, client.meta.region_name))
+    return getCachedAwsValue('artifactBucket', lookup)
+
+#Create the artifact bucket if it does not exist yet, with all public access blocked
+#Instances download helper scripts through presigned URLs (see getScriptUrls), so nothing in it is public
+def createArtifactBucket(s3, bucket):
+    try:
+        s3.head_bucket(Bucket=bucket)
+        return bucket
+    except getClientError() as error:
+        if(error.response['Error']['Code'] not in ['404', 'NoSuchBucket', 'NotFound']):
+            raise
+    createArguments = {'Bucket' : bucket}
+    if(s3.meta.region_name != 'us-east-1'):
+        createArguments['CreateBucketConfiguration'] = {'LocationConstraint' : s3.meta.region_name}
+    s3.create_bucket(**createArguments)
+    s3.put_public_access_block(Bucket=bucket, PublicAccessBlockConfiguration={
+        'BlockPublicAcls' : True, 'IgnorePublicAcls' : True, 'BlockPublicPolicy' : True, 'RestrictPublicBuckets' : True})
+    return bucket
+
+def getArtifactUrl(bucket, region, key):
+    return 'https://%s.s3.%s.amazonaws.com/%s' % (bucket, region, key)
+
+#Presigned GET URLs for the script keys, as {key : url}, signed with the current credentials
+#Signing is local, so it costs no API calls
+def getScriptUrls(s3, bucket, keys):
+    return {key : s3.generate_presigned_url('get_object', Params={'Bucket' : bucket, 'Key' : key}, ExpiresIn=ARTIFACT_URL_SECONDS) for key in keys}
+
+#Content-addressed key: the same bytes always map to the same key, so an existing object never needs re-uploading
+def getArtifactKey(kind, fileName, content):
+    return '%s/%s/%s/%s' % (ARTIFACT_PREFIX, kind, hashlib.sha256(content).hexdigest()[:16], fileName)
+
+#Upload the artifacts ({key : bytes}) the bucket does not already have, maxWorkers at a time
+#One listing of the bucket finds the objects already there; nothing is remembered locally, since objects
+#can be deleted (ex. by a lifecycle rule) behind SBIT's back
+#Returns the number of artifacts uploaded
+def uploadArtifacts(s3, bucket, artifacts, maxWorkers=ARTIFACT_UPLOAD_WORKERS):
+    bucketKeys = set()
+    for page in callWithBackoff(lambda: list(s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=ARTIFACT_PREFIX + '/'))):
+        bucketKeys.update(item['Key'] for item in page.get('Contents', []))
+    missingKeys = [key for key in sorted(artifacts) if key not in bucketKeys]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        uploads = [executor.submit(callWithBackoff, (lambda key: lambda: s3.put_object(Bucket=bucket, Key=key, Body=artifacts[key]))(key)) for key in missingKeys]
+        for upload in uploads:
+            upload.result()
+    return len(missingKeys)
+
+#Upload templates ({name : template}) along with every local helper script they download, and return
+#{name : TemplateURL}; each template's script sources are pointed at freshly signed URLs for the uploaded
+#copies first, so every build uploads its own templates while unchanged scripts are uploaded only once
+def publishTemplates(templates, s3=None, bucket=None, maxWorkers=ARTIFACT_UPLOAD_WORKERS):
+    if(s3 is None):
+        s3 = getS3Client()
+    if(bucket is None):
+        bucket = getArtifactBucket(s3)
+    region = s3.meta.region_name
+    artifacts = {}
+    templateUrls = {}
+    scriptSources = []
+    templates = {name : json.loads(json.dumps(template)) for name, template in templates.items()}
+    for name, template in templates.items():
+        for path, definition in getTemplateFiles(template):
+            scriptName = str(definition.get('source', '')).rsplit('/', 1)[-1]
+            scriptPath = os.path.join(TEMPLATE_DIRECTORY, scriptName)
+            #Scripts without a local copy keep the URL the template already has
+            if(not scriptName or not os.path.isfile(scriptPath)):
+                continue
+            with open(scriptPath, 'rb') as scriptFile:
+                scriptBytes = scriptFile.read()
+            scriptKey = getArtifactKey('scripts', scriptName, scriptBytes)
+            artifacts[scriptKey] = scriptBytes
+            scriptSources.append((definition, scriptKey))
+    scriptUrls = getScriptUrls(s3, bucket, sorted(set(scriptKey for definition, scriptKey in scriptSources)))
+    for definition, scriptKey in scriptSources:
+        definition['source'] = scriptUrls[scriptKey]
+    for name, template in templates.items():
+        templateBytes = json.dumps(template, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        templateKey = getArtifactKey('templates', name + '.json', templateBytes)
+        artifacts[templateKey] = templateBytes
+        templateUrls[name] = getArtifactUrl(bucket, region, templateKey)
+    uploadCount = uploadArtifacts(s3, bucket, artifacts, maxWorkers)
+    if(uploadCount):
+        print('Uploaded %d of %d templates and scripts to s3://%s' % (uploadCount, len(artifacts), bucket))
+    return templateUrls
+
+#Upload the template each stack in the graph will be built from and set node['templateUrl']
+#Stacks use their rendered template if they have one (see renderServerTemplate and applyBakedImages)
+def publishStackTemplates(stackGraph, s3=None, bucket=None, maxWorkers=ARTIFACT_UPLOAD_WORKERS):
+    templates = {}
+    for node in stackGraph:
+        if(node.get('role') in TEMPLATE_FILES):
+            templateName = os.path.splitext(TEMPLATE_FILES[node['role']])[0]
+            if(node.get('template') is not None):
+                templateName += '-' + hashlib.sha256(json.dumps(node['template'], sort_keys=True).encode('utf-8')).hexdigest()[:8]
+            node['templateName'] = templateName
+            templates[templateName] = node['template'] if node.get('template') is not None else getParsedTemplate(node['role'])[1]
+    templateUrls = publishTemplates(templates, s3, bucket, maxWorkers)
+    for node in stackGraph:
+        if('templateName' in node):
+            node['templateUrl'] = templateUrls[node.pop('templateName')]
+    return templateUrls
+
+#Parameters for the VPC and other networking resources
+def getNetworkStackParameters(userPublicIp):
+    return [
+        {
+            'ParameterKey' : 'VpcCidrBlock',
+            'ParameterValue' : '172.16.0.0/22'
+        },
+        {
+            'ParameterKey' : 'PrivSub1CidrBlock',
+            'ParameterValue' : '172.16.0.0/24'
+        },
+        {
+            'ParameterKey' : 'PrivSub2CidrBlock',
+            'ParameterValue' : '172.16.1.0/24'
+        },
+        {
+            'ParameterKey' : 'PubSub1CidrBlock',
+            'ParameterValue' : '172.16.2.0/24'
+        },
+        {
+            'ParameterKey' : 'CustPubIp',
+            'ParameterValue' : userPublicIp
+        },
+    ]
+
 #Build VPC and other networking resources
-def buildNetworkStack(userPublicIp):
-    #vpcStackWaiter can be called to halt script execution until the specified stack is finished executing/building
-    vpcStackWaiter = cloudFormationClient.get_waiter('stack_create_complete')
-    
-    #Print estimated time to completion
+def buildNetworkStack(stackName, parameters, templateUrl):
+    #Announce the component being built
     print('\n' + SECTION_SEPARATOR)
     print('Building AWS Networking...')
-    print('Estimated time to build this component: ~4-6 min.')
     
-    vpcStackResponse = cloudFormationClient.create_stack(
-        StackName = networkStackName,
-        TemplateURL = vpcTemplateUrl,
-        Parameters=[
-            {
-                'ParameterKey' : 'VpcCidrBlock',
-                'ParameterValue' : '172.16.0.0/22'
-            },
-            {
-                'ParameterKey' : 'PrivSub1CidrBlock',
-                'ParameterValue' : '172.16.0.0/24'
-            },
-            {
-                'ParameterKey' : 'PrivSub2CidrBlock',
-                'ParameterValue' : '172.16.1.0/24'
-            },
-            {
-                'ParameterKey' : 'PubSub1CidrBlock',
-                'ParameterValue' : '172.16.2.0/24'
-            },
-            {
-                'ParameterKey' : 'CustPubIp',
-                'ParameterValue' : userPublicIp
-            },
-        ],
+    vpcStackResponse = getCloudFormationClient().create_stack(
+        StackName = stackName,
+        TemplateURL = templateUrl,
+        Parameters = parameters,
         OnFailure='DO_NOTHING'
     )
-    vpcStackWaiter.wait(StackName=vpcStackResponse['StackId'])
+    return vpcStackResponse
 
-    print('AWS Networking... Build Complete!')
+#Parameters for the Domain Controllers
+def getADStackParameters(networkStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userRestoreModePassword, userDcInstanceType, userKeyPair, userNumDcs=MIN_DCS):
+    parameters = [
+        {
+            'ParameterKey' : 'NetworkStackName',
+            'ParameterValue' : networkStackName
+        },
+        {
+            'ParameterKey' : 'DomainDNSName',
+            'ParameterValue' : userDomainName
+        },
+        {
+            'ParameterKey' : 'DomainNetBIOSName',
+            'ParameterValue' : userDomainNetBIOSName
+        },
+        {
+            'ParameterKey' : 'DomainAdminUser',
+            'ParameterValue' : userDomainAdminUsername
+        },
+        {
+            'ParameterKey' : 'DomainAdminPassword',
+            'ParameterValue' : userDomainAdminPassword
+        },
+        {
+            'ParameterKey' : 'RestoreModePassword',
+            'ParameterValue' : userRestoreModePassword
+        },
+        {
+            'ParameterKey' : 'DCInstanceType',
+            'ParameterValue' : userDcInstanceType
+        },
+        {
+            'ParameterKey' : 'KeyPair',
+            'ParameterValue' : userKeyPair
+        },
+    ]
+    for serverNumber, privateIp in enumerate(allocatePrivateIps('ad', userNumDcs), 1):
+        parameters.append({
+            'ParameterKey' : 'DC%dPrivIP' % (serverNumber),
+            'ParameterValue' : privateIp
+        })
+    return parameters
 
-#Build first two Domain Controllers in AD domain
-def buildADStack(networkStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userRestoreModePassword, userDcInstanceType, userKeyPair):
-    #adStackWaiter can be called to halt script execution until the specified stack is finished building
-    adStackWaiter = cloudFormationClient.get_waiter('stack_create_complete')
-    
-    #Print estimated time to completion
+#Build the Domain Controllers in AD domain
+def buildADStack(stackName, parameters, templateUrl):
+    #Announce the component being built
     print('\n' + SECTION_SEPARATOR)
     print('Building Active Directory...')
-    print('Estimated time to build this component: ~25-30 min.')
     
-    adStackResponse = cloudFormationClient.create_stack(
-        StackName = adStackName,
-        TemplateURL = adTemplateUrl,
-        Parameters=[
-            {
-                'ParameterKey' : 'NetworkStackName',
-                'ParameterValue' : networkStackName
-            },
-            {
-                'ParameterKey' : 'DomainDNSName',
-                'ParameterValue' : userDomainName
-            },
-            {
-                'ParameterKey' : 'DomainNetBIOSName',
-                'ParameterValue' : userDomainNetBIOSName
-            },
-            {
-                'ParameterKey' : 'DomainAdminUser',
-                'ParameterValue' : userDomainAdminUsername
-            },
-            {
-                'ParameterKey' : 'DomainAdminPassword',
-                'ParameterValue' : userDomainAdminPassword
-            },
-            {
-                'ParameterKey' : 'RestoreModePassword',
-                'ParameterValue' : userRestoreModePassword
-            },
-            {
-                'ParameterKey' : 'DCInstanceType',
-                'ParameterValue' : userDcInstanceType
-            },
-            {
-                'ParameterKey' : 'KeyPair',
-                'ParameterValue' : userKeyPair
-            },
-            {
-                'ParameterKey' : 'DC1PrivIP',
-                'ParameterValue' : '172.16.0.10'
-            },
-            {
-                'ParameterKey' : 'DC2PrivIP',
-                'ParameterValue' : '172.16.1.10'
-            },
-        ],
-        OnFailure='DO_NOTHING'
+    adStackResponse = getCloudFormationClient().create_stack(
+        StackName = stackName,
+        TemplateURL = templateUrl,
+        Parameters = parameters,
+        OnFailure='DO_NOTHING',
+        Capabilities = STACK_CAPABILITIES
     )
-    adStackWaiter.wait(StackName=adStackResponse['StackId'])
-    print('Active Directory... Build Complete!')
+    return adStackResponse
 
-#Build first two File Servers in AD Domain
-def buildFSStack(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userFsInstanceType, userVolumeSize, userKeyPair):
-    #Print estimated time to completion
+#Parameters for the File Servers
+def getFSStackParameters(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userFsInstanceType, userVolumeSize, userKeyPair, userNumFileServers=MIN_DCS):
+    parameters = [
+        {
+            'ParameterKey' : 'NetworkStackName',
+            'ParameterValue' : networkStackName
+        },
+        {
+            'ParameterKey' : 'ADStackName',
+            'ParameterValue' : adStackName
+        },
+        {
+            'ParameterKey' : 'DomainDNSName',
+            'ParameterValue' : userDomainName
+        },
+        {
+            'ParameterKey' : 'DomainNetBIOSName',
+            'ParameterValue' : userDomainNetBIOSName
+        },
+        {
+            'ParameterKey' : 'DomainAdminUser',
+            'ParameterValue' : userDomainAdminUsername
+        },
+        {
+            'ParameterKey' : 'DomainAdminPassword',
+            'ParameterValue' : userDomainAdminPassword
+        },
+        {
+            'ParameterKey' : 'FSInstanceType',
+            'ParameterValue' : userFsInstanceType
+        },
+        {
+            'ParameterKey' : 'FSVolumeSize',
+            'ParameterValue' : userVolumeSize
+        },
+        {
+            'ParameterKey' : 'KeyPair',
+            'ParameterValue' : userKeyPair
+        },
+    ]
+    for serverNumber, privateIp in enumerate(allocatePrivateIps('fs', userNumFileServers), 1):
+        parameters.append({
+            'ParameterKey' : 'FS%dPrivIP' % (serverNumber),
+            'ParameterValue' : privateIp
+        })
+    return parameters
+
+#Build the File Servers in AD Domain
+def buildFSStack(stackName, parameters, templateUrl):
+    #Announce the component being built
     print('\n' + SECTION_SEPARATOR)
     print('Building File Servers...')
-    print('Estimated time to build this component: ~10-15 min.')
     
-    fsStackResponse = cloudFormationClient.create_stack(
-        StackName = fsStackName,
-        TemplateURL = fsTemplateUrl,
-        Parameters=[
-            {
-                'ParameterKey' : 'NetworkStackName',
-                'ParameterValue' : networkStackName
-            },
-            {
-                'ParameterKey' : 'ADStackName',
-                'ParameterValue' : adStackName
-            },
-            {
-                'ParameterKey' : 'DomainDNSName',
-                'ParameterValue' : userDomainName
-            },
-            {
-                'ParameterKey' : 'DomainNetBIOSName',
-                'ParameterValue' : userDomainNetBIOSName
-            },
-            {
-                'ParameterKey' : 'DomainAdminUser',
-                'ParameterValue' : userDomainAdminUsername
-            },
-            {
-                'ParameterKey' : 'DomainAdminPassword',
-                'ParameterValue' : userDomainAdminPassword
-            },
-            {
-                'ParameterKey' : 'FSInstanceType',
-                'ParameterValue' : userFsInstanceType
-            },
-            {
-                'ParameterKey' : 'FSVolumeSize',
-                'ParameterValue' : userVolumeSize
-            },
-            {
-                'ParameterKey' : 'KeyPair',
-                'ParameterValue' : userKeyPair
-            },
-            {
-                'ParameterKey' : 'FS1PrivIP',
-                'ParameterValue' : '172.16.0.20'
-            },
-            {
-                'ParameterKey' : 'FS2PrivIP',
-                'ParameterValue' : '172.16.1.20'
-            },
-        ],
+    fsStackResponse = getCloudFormationClient().create_stack(
+        StackName = stackName,
+        TemplateURL = templateUrl,
+        Parameters = parameters,
         OnFailure='DO_NOTHING'
     )
     return fsStackResponse
 
+#Parameters for the first Exchange server
+def getExchStackParameters(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userExchangeInstanceType, userExchVolumeSize, userKeyPair):
+    return [
+        {
+            'ParameterKey' : 'NetworkStackName',
+            'ParameterValue' : networkStackName
+        },
+        {
+            'ParameterKey' : 'ADStackName',
+            'ParameterValue' : adStackName
+        },
+        {
+            'ParameterKey' : 'DomainDNSName',
+            'ParameterValue' : userDomainName
+        },
+        {
+            'ParameterKey' : 'DomainNetBIOSName',
+            'ParameterValue' : userDomainNetBIOSName
+        },
+        {
+            'ParameterKey' : 'DomainAdminUser',
+            'ParameterValue' : userDomainAdminUsername
+        },
+        {
+            'ParameterKey' : 'DomainAdminPassword',
+            'ParameterValue' : userDomainAdminPassword
+        },
+        {
+            'ParameterKey' : 'ExchInstanceType',
+            'ParameterValue' : userExchangeInstanceType
+        },
+        {
+            'ParameterKey' : 'ExchDriveSize',
+            'ParameterValue' : userExchVolumeSize
+        },
+        {
+            'ParameterKey' : 'KeyPair',
+            'ParameterValue' : userKeyPair
+        },
+        {
+            'ParameterKey' : 'ExchPrivIP',
+            'ParameterValue' : '172.16.0.30'
+        },
+    ]
+
 #Build first Exchange server in AD Domain
-def buildExchStack(networkStackName, adStackName, userDomainName, userDomainNetBIOSName, userDomainAdminUsername, userDomainAdminPassword, userExchangeInstanceType, userExchVolumeSize, userKeyPair):
-    #Print estimated time to completion
+def buildExchStack(stackName, parameters, templateUrl):
+    #Announce the component being built
     print('\n' + SECTION_SEPARATOR)
     print('Building Exchange Server...')
-    print('Estimated time to build this component: ~1.75-2 hr. (~105-120 min.)')
     
-    exchStackResponse = cloudFormationClient.create_stack(
-        StackName = exchStackName,
-        TemplateURL = exchTemplateUrl,
-        Parameters=[
-            {
-                'ParameterKey' : 'NetworkStackName',
-                'ParameterValue' : networkStackName
-            },
-            {
-                'ParameterKey' : 'ADStackName',
-                'ParameterValue' : adStackName
-            },
-            {
-                'ParameterKey' : 'DomainDNSName',
-                'ParameterValue' : userDomainName
-            },
-            {
-                'ParameterKey' : 'DomainNetBIOSName',
-                'ParameterValue' : userDomainNetBIOSName
-            },
-            {
-                'ParameterKey' : 'DomainAdminUser',
-                'ParameterValue' : userDomainAdminUsername
-            },
-            {
-                'ParameterKey' : 'DomainAdminPassword',
-                'ParameterValue' : userDomainAdminPassword
-            },
-            {
-                'ParameterKey' : 'ExchInstanceType',
-                'ParameterValue' : userExchangeInstanceType
-            },
-            {
-                'ParameterKey' : 'ExchDriveSize',
-                'ParameterValue' : userExchVolumeSize
-            },
-            {
-                'ParameterKey' : 'KeyPair',
-                'ParameterValue' : userKeyPair
-            },
-            {
-                'ParameterKey' : 'ExchPrivIP',
-                'ParameterValue' : '172.16.0.30'
-            },
-        ],
-        OnFailure='DO_NOTHING'
+    exchStackResponse = getCloudFormationClient().create_stack(
+        StackName = stackName,
+        TemplateURL = templateUrl,
+        Parameters = parameters,
+        OnFailure='DO_NOTHING',
+        Capabilities = STACK_CAPABILITIES
     )
     return exchStackResponse
 
-#Wait for File Servers and Exchange Server (Allows these to run asynchronously)
-def waitForFsAndExch(fsResponse, exchResponse):
-    #fsStackWaiter can be called to halt script execution until the specified stack is finished building
-    fsStackWaiter = cloudFormationClient.get_waiter('stack_create_complete')
-    #exchStackWaiter can be called to halt script execution until the specified stack is finished building
-    exchStackWaiter = cloudFormationClient.get_waiter('stack_create_complete')
-    
-    fsStackWaiter.wait(StackName=fsResponse['StackId'])
-    print('\nFile Servers... Build Complete!')
-
-    exchStackWaiter.wait(StackName=exchResponse['StackId'],WaiterConfig={'Delay':30,'MaxAttempts':200})
-    print('\nExchange Server... Build Complete!')
-
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #Prompt for and validate the Domain Name
 def getDomainName(message):
@@ -313,15 +1781,20 @@ def getDomainName(message):
     #Loop until the user enters a valid domain
     while(not validDomain):
         userDomain = input(message)
-        #The domain can include upper and lowercase letters, numbers, and
-        #dashes (-), as long as the dashes are not the first or last 
-        #character. Ex. "-example.com" = invalid, "ex-ample.com" = valid.
-        regex = re.compile('^[A-Za-z0-9]([A-Za-z0-9-]*\.)+[A-Za-z0-9]+$')
-        if(regex.match(userDomain)):
+        if(isValidDomainName(userDomain)):
             validDomain = True
         else:
-            print('Invalid domain. Please enter a valid domain. Domain names must contain only upper and lowercase letters and numbers. Hyphens or dashes (-) are allowed only if they are NOT the first or last character.')
+            print(INVALID_DOMAIN_NAME_MESSAGE)
     return userDomain
+
+INVALID_DOMAIN_NAME_MESSAGE = 'Invalid domain. Please enter a valid domain. Domain names must contain only upper and lowercase letters and numbers. Hyphens or dashes (-) are allowed only if they are NOT the first or last character.'
+
+def isValidDomainName(userDomain):
+    #The domain can include upper and lowercase letters, numbers, and
+    #dashes (-), as long as the dashes are not the first or last 
+    #character. Ex. "-example.com" = invalid, "ex-ample.com" = valid.
+    regex = re.compile('^[A-Za-z0-9]([A-Za-z0-9-]*\.)+[A-Za-z0-9]+$')
+    return regex.match(userDomain) is not None
     
 #Prompt for the NetBIOS name of the domain
 def getNetBiosName(message):
@@ -329,33 +1802,49 @@ def getNetBiosName(message):
     #Loop until the user enters a valid NetBIOS name
     while(not validNetBiosName):
         userNetBiosName = input(message)
-        #The domain NetBIOS name is typically the domain name without the root domain
-        # Ex. example.com => EXAMPLE
-        regex = re.compile('^[A-Za-z0-9\-]+$')
-        if(regex.match(userNetBiosName) and len(userNetBiosName) >= 1 and len(userNetBiosName) <= 15):
+        if(isValidNetBiosName(userNetBiosName)):
             validNetBiosName = True
         else:
-            print('Invalid name. Domain NetBIOS names are typically the domain name without the root (Ex. example.com => EXAMPLE) and computer NetBIOS names are a short name for the computer. NetBIOS names must be between 1 and 15 characters long and can have upper and lowercase letters, numbers, and hyphens (-).')
+            print(INVALID_NETBIOS_NAME_MESSAGE)
     return userNetBiosName
 
+INVALID_NETBIOS_NAME_MESSAGE = 'Invalid name. Domain NetBIOS names are typically the domain name without the root (Ex. example.com => EXAMPLE) and computer NetBIOS names are a short name for the computer. NetBIOS names must be between 1 and 15 characters long and can have upper and lowercase letters, numbers, and hyphens (-).'
+
+def isValidNetBiosName(userNetBiosName):
+    #The domain NetBIOS name is typically the domain name without the root domain
+    # Ex. example.com => EXAMPLE
+    regex = re.compile('^[A-Za-z0-9\-]+$')
+    return regex.match(userNetBiosName) is not None and len(userNetBiosName) >= 1 and len(userNetBiosName) <= 15
+
 #Prompt for the name of the Key Pair to use for accessing instances
 def getKeyPairName(message):
-    #Compile a list of all available Key Pair Names
-    keyPairs = ec2.key_pairs.all()
-    validPairNames = []
-    for pair in keyPairs:
-        validPairNames.append(pair.name)
-
     validKeyPairName = False
     #Prompt for and validate Key Pair Name
     while(not validKeyPairName):
         userKeyPairName = input(message)
-        if(not userKeyPairName in validPairNames):
-            print('Please, enter the name of the key pair you created in AWS.')
+        if(not isValidKeyPairName(userKeyPairName)):
+            print(INVALID_KEY_PAIR_MESSAGE)
         else:
             validKeyPairName = True
     return userKeyPairName
 
+INVALID_KEY_PAIR_MESSAGE = 'Please, enter the name of the key pair you created in AWS.'
+
+#Compile a list of all available Key Pair Names (cached on disk for AWS_CACHE_TTL seconds)
+def getKeyPairNames(refresh=False):
+    def lookupKeyPairNames():
+        validPairNames = []
+        for pair in getEc2Client().describe_key_pairs()['KeyPairs']:
+            validPairNames.append(pair['KeyName'])
+        return validPairNames
+    return getCachedAwsValue('key-pairs', lookupKeyPairNames, refresh)
+
+#A key pair created since the cache was filled is found by refreshing the cache once
+def isValidKeyPairName(userKeyPairName):
+    if(userKeyPairName in getKeyPairNames()):
+        return True
+    return userKeyPairName in getKeyPairNames(refresh=True)
+
 #Prompt for the number of Domain Controllers
 #Users must enter a number between 2 and 8, the default is 2
 def getNumDcs(message):
@@ -363,17 +1852,25 @@ def getNumDcs(message):
     #Loop until the user enters a number between 2 and 8, inclusive
     while(not validNum):
         userNumDcs = input(message)
-        #Ensure the user enters a number between 2 and 8, or leaves the input blank
-        regex = re.compile('(^$)|^[2-8]$')
-        if(not regex.match(userNumDcs)):
-            print('Please, enter a number between 2 and 8.')
+        if(not isValidNumDcs(userNumDcs)):
+            print(INVALID_NUM_DCS_MESSAGE)
         else:
             validNum = True
-    #Return the default if the user enters nothing
-    if(userNumDcs == ''):
+    return parseServerCount(userNumDcs)
+
+INVALID_NUM_DCS_MESSAGE = 'Please, enter a number between 2 and 8.'
+
+def isValidNumDcs(userNumDcs):
+    #Ensure the user enters a number between 2 and 8, or leaves the input blank
+    regex = re.compile('(^$)|^[2-8]$')
+    return regex.match(userNumDcs) is not None
+
+#Return the default if the user enters nothing
+def parseServerCount(userNumServers):
+    if(userNumServers == ''):
         return MIN_DCS
     else:
-        return int(userNumDcs)
+        return int(userNumServers)
 
 #Prompt for the number of File Servers
 #Users must enter a number between 2 and 4, the default is 2
@@ -382,17 +1879,18 @@ def getNumFileServers(message):
     #Loop until the user enters a number between 2 and 4, inclusive
     while(not validNum):
         userNumFileServers = input(message)
-        #Ensure the user enters a number between 2 and 4, or leaves the input blank
-        regex = re.compile('(^$)|^[2-4]$')
-        if(not regex.match(userNumFileServers)):
-            print('Please, enter a number between 2 and 4.')
+        if(not isValidNumFileServers(userNumFileServers)):
+            print(INVALID_NUM_FILE_SERVERS_MESSAGE)
         else:
             validNum = True
-    #Return the default if the user enters nothing
-    if(userNumFileServers == ''):
-        return MIN_DCS
-    else:
-        return int(userNumFileServers)
+    return parseServerCount(userNumFileServers)
+
+INVALID_NUM_FILE_SERVERS_MESSAGE = 'Please, enter a number between 2 and 4.'
+
+def isValidNumFileServers(userNumFileServers):
+    #Ensure the user enters a number between 2 and 4, or leaves the input blank
+    regex = re.compile('(^$)|^[2-4]$')
+    return regex.match(userNumFileServers) is not None
 
 #Prompt for and validate the size of drives to be added to file servers
 def getVolumeSize(message):
@@ -400,46 +1898,104 @@ def getVolumeSize(message):
     #Loop until a valid volume size is entered
     while(not validSize):
         userVolumeSize = input(message)
-        #Validate that the number entered is positive and between MAX_VOLUME_SIZE and MIN_VOLUME_SIZE
-        try:
-            if(int(userVolumeSize) > MAX_VOLUME_SIZE or int(userVolumeSize) < MIN_VOLUME_SIZE):
-                raise ValueError
-            else:
-                validSize = True
-        except ValueError:
-            print('Invalid input. Please enter a number between %d and %d.' % (MIN_VOLUME_SIZE,MAX_VOLUME_SIZE))
+        if(isValidVolumeSize(userVolumeSize)):
+            validSize = True
+        else:
+            print(INVALID_VOLUME_SIZE_MESSAGE)
     return userVolumeSize
 
+INVALID_VOLUME_SIZE_MESSAGE = 'Invalid input. Please enter a number between %d and %d.' % (MIN_VOLUME_SIZE,MAX_VOLUME_SIZE)
+
+def isValidVolumeSize(userVolumeSize):
+    #Validate that the number entered is positive and between MAX_VOLUME_SIZE and MIN_VOLUME_SIZE
+    try:
+        return int(userVolumeSize) <= MAX_VOLUME_SIZE and int(userVolumeSize) >= MIN_VOLUME_SIZE
+    except ValueError:
+        return False
+
+#Prompt for and validate the volume size for the Exchange server
+def getExchVolumeSize(message):
+    validSize = False
+    #Loop until a valid volume size is entered
+    while(not validSize):
+        userVolumeSize = input(message)
+        if(isValidExchVolumeSize(userVolumeSize)):
+            validSize = True
+        else:
+            print(INVALID_EXCH_VOLUME_SIZE_MESSAGE)
+    return userVolumeSize
+
+INVALID_EXCH_VOLUME_SIZE_MESSAGE = 'Invalid input. Please enter a number between %d and %d (Exchange needs at least %dGB to install).' % (MIN_EXCH_VOLUME_SIZE,MAX_VOLUME_SIZE,MIN_EXCH_VOLUME_SIZE)
+
+def isValidExchVolumeSize(userVolumeSize):
+    #Smaller drives pass the template but fail deep inside the ~2hr Exchange build
+    return isValidVolumeSize(userVolumeSize) and int(userVolumeSize) >= MIN_EXCH_VOLUME_SIZE
+
 #Prompt for and validate the instance type for instances
-def getInstanceType(message):
-    validTypes = ["t2.micro","t2.small","t2.medium","t2.large","t2.xlarge","t2.2xlarge","m5.large","m5.xlarge","m5.2xlarge","m5.4xlarge","r4.large"]
+#Returns defaultInstanceType if the user enters nothing
+def getInstanceType(message, defaultInstanceType):
     validType = False
     #Loop until a valid instance type is entered
     while(not validType):
         userInstanceType = input(message)
-        if(userInstanceType in validTypes):
+        if(isValidInstanceType(userInstanceType)):
             validType = True
         else:
-            print('Invalid input. Please enter one of the following instance types:')
-            for instanceType in validTypes[:-2]:
-                print('%s, ' % (instanceType), end='')
-            print(validTypes[-1])
-    return userInstanceType
-    
+            print(INVALID_INSTANCE_TYPE_MESSAGE)
+    return userInstanceType or defaultInstanceType
+
+INVALID_INSTANCE_TYPE_MESSAGE = 'Invalid input. Please enter an instance type that can run Windows (Ex. t3.medium, m5.large), or leave blank for the default. Run "sbit-master.py advise" to see the types that fit your users.'
+
+#Blank means the default; anything else must be in the instance type catalog and able to run Windows
+def isValidInstanceType(userInstanceType):
+    if(userInstanceType == ''):
+        return True
+    instanceType = getInstanceCatalog().get(userInstanceType)
+    return instanceType is not None and instanceType['windowsHourly'] is not None
+
+#Prompt for the number of people who will use the environment, which instance types are sized for
+def getUserCount(message):
+    validCount = False
+    #Loop until the user enters a number or leaves the input blank
+    while(not validCount):
+        userCount = input(message)
+        if(isValidUserCount(userCount)):
+            validCount = True
+        else:
+            print(INVALID_USER_COUNT_MESSAGE)
+    return parseUserCount(userCount)
+
+INVALID_USER_COUNT_MESSAGE = 'Please, enter a number between 1 and %d, or leave blank to use the default instance types.' % (MAX_USER_COUNT)
+
+def isValidUserCount(userCount):
+    return userCount == '' or (userCount.isdigit() and 1 <= int(userCount) <= MAX_USER_COUNT)
+
+#Return None (no sizing) if the user enters nothing
+def parseUserCount(userCount):
+    if(userCount == ''):
+        return None
+    else:
+        return int(userCount)
+
 #Prompt for usernames for AD users
 def getUsername(message):
     validUsername = False
     #Loop until the user enters a valid username
     while(not validUsername):
         userName = input(message)
-        #Ensure the username has no symbols
-        regex = re.compile('[a-zA-Z0-9]*')
-        if(len(userName) >= 3 and len(userName) <= 25 and regex.match(userName)):
+        if(isValidUsername(userName)):
             validUsername = True
         else:
-            print('Invalid username. Usernames can contain upper and lowercase letters and numbers. Usernames should be between 3 and 25 characters in length.')
+            print(INVALID_USERNAME_MESSAGE)
     return userName
 
+INVALID_USERNAME_MESSAGE = 'Invalid username. Usernames can contain upper and lowercase letters and numbers. Usernames should be between 3 and 25 characters in length.'
+
+def isValidUsername(userName):
+    #Ensure the username has no symbols
+    regex = re.compile('[a-zA-Z0-9]*')
+    return len(userName) >= 3 and len(userName) <= 25 and regex.match(userName) is not None
+
 #Prompt for and validate the AD admin password
 def getPassword(message):
     validPassword = False
@@ -447,33 +2003,1502 @@ def getPassword(message):
     #contains at least one upper and lowercase letter, number, and symbol
     while(not validPassword):
         userPassword = getpass.getpass(message)
-        #Check to see if password meets length and complexity requirements
-        if(
-            (len(userPassword) >= 8) and
-            (re.search(r'[A-Z]', userPassword) is not None) and #Checks for Uppercase
-            (re.search(r'[a-z]', userPassword) is not None) and #Checks for Lowercase
-            (re.search(r'\d', userPassword) is not None) and #Checks for Numbers
-            (re.search(r"[!#$%&'()*+,-./[\\\]^_`{|}~"+r'":;<=>?@]', userPassword) is not None) #Checks for Symbols
-           ):
+        if(isValidPassword(userPassword)):
             validPassword = True
         else:
-            print('Invalid password. Password should be 8 characters or more and contain an uppercase letter, lowercase letter, number, and symbol.')
+            print(INVALID_PASSWORD_MESSAGE)
     return userPassword
 
+INVALID_PASSWORD_MESSAGE = 'Invalid password. Password should be 8 characters or more and contain an uppercase letter, lowercase letter, number, and symbol.'
+
+#Check to see if password meets length and complexity requirements
+def isValidPassword(userPassword):
+    return (
+        (len(userPassword) >= 8) and
+        (re.search(r'[A-Z]', userPassword) is not None) and #Checks for Uppercase
+        (re.search(r'[a-z]', userPassword) is not None) and #Checks for Lowercase
+        (re.search(r'\d', userPassword) is not None) and #Checks for Numbers
+        (re.search(r"[!#$%&'()*+,-./[\\\]^_`{|}~"+r'":;<=>?@]', userPassword) is not None) #Checks for Symbols
+       )
+
 def getIpAddress(message):
     validIp = False
     #Loop until user enters a valid IP address
     #Does not validate for public vs. private IPs!!!
     while(not validIp):
         userIp = input(message)
-        #Ensure the IP is in the correct format
-        regex = re.compile('^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$')
-        if(regex.match(userIp)):
+        if(isValidIpAddress(userIp)):
             validIp = True
         else:
-            print('Invalid IP. IPs must be in decimal-dot format. (Ex. 192.168.0.0)')
+            print(INVALID_IP_ADDRESS_MESSAGE)
     return userIp
 
+INVALID_IP_ADDRESS_MESSAGE = 'Invalid IP. IPs must be in decimal-dot format. (Ex. 192.168.0.0)'
+
+def isValidIpAddress(userIp):
+    #Ensure the IP is in the correct format
+    regex = re.compile('^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])$')
+    return regex.match(userIp) is not None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Instance types used when no user count is given
+DEFAULT_INSTANCE_TYPES = {
+    'ad' : 't2.micro',
+    'fs' : 't2.micro',
+    'exchange' : 'r4.large',
+}
+#Environment field holding each role's instance type
+INSTANCE_TYPE_FIELDS = {
+    'ad' : 'dcInstanceType',
+    'fs' : 'fsInstanceType',
+    'exchange' : 'exchInstanceType',
+}
+HOURS_PER_MONTH = 730
+
+#Instance type specs and prices from the bundled catalog, indexed by name and by Windows price so that a
+#recommendation is a scan that stops at the first (cheapest) type meeting a role's needs
+class InstanceCatalog:
+    def __init__(self, catalogPath=INSTANCE_CATALOG_PATH):
+        with open(catalogPath) as catalogFile:
+            catalog = json.load(catalogFile)
+        self.region = catalog['region']
+        self.instanceTypes = {row[0] : dict(zip(catalog['fields'], row)) for row in catalog['instanceTypes']}
+        #Only types that can run Windows are recommended; current generation types win ties
+        self.byWindowsPrice = sorted([instanceType for instanceType in self.instanceTypes.values() if instanceType['windowsHourly'] is not None],
+                                     key=lambda instanceType: (instanceType['windowsHourly'], not instanceType['currentGeneration'], instanceType['instanceType']))
+
+    def get(self, instanceTypeName):
+        return self.instanceTypes.get(instanceTypeName)
+
+    #Returns the count cheapest types that meet requirements (from getRoleRequirements)
+    def recommend(self, requirements, count=1):
+        matches = []
+        for instanceType in self.byWindowsPrice:
+            if(meetsRequirements(instanceType, requirements)):
+                matches.append(instanceType)
+                if(len(matches) == count):
+                    break
+        return matches
+
+instanceCatalog = None
+def getInstanceCatalog():
+    global instanceCatalog
+    if(instanceCatalog is None):
+        instanceCatalog = InstanceCatalog()
+    return instanceCatalog
+
+#What one server of each role needs for userCount users, with storageGiB on each file server
+#Domain controllers mostly need memory to cache the directory and very little CPU
+#File servers need memory for metadata and caching (~1 GiB per TiB stored) and network for file traffic
+#Exchange needs MIN_EXCH_MEMORY plus ~10 MB per mailbox and a vCPU per 400 mailboxes; its indexing and
+#health checks keep the CPU busy, so it is never put on a burstable type that would run out of CPU credits
+#sustainedVcpus is the average load a burstable type must carry at its baseline, without spending credits
+def getRoleRequirements(stackRole, userCount, storageGiB=0):
+    if(stackRole == 'ad'):
+        return {'vcpus' : 1 if userCount <= 500 else 2 if userCount <= 10000 else 4, 'memoryGiB' : max(1, 0.5 + userCount / 2000),
+                'networkGbps' : 0.1, 'sustainedVcpus' : userCount / 20000, 'burstable' : True}
+    if(stackRole == 'fs'):
+        return {'vcpus' : 1 if userCount <= 50 else 2 if userCount <= 1000 else 4, 'memoryGiB' : 1 + storageGiB / 1024 + userCount / 1000,
+                'networkGbps' : max(0.3, userCount * 0.001), 'sustainedVcpus' : userCount / 5000, 'burstable' : True}
+    return {'vcpus' : max(2, math.ceil(userCount / 400)), 'memoryGiB' : MIN_EXCH_MEMORY + userCount * 0.01,
+            'networkGbps' : max(0.45, userCount * 0.001), 'sustainedVcpus' : userCount / 400, 'burstable' : False}
+
+def meetsRequirements(instanceType, requirements):
+    if(instanceType['vcpus'] < requirements['vcpus'] or instanceType['memoryGiB'] < requirements['memoryGiB'] or instanceType['networkGbps'] < requirements['networkGbps']):
+        return False
+    if(instanceType['baselinePercent'] < 100):
+        return requirements['burstable'] and instanceType['vcpus'] * instanceType['baselinePercent'] / 100 >= requirements['sustainedVcpus']
+    return True
+
+#The instance type for each environment field: the cheapest type that fits userCount users, or the fixed
+#defaults if userCount is None
+def getDefaultInstanceTypes(userCount, storageGiB=0):
+    if(userCount is None):
+        return {INSTANCE_TYPE_FIELDS[stackRole] : instanceType for stackRole, instanceType in DEFAULT_INSTANCE_TYPES.items()}
+    catalog = getInstanceCatalog()
+    defaults = {}
+    for stackRole, field in INSTANCE_TYPE_FIELDS.items():
+        matches = catalog.recommend(getRoleRequirements(stackRole, userCount, storageGiB))
+        #Nothing in the catalog is big enough; the largest default is the best that can be done
+        defaults[field] = matches[0]['instanceType'] if matches else DEFAULT_INSTANCE_TYPES[stackRole]
+    return defaults
+
+#Print the cheapest instance types for each role and what the whole environment would cost per month,
+#next to the fixed defaults
+def printInstanceAdvice(userCount, storageGiB=0, numDcs=MIN_DCS, numFileServers=MIN_DCS, top=3):
+    catalog = getInstanceCatalog()
+    serverCounts = {'ad' : numDcs, 'fs' : numFileServers, 'exchange' : 1}
+    print(SECTION_SEPARATOR)
+    print('Instance types for %d users and %d GiB per file server (%s on-demand Windows prices, %s)' % (userCount, storageGiB, catalog.region, INSTANCE_CATALOG_PATH))
+    recommendedCost = 0
+    defaultCost = 0
+    defaultsFit = True
+    for stackRole, field in INSTANCE_TYPE_FIELDS.items():
+        requirements = getRoleRequirements(stackRole, userCount, storageGiB)
+        print('\n%s x%d (needs %d vCPU, %.1f GiB, %.2f Gbps%s):' % (STACK_LABELS[stackRole], serverCounts[stackRole], requirements['vcpus'], requirements['memoryGiB'], requirements['networkGbps'],
+                                                                 ', %.2f vCPU sustained' % (requirements['sustainedVcpus']) if requirements['burstable'] else ', no burstable types'))
+        print('  %-22s %5s %8s %8s %10s %10s %12s' % ('Type', 'vCPU', 'GiB', 'Gbps', 'Baseline', '$/hour', '$/month'))
+        matches = catalog.recommend(requirements, top)
+        defaultType = catalog.get(DEFAULT_INSTANCE_TYPES[stackRole])
+        for instanceType in matches + ([defaultType] if defaultType not in matches else []):
+            label = instanceType['instanceType'] + (' (default)' if instanceType is defaultType else '')
+            print('  %-22s %5d %8.2f %8.2f %9.0f%% %10.4f %12.2f%s' % (label, instanceType['vcpus'], instanceType['memoryGiB'], instanceType['networkGbps'], instanceType['baselinePercent'],
+                                                                instanceType['windowsHourly'], instanceType['windowsHourly'] * HOURS_PER_MONTH, '' if meetsRequirements(instanceType, requirements) else '  too small'))
+        if(matches):
+            recommendedCost += matches[0]['windowsHourly'] * HOURS_PER_MONTH * serverCounts[stackRole]
+        defaultCost += defaultType['windowsHourly'] * HOURS_PER_MONTH * serverCounts[stackRole]
+        defaultsFit = defaultsFit and meetsRequirements(defaultType, requirements)
+    print('\nEnvironment per month: $%.2f with the recommended types, $%.2f with the defaults%s' % (recommendedCost, defaultCost, '' if defaultsFit else ' (which are too small)'))
+    print(SECTION_SEPARATOR)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Tenant names become part of each stack's name
+def isValidTenantName(tenant):
+    regex = re.compile('^[A-Za-z][A-Za-z0-9-]*$')
+    return regex.match(tenant) is not None and len(tenant) <= MAX_TENANT_NAME_LENGTH
+
+#Columns of a batch manifest, the validator for each, and the message shown when a value is invalid
+#Blank server counts and instance types use the same defaults as the interactive prompts
+MANIFEST_FIELDS = [
+    ('tenant', isValidTenantName, 'Invalid tenant. Tenant names must start with a letter, contain only letters, numbers, and hyphens (-), and be at most %d characters long.' % (MAX_TENANT_NAME_LENGTH)),
+    ('domainName', isValidDomainName, INVALID_DOMAIN_NAME_MESSAGE),
+    ('netBiosName', isValidNetBiosName, INVALID_NETBIOS_NAME_MESSAGE),
+    ('keyPair', isValidKeyPairName, INVALID_KEY_PAIR_MESSAGE),
+    ('numDcs', isValidNumDcs, INVALID_NUM_DCS_MESSAGE),
+    ('numFileServers', isValidNumFileServers, INVALID_NUM_FILE_SERVERS_MESSAGE),
+    ('volumeSize', isValidVolumeSize, INVALID_VOLUME_SIZE_MESSAGE),
+    ('exchVolumeSize', isValidExchVolumeSize, INVALID_EXCH_VOLUME_SIZE_MESSAGE),
+    ('users', isValidUserCount, INVALID_USER_COUNT_MESSAGE),
+    ('dcInstanceType', isValidInstanceType, INVALID_INSTANCE_TYPE_MESSAGE),
+    ('fsInstanceType', isValidInstanceType, INVALID_INSTANCE_TYPE_MESSAGE),
+    ('exchInstanceType', isValidInstanceType, INVALID_INSTANCE_TYPE_MESSAGE),
+    ('adminUsername', isValidUsername, INVALID_USERNAME_MESSAGE),
+    ('adminPassword', isValidPassword, INVALID_PASSWORD_MESSAGE),
+    ('restoreModePassword', isValidPassword, INVALID_PASSWORD_MESSAGE),
+    ('publicIp', isValidIpAddress, INVALID_IP_ADDRESS_MESSAGE),
+]
+#Password columns may hold "env:VARIABLE_NAME" to keep passwords out of the manifest file
+ENVIRONMENT_VALUE_PREFIX = 'env:'
+
+#Build every environment listed in a manifest, several at once, and print a summary of the results
+#Returns the process exit code
+#With resume, stacks left by an earlier run of the same manifest are skipped, reattached to, or rebuilt
+#poller, if given, watches the stacks instead of a new StackPoller (ex. one on a simulated clock; see tests/benchmark.py)
+#and is given a stack event tail if it has none, so wait condition timings are recorded as they are for a single build
+def runBatch(manifestPath, maxConcurrent=DEFAULT_BATCH_CONCURRENCY, dryRun=False, resume=False, poller=None):
+    print(SECTION_SEPARATOR)
+    print('SBIT batch build: %s' % (manifestPath))
+    environments, errors = validateManifest(loadManifest(manifestPath))
+    if(resume):
+        #Tenants that were given a pooled network stack carry on with it
+        for environment in environments:
+            checkpoint = loadCheckpoint(environment['tenant'])
+            if(checkpoint is not None and checkpoint['environment'].get('networkStackName')):
+                environment['networkStackName'] = checkpoint['environment']['networkStackName']
+    if(not errors):
+        stackGraph = []
+        for environment in environments:
+            stackGraph.extend(createStackGraph(environment))
+        applyBakedImages(stackGraph)
+        errors = preflightStackGraph(stackGraph)
+    if(errors):
+        print('\nThe manifest has %d problem%s; nothing was built:' % (len(errors), '' if len(errors) == 1 else 's'))
+        for error in errors:
+            print('  ' + error)
+        return 1
+    print('%d environment%s validated.' % (len(environments), '' if len(environments) == 1 else 's'))
+    if(dryRun):
+        return 0
+
+    #All tenants' stacks form one graph watched by one poller, so API calls stay flat as tenants are added
+    if(poller is None):
+        poller = StackPoller()
+    if(poller.eventTail is None):
+        poller.eventTail = StackEventTail(poller.client)
+    publishStackTemplates(stackGraph)
+    buildHistory = BuildHistory()
+    if(resume):
+        inspectExistingStacks(stackGraph, poller)
+    else:
+        claimPooledNetworks(stackGraph, environments, buildHistory, sleep=poller.sleep)
+    applyBuildEstimates(stackGraph, buildHistory)
+    environmentsByTenant = {environment['tenant'] : environment for environment in environments}
+    #Only the tenant whose stack changed needs its checkpoint rewritten
+    def saveCheckpoints(graph, node):
+        saveCheckpoint(environmentsByTenant[node['group']], graph)
+    startTime = poller.clock()
+    try:
+        runStackGraph(stackGraph, poller, maxConcurrentGroups=maxConcurrent, raiseOnFailure=False, onProgress=saveCheckpoints)
+    finally:
+        recordBuildTimings(stackGraph, poller.eventTail, buildHistory)
+        buildHistory.close()
+    return printBatchSummary(environments, stackGraph, poller.clock() - startTime)
+
+#Read a CSV or YAML manifest into a list of rows (one dictionary per environment)
+#YAML manifests may be a list of environments or a mapping with an "environments" list
+def loadManifest(manifestPath):
+    if(manifestPath.lower().endswith('.csv')):
+        with open(manifestPath, newline='') as manifestFile:
+            return list(csv.DictReader(manifestFile))
+    try:
+        import yaml
+    except ImportError:
+        raise SystemExit('Reading YAML manifests requires PyYAML (pip install pyyaml); CSV manifests need no extra packages.')
+    with open(manifestPath) as manifestFile:
+        manifest = yaml.safe_load(manifestFile) or []
+    if(isinstance(manifest, dict)):
+        manifest = manifest.get('environments', [])
+    return manifest
+
+#Check every row with the same validators used by the interactive prompts
+#Returns (environments, errors); environments is only usable if errors is empty
+def validateManifest(rows):
+    environments = []
+    errors = []
+    seenTenants = set()
+    for rowNumber, row in enumerate(rows, start=1):
+        environment = {}
+        for field, validator, message in MANIFEST_FIELDS:
+            value = row.get(field)
+            value = '' if value is None else str(value).strip()
+            if(value.startswith(ENVIRONMENT_VALUE_PREFIX)):
+                value = os.environ.get(value[len(ENVIRONMENT_VALUE_PREFIX):], '')
+            if(not validator(value)):
+                errors.append('Row %d (%s), %s: %s' % (rowNumber, row.get('tenant') or 'no tenant', field, message))
+            environment[field] = value
+        if(environment['tenant'] in seenTenants):
+            errors.append('Row %d: tenant %s appears more than once; tenant names must be unique.' % (rowNumber, environment['tenant']))
+        seenTenants.add(environment['tenant'])
+        environment['numDcs'] = parseServerCount(environment['numDcs']) if isValidNumDcs(environment['numDcs']) else environment['numDcs']
+        environment['numFileServers'] = parseServerCount(environment['numFileServers']) if isValidNumFileServers(environment['numFileServers']) else environment['numFileServers']
+        if(isValidUserCount(environment['users'])):
+            environment['users'] = parseUserCount(environment['users'])
+            defaultInstanceTypes = getDefaultInstanceTypes(environment['users'], int(environment['volumeSize']) if isValidVolumeSize(environment['volumeSize']) else 0)
+            for field, instanceType in defaultInstanceTypes.items():
+                environment[field] = environment[field] or instanceType
+        environments.append(environment)
+    return environments, errors
+
+#Print one line per environment and overall throughput; returns 0 if every environment built
+def printBatchSummary(environments, stackGraph, elapsedSeconds):
+    print('\n' + SECTION_SEPARATOR)
+    print('%-20s %-10s %-12s %s' % ('Tenant', 'Result', 'Build Time', 'Stacks'))
+    builtCount = 0
+    for environment in environments:
+        tenantNodes = [node for node in stackGraph if node['group'] == environment['tenant']]
+        built = all(node['status'] in STACK_BUILT_STATUSES for node in tenantNodes)
+        builtCount += 1 if built else 0
+        finishTimes = [node['startTime'] + node['buildSeconds'] for node in tenantNodes if 'buildSeconds' in node]
+        startTimes = [node['startTime'] for node in tenantNodes if 'startTime' in node]
+        buildTime = formatDuration(max(finishTimes) - min(startTimes)) if finishTimes else '-'
+        stackStatuses = ', '.join('%s=%s' % (node['role'], node['status']) for node in tenantNodes)
+        print('%-20s %-10s %-12s %s' % (environment['tenant'], 'Complete' if built else 'FAILED', buildTime, stackStatuses))
+    print('\n%d of %d environments built in %s (%.2f environments/hour)' % (builtCount, len(environments), formatDuration(elapsedSeconds), builtCount / max(elapsedSeconds, 1) * 3600))
+    print(SECTION_SEPARATOR)
+    return 0 if builtCount == len(environments) else 1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Settings that can be changed on an existing environment, and the validator for each
+UPDATABLE_FIELDS = [
+    ('volumeSize', isValidVolumeSize, INVALID_VOLUME_SIZE_MESSAGE),
+    ('exchVolumeSize', isValidExchVolumeSize, INVALID_EXCH_VOLUME_SIZE_MESSAGE),
+    ('dcInstanceType', lambda value: value != '' and isValidInstanceType(value), INVALID_INSTANCE_TYPE_MESSAGE),
+    ('fsInstanceType', lambda value: value != '' and isValidInstanceType(value), INVALID_INSTANCE_TYPE_MESSAGE),
+    ('exchInstanceType', lambda value: value != '' and isValidInstanceType(value), INVALID_INSTANCE_TYPE_MESSAGE),
+]
+#Seconds between checks while CloudFormation works out what a change set will do
+CHANGE_SET_POLL_INTERVAL = 5
+
+#Change settings on an already-built environment without rebuilding it
+#Only stacks whose parameters changed get a change set; each change set's resource-level diff is shown
+#before anything is applied, then the changes run in dependency order
+#changes maps UPDATABLE_FIELDS names to their new values; returns the process exit code
+def runUpdate(tenant, changes, assumeYes=False, poller=None):
+    if(poller is None):
+        poller = StackPoller()
+    checkpoint = loadCheckpoint(tenant)
+    if(checkpoint is None):
+        raise SystemExit('No checkpoint found at %s; build the environment before updating it.' % (getCheckpointPath(tenant)))
+    environment = dict(checkpoint['environment'])
+    for field, validator, message in UPDATABLE_FIELDS:
+        if(changes.get(field) is None):
+            continue
+        if(not validator(str(changes[field]))):
+            print('%s: %s' % (field, message))
+            return 1
+        environment[field] = str(changes[field])
+    #Passwords are not needed: secret parameters keep their deployed values
+    stackGraph = createStackGraph(dict(environment, **{field : None for field in SECRET_FIELDS}))
+    for node in stackGraph:
+        node['parameters'] = [{'ParameterKey' : parameter['ParameterKey'], 'UsePreviousValue' : True} if parameter['ParameterKey'] in SECRET_PARAMETERS else parameter for parameter in node['parameters']]
+
+    preflightErrors = preflightStackGraph(stackGraph)
+    if(preflightErrors):
+        print('\nThese values would be rejected by the CloudFormation templates; nothing was changed:')
+        for error in preflightErrors:
+            print('  ' + error)
+        return 1
+
+    #Create a change set for every stack whose parameters differ from what is deployed
+    client = poller.client if poller.client is not None else getCloudFormationClient()
+    changeSetName = 'sbit-update-%d' % (time.time())
+    updateGraph = []
+    for node in stackGraph:
+        changedParameters = getChangedParameters(client, node, poller)
+        if(not changedParameters):
+            continue
+        print('\n' + SECTION_SEPARATOR)
+        print('%s (%s):' % (node['label'], node['name']))
+        for parameterName, (oldValue, newValue) in sorted(changedParameters.items()):
+            print('  %s: %s -> %s' % (parameterName, oldValue, newValue))
+        resourceChanges = createUpdateChangeSet(client, node, changeSetName, poller)
+        if(not resourceChanges):
+            print('  (no resource changes)')
+            continue
+        for change in resourceChanges:
+            print('  %-8s %-35s %-35s replacement: %s' % (change['Action'], change['LogicalResourceId'], change['ResourceType'], change.get('Replacement', 'N/A')))
+        updateGraph.append(node)
+
+    if(not updateGraph):
+        print('\nNothing to update; every stack already matches.')
+        return 0
+    if(not assumeYes and input('\nApply these changes? [y/N]: ').strip().lower() not in ['y', 'yes']):
+        for node in updateGraph:
+            callWithBackoff(lambda: client.delete_change_set(ChangeSetName=changeSetName, StackName=node['name']), poller.sleep)
+        print('Update cancelled; change sets deleted.')
+        return 1
+
+    #Run only the changed stacks, still in dependency order (ex. AD before FS if both changed)
+    updatedStackNames = [node['name'] for node in updateGraph]
+    for node in updateGraph:
+        node['dependsOn'] = [parent for parent in node['dependsOn'] if parent in updatedStackNames]
+        node['action'] = 'Update'
+        node['create'] = (lambda node: lambda: executeChangeSet(client, node, changeSetName))(node)
+        node.pop('eta', None)
+    runStackGraph(updateGraph, poller, raiseOnFailure=False)
+
+    failedStacks = [node['name'] for node in updateGraph if node['status'] not in STACK_BUILT_STATUSES]
+    if(failedStacks):
+        print('\nThese stacks did not update (CloudFormation rolls them back to their previous settings): %s' % (', '.join(failedStacks)))
+        return 1
+    saveCheckpoint(environment, stackGraph)
+    print('\nUpdate complete!')
+    return 0
+
+#Compare a stack's deployed parameters with the ones it would be built with now
+#Returns {parameterName : (deployedValue, newValue)} for every parameter that differs
+def getChangedParameters(client, node, poller):
+    stack = callWithBackoff(lambda: client.describe_stacks(StackName=node['name']), poller.sleep)['Stacks'][0]
+    poller.apiCalls += 1
+    deployedValues = {parameter['ParameterKey'] : parameter.get('ParameterValue') for parameter in stack.get('Parameters', [])}
+    node['stackId'] = stack['StackId']
+    changedParameters = {}
+    for parameter in node['parameters']:
+        parameterName = parameter['ParameterKey']
+        if(parameterName in SECRET_PARAMETERS or parameter.get('UsePreviousValue')):
+            continue
+        if(deployedValues.get(parameterName) != str(parameter['ParameterValue'])):
+            changedParameters[parameterName] = (deployedValues.get(parameterName), parameter['ParameterValue'])
+    return changedParameters
+
+#Create an UPDATE change set that reuses the deployed template and wait for CloudFormation to describe it
+#Returns the list of ResourceChange entries (empty if the change set turned out to change nothing)
+def createUpdateChangeSet(client, node, changeSetName, poller):
+    parameters = list(node['parameters'])
+    #Keep whichever image the servers were built from; a new image would replace every instance
+    if(node['role'] in BAKE_RECIPES):
+        parameters.append({'ParameterKey' : BAKE_RECIPES[node['role']]['imageParameter'], 'UsePreviousValue' : True})
+    callWithBackoff(lambda: client.create_change_set(
+        StackName = node['name'],
+        ChangeSetName = changeSetName,
+        ChangeSetType = 'UPDATE',
+        UsePreviousTemplate = True,
+        Parameters = parameters,
+        Capabilities = STACK_CAPABILITIES
+    ), poller.sleep)
+    while(True):
+        poller.sleep(CHANGE_SET_POLL_INTERVAL)
+        changeSet = callWithBackoff(lambda: client.describe_change_set(ChangeSetName=changeSetName, StackName=node['name']), poller.sleep)
+        if(changeSet['Status'] == 'CREATE_COMPLETE'):
+            return [change['ResourceChange'] for change in changeSet.get('Changes', [])]
+        if(changeSet['Status'] == 'FAILED'):
+            #A parameter change that no resource uses produces an empty, failed change set
+            if("didn't contain changes" in changeSet.get('StatusReason', '') or "No updates" in changeSet.get('StatusReason', '')):
+                callWithBackoff(lambda: client.delete_change_set(ChangeSetName=changeSetName, StackName=node['name']), poller.sleep)
+                return []
+            raise RuntimeError('Could not create a change set for %s: %s' % (node['name'], changeSet.get('StatusReason')))
+
+def executeChangeSet(client, node, changeSetName):
+    print('\n' + SECTION_SEPARATOR)
+    print('Updating %s...' % (node['label']))
+    client.execute_change_set(ChangeSetName=changeSetName, StackName=node['name'])
+    return {'StackId' : node['stackId']}
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Roles whose stacks must be gone before a stack of each role can be deleted, since they import its exports
+#(the reverse of the build order in createStackGraph)
+TEARDOWN_DEPENDENCIES = {
+    'network' : ['ad', 'fs', 'exchange'],
+    'ad' : ['fs', 'exchange'],
+    'fs' : [],
+    'exchange' : [],
+}
+
+#Work out which SBIT stack a describe_stacks entry is from its name (or, for pool stacks, its tags)
+#Returns (role, tenant), or None for stacks SBIT did not create and for pool stacks nobody has claimed
+def getStackOwner(stack):
+    tags = {tag['Key'] : tag['Value'] for tag in stack.get('Tags', [])}
+    if(stack['StackName'].startswith(NETWORK_POOL_NAME_FORMAT % (''))):
+        return ('network', tags.get(TENANT_TAG)) if tags.get(POOL_TAG) == 'claimed' else None
+    for role, nameFormat in STACK_NAME_FORMATS.items():
+        tenant = stack['StackName'][len(nameFormat % ('')):]
+        if(stack['StackName'].startswith(nameFormat % ('')) and isValidTenantName(tenant)):
+            return (role, tenant)
+    return None
+
+#Find the stacks to tear down with one describe_stacks listing: every stack of the given tenants (including
+#network stacks they claimed from the pool) and, with orphans, every SBIT stack in STACK_FAILED_STATUSES
+#Returns the teardown graph: one node per stack, with 'deleteAfter' listing the stack IDs that must be deleted first
+def createTeardownGraph(tenants, orphans=False, poller=None):
+    if(poller is None):
+        poller = StackPoller()
+    client = poller.client if poller.client is not None else getCloudFormationClient()
+    tenantStackNames = {}
+    for tenant in tenants:
+        for stackName in getStackNames(tenant).values():
+            tenantStackNames[stackName] = tenant
+        checkpoint = loadCheckpoint(tenant)
+        if(checkpoint is not None and checkpoint['environment'].get('networkStackName')):
+            tenantStackNames[checkpoint['environment']['networkStackName']] = tenant
+
+    teardownGraph = []
+    for page in callWithBackoff(lambda: list(client.get_paginator('describe_stacks').paginate()), poller.sleep):
+        poller.apiCalls += 1
+        for stack in page['Stacks']:
+            owner = getStackOwner(stack)
+            if(owner is None):
+                continue
+            role, tenant = owner
+            if(stack['StackName'] in tenantStackNames):
+                tenant = tenantStackNames[stack['StackName']]
+            elif(not tenant in tenants and not (orphans and stack['StackStatus'] in STACK_FAILED_STATUSES)):
+                continue
+            teardownGraph.append({
+                'name' : stack['StackName'],
+                'stackId' : stack['StackId'],
+                'stackStatus' : stack['StackStatus'],
+                'label' : '%s: %s' % (tenant, STACK_LABELS[role]),
+                'group' : tenant,
+                'role' : role,
+            })
+    for node in teardownGraph:
+        node['deleteAfter'] = [other['stackId'] for other in teardownGraph if other['group'] == node['group'] and other['role'] in TEARDOWN_DEPENDENCIES[node['role']]]
+    teardownGraph.sort(key=lambda node: (str(node['group']), node['name']))
+    return teardownGraph
+
+#Delete every stack in teardownGraph as soon as all of the stacks in its 'deleteAfter' are gone, so every
+#tenant's File Server and Exchange stacks go at once, then each AD stack, then each network stack
+#All deletions in flight are watched together by one StackPoller
+#Each node's final status is stored in node['status']; stacks that had to wait on a stack that could not
+#be deleted are marked SKIPPED
+#Returns the number of CloudFormation API calls the teardown used
+def runTeardownGraph(teardownGraph, poller=None):
+    if(poller is None):
+        poller = StackPoller()
+    client = poller.client if poller.client is not None else getCloudFormationClient()
+    nodesByStackId = {node['stackId'] : node for node in teardownGraph}
+    for node in teardownGraph:
+        node['status'] = 'PENDING'
+    wallClockOffset = time.time() - poller.clock()
+    describeCallsBefore = poller.apiCalls
+    deleteCalls = 0
+    while(True):
+        scheduleChanged = True
+        while(scheduleChanged):
+            scheduleChanged = False
+            for node in teardownGraph:
+                if(node['status'] != 'PENDING'):
+                    continue
+                blockerStatuses = [nodesByStackId[blocker]['status'] for blocker in node['deleteAfter']]
+                if(any(status in ['DELETE_FAILED', 'TIMED_OUT', 'SKIPPED'] for status in blockerStatuses)):
+                    node['status'] = 'SKIPPED'
+                    scheduleChanged = True
+                    print('%s... Skipped; a stack that uses it could not be deleted.' % (node['label']))
+                    continue
+                if(any(status != 'DELETE_COMPLETE' for status in blockerStatuses)):
+                    continue
+                #A stack already being deleted (ex. by an interrupted teardown) is only watched
+                if(node['stackStatus'] != 'DELETE_IN_PROGRESS'):
+                    callWithBackoff(lambda: client.delete_stack(StackName=node['stackId']), poller.sleep)
+                    deleteCalls += 1
+                node['status'] = 'DELETE_IN_PROGRESS'
+                node['startTime'] = poller.clock()
+                print('Deleting %s (%s)...' % (node['label'], node['name']))
+
+        deadlines = {node['stackId'] : node['startTime'] + DEFAULT_STACK_TIMEOUT for node in teardownGraph if node['status'] == 'DELETE_IN_PROGRESS'}
+        if(not deadlines):
+            break
+        for stackId, stackStatus in poller.waitForAnyDeletion(deadlines):
+            node = nodesByStackId[stackId]
+            node['status'] = stackStatus
+            node['deleteSeconds'] = poller.clock() - node['startTime']
+            buildMetrics.addSpan('delete', wallClockOffset + node['startTime'], node['deleteSeconds'], tenant=node['group'], stack=node['name'], role=node['role'], status=stackStatus)
+            if(stackStatus == 'DELETE_COMPLETE'):
+                print('%s... Deleted!' % (node['label']))
+            else:
+                print('%s... Delete Failed! (status: %s)' % (node['label'], stackStatus))
+
+    describeCalls = poller.apiCalls - describeCallsBefore
+    apiCalls = deleteCalls + describeCalls
+    print('CloudFormation API calls used: %d (%d delete, %d describe, %d throttled)' % (apiCalls, deleteCalls, describeCalls, poller.throttles))
+    return apiCalls
+
+#Tear down the environments of the given tenants and, with orphans, failed SBIT stacks of any tenant
+#The stacks are listed and confirmed before anything is deleted; tenants whose stacks are all gone have
+#their checkpoints removed. Returns the process exit code
+def runDestroy(tenants, orphans=False, assumeYes=False, poller=None):
+    if(poller is None):
+        poller = StackPoller()
+    print(SECTION_SEPARATOR)
+    teardownGraph = createTeardownGraph(tenants, orphans, poller)
+    if(teardownGraph):
+        print('These %d stacks will be deleted:' % (len(teardownGraph)))
+        for node in teardownGraph:
+            print('  %-40s %-45s %s' % (node['label'], node['name'], node['stackStatus']))
+        if(not assumeYes and input('\nDelete them? This cannot be undone. [y/N]: ').strip().lower() not in ['y', 'yes']):
+            print('Nothing was deleted.')
+            return 1
+        startTime = poller.clock()
+        runTeardownGraph(teardownGraph, poller)
+        print('\n%d of %d stacks deleted in %s' % (len([node for node in teardownGraph if node['status'] == 'DELETE_COMPLETE']), len(teardownGraph), formatDuration(poller.clock() - startTime)))
+    else:
+        print('No stacks to delete.')
+
+    for tenant in tenants:
+        if(all(node['status'] == 'DELETE_COMPLETE' for node in teardownGraph if node['group'] == tenant)):
+            try:
+                os.remove(getCheckpointPath(tenant))
+            except FileNotFoundError:
+                pass
+    failedStacks = [node['name'] for node in teardownGraph if node['status'] != 'DELETE_COMPLETE']
+    if(failedStacks):
+        print('These stacks were not deleted; fix what is holding them (see their events) and run destroy again: %s' % (', '.join(failedStacks)))
+        return 1
+    return 0
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Columns of a user import CSV, the validator for each, and the message shown when a value is invalid
+#password may hold "env:VARIABLE_NAME" like manifest passwords; groups is a semicolon-separated list;
+#a blank mailbox column means yes
+USER_FIELDS = [
+    ('samAccountName', lambda value: re.match(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,19}$', value) is not None, 'Invalid account name. Account names must be 1 to 20 letters, numbers, periods, hyphens, or underscores, starting with a letter or number.'),
+    ('firstName', lambda value: 0 < len(value) <= 64 and value.isprintable(), 'Invalid first name. Names must be 1 to 64 printable characters.'),
+    ('lastName', lambda value: 0 < len(value) <= 64 and value.isprintable(), 'Invalid last name. Names must be 1 to 64 printable characters.'),
+    ('password', isValidPassword, INVALID_PASSWORD_MESSAGE),
+    ('department', lambda value: len(value) <= 64 and value.isprintable(), 'Invalid department. Departments can be at most 64 printable characters.'),
+    ('title', lambda value: len(value) <= 64 and value.isprintable(), 'Invalid title. Titles can be at most 64 printable characters.'),
+    ('groups', lambda value: all(re.match(r'^[A-Za-z0-9][A-Za-z0-9 ._-]{0,63}$', group.strip()) for group in value.split(';') if group.strip()), 'Invalid groups. Separate group names with semicolons (;); names can contain letters, numbers, spaces, periods, hyphens, and underscores.'),
+    ('mailbox', lambda value: value.lower() in ['', 'yes', 'no', 'true', 'false', 'y', 'n'], 'Invalid mailbox. Enter yes or no.'),
+]
+DEFAULT_USER_OU = 'AWS OU'
+DEFAULT_MAILBOX_DATABASE = 'DB1'
+#Users in each PowerShell batch; every batch is one Run Command, so one PowerShell start and module load
+#is shared by the whole batch instead of paid for every user
+PROVISIONING_CHUNK_SIZE = 100
+#Run Command rejects large requests; batches whose script would be bigger than this are split in half
+MAX_PROVISIONING_SCRIPT_BYTES = 48*1024
+#Initial passwords reach the domain controller in a SecureString parameter per batch, never in the command
+#itself (Run Command keeps its parameters in the command history); the AD template lets DC1 read parameters
+#under /sbit/<AD stack name>/, and batches whose passwords don't fit a standard parameter are split in half
+PASSWORD_PARAMETER_FORMAT = '/sbit/%s/users/%s'
+MAX_PASSWORD_PARAMETER_BYTES = 4096
+#Batches running at once on each server; the SSM agent runs up to five commands at a time
+DEFAULT_PROVISIONING_CONCURRENCY = 4
+PROVISIONING_MAX_ATTEMPTS = 3
+PROVISIONING_POLL_INTERVAL = 5
+PROVISIONING_COMMAND_TIMEOUT = 60*60
+PROVISIONING_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sbit', 'provisioning')
+#Each stage runs on one server of the tenant's environment: (stack role, logical ID of the instance)
+#The logical IDs are also the servers' computer names, since builds keep the templates' default NetBIOS names
+#Run Command runs scripts as SYSTEM, which on a domain controller may create users, and which on the
+#Exchange server may mail-enable them through the Exchange Trusted Subsystem group
+PROVISIONING_STAGES = {
+    'users' : ('ad', 'DC1'),
+    'mailboxes' : ('exchange', 'EXCH1'),
+}
+#Lines provisioning scripts write so results can be read back from the command output
+PROVISIONING_RESULT_PREFIX = 'SBIT-RESULT'
+PROVISIONING_FAILURE_PREFIX = 'SBIT-FAILED'
+
+#Read and check a user import CSV with the USER_FIELDS validators
+#Returns (users, errors); users is only usable if errors is empty
+def loadUserCsv(csvPath):
+    with open(csvPath, newline='') as csvFile:
+        rows = list(csv.DictReader(csvFile))
+    users = []
+    errors = []
+    seenAccounts = set()
+    for rowNumber, row in enumerate(rows, start=1):
+        user = {}
+        for field, validator, message in USER_FIELDS:
+            value = row.get(field)
+            value = '' if value is None else str(value).strip()
+            if(value.startswith(ENVIRONMENT_VALUE_PREFIX)):
+                value = os.environ.get(value[len(ENVIRONMENT_VALUE_PREFIX):], '')
+            if(not validator(value)):
+                errors.append('Row %d (%s), %s: %s' % (rowNumber, row.get('samAccountName') or 'no account name', field, message))
+            user[field] = value
+        if(user['samAccountName'].lower() in seenAccounts):
+            errors.append('Row %d: account %s appears more than once; account names must be unique.' % (rowNumber, user['samAccountName']))
+        seenAccounts.add(user['samAccountName'].lower())
+        user['groups'] = [group.strip() for group in user['groups'].split(';') if group.strip()]
+        user['mailbox'] = user['mailbox'].lower() not in ['no', 'false', 'n']
+        users.append(user)
+    return users, errors
+
+#Quote a value as a PowerShell single-quoted string
+#Run Command saves scripts without a byte order mark, which Windows PowerShell reads as the ANSI code page, so
+#values with other than ASCII characters (including curly quotes, which PowerShell treats as single quotes)
+#are written as \u escapes and decoded when the script runs
+def quotePowerShell(value):
+    value = str(value)
+    if(value.isascii()):
+        return "'" + value.replace("'", "''") + "'"
+    escapedCharacters = []
+    for character in value.replace('\\', '\\\\'):
+        if(character.isascii()):
+            escapedCharacters.append(character)
+        else:
+            encoded = character.encode('utf-16-be')
+            escapedCharacters += ['\\u%02x%02x' % (encoded[index], encoded[index + 1]) for index in range(0, len(encoded), 2)]
+    return '([regex]::Unescape(%s))' % (quotePowerShell(''.join(escapedCharacters)))
+
+#PowerShell that creates each user in the tenant's OU (skipping users that already exist, so a batch can be
+#retried) and adds them to their groups
+#Initial passwords are read from the passwordParameter SecureString (see renderPasswordParameter) when the
+#script runs; every account must still change its password at first logon
+def renderUserScript(users, domainName, passwordParameter, organizationalUnit=DEFAULT_USER_OU):
+    domainPath = ','.join('DC=' + part for part in domainName.split('.'))
+    lines = [
+        "$ErrorActionPreference = 'Stop'",
+        'Import-Module ActiveDirectory',
+        '$path = %s' % (quotePowerShell('OU=%s,%s' % (organizationalUnit, domainPath))),
+        '$passwords = (Get-SSMParameter -Name %s -WithDecryption $true).Value | ConvertFrom-Json' % (quotePowerShell(passwordParameter)),
+        '$users = @(',
+    ]
+    for user in users:
+        lines.append('    @{Sam=%s; First=%s; Last=%s; Department=%s; Title=%s; Groups=@(%s)}' % (
+            quotePowerShell(user['samAccountName']), quotePowerShell(user['firstName']), quotePowerShell(user['lastName']),
+            quotePowerShell(user['department']), quotePowerShell(user['title']),
+            ','.join(quotePowerShell(group) for group in user['groups'])))
+    lines += [
+        ')',
+        '$created = 0; $existing = 0; $failed = 0',
+        'foreach($user in $users) {',
+        '    try {',
+        "        if(Get-ADUser -Filter \"SamAccountName -eq '$($user.Sam)'\") {",
+        '            $existing++',
+        '        } else {',
+        #Accounts are named after their account name, since two users can share a display name
+        '            $attributes = @{Name=$user.Sam; SamAccountName=$user.Sam; UserPrincipalName=($user.Sam + %s); GivenName=$user.First; Surname=$user.Last; DisplayName=($user.First + \' \' + $user.Last); Path=$path; AccountPassword=(ConvertTo-SecureString $passwords.($user.Sam) -AsPlainText -Force); ChangePasswordAtLogon=$true; Enabled=$true}' % (quotePowerShell('@' + domainName)),
+        "            if($user.Department) { $attributes['Department'] = $user.Department }",
+        "            if($user.Title) { $attributes['Title'] = $user.Title }",
+        '            New-ADUser @attributes',
+        '            $created++',
+        '        }',
+        '        foreach($group in $user.Groups) { Add-ADGroupMember -Identity $group -Members $user.Sam }',
+        '    } catch {',
+        '        $failed++',
+        "        Write-Output ('%s {0}: {1}' -f $user.Sam, $_.Exception.Message)" % (PROVISIONING_FAILURE_PREFIX),
+        '    }',
+        '}',
+        "Write-Output ('%s created={0} existing={1} failed={2}' -f $created, $existing, $failed)" % (PROVISIONING_RESULT_PREFIX),
+        'if($failed) { exit 1 }',
+    ]
+    return '\n'.join(lines) + '\n'
+
+#Value of a batch's password parameter: each user's initial password by account name, as JSON
+def renderPasswordParameter(users):
+    return json.dumps({user['samAccountName'] : user['password'] for user in users}, separators=(',', ':'))
+
+#PowerShell that enables a mailbox for each user on the Exchange server (skipping users that already have one)
+#Mailboxes are created through domainController, the server the users were created on, so they are found
+#before Active Directory replication reaches the other domain controllers
+def renderMailboxScript(users, database=DEFAULT_MAILBOX_DATABASE, domainController=None):
+    lines = [
+        "$ErrorActionPreference = 'Stop'",
+        'Add-PSSnapin Microsoft.Exchange.Management.PowerShell.SnapIn',
+        '$database = %s' % (quotePowerShell(database)),
+        '$users = @(',
+    ]
+    for user in users:
+        lines.append('    @{Sam=%s}' % (quotePowerShell(user['samAccountName'])))
+    lines += [
+        ')',
+        '$created = 0; $existing = 0; $failed = 0',
+        'foreach($user in $users) {',
+        '    try {',
+        '        if(Get-Mailbox -Identity $user.Sam -ErrorAction SilentlyContinue) {',
+        '            $existing++',
+        '        } else {',
+        '            Enable-Mailbox -Identity $user.Sam -Database $database%s | Out-Null' % ('' if domainController is None else ' -DomainController %s' % (quotePowerShell(domainController))),
+        '            $created++',
+        '        }',
+        '    } catch {',
+        '        $failed++',
+        "        Write-Output ('%s {0}: {1}' -f $user.Sam, $_.Exception.Message)" % (PROVISIONING_FAILURE_PREFIX),
+        '    }',
+        '}',
+        "Write-Output ('%s created={0} existing={1} failed={2}' -f $created, $existing, $failed)" % (PROVISIONING_RESULT_PREFIX),
+        'if($failed) { exit 1 }',
+    ]
+    return '\n'.join(lines) + '\n'
+
+#Split users into batches of at most chunkSize, halving any batch whose script is too large for Run Command or
+#whose passwords are too large for a parameter
+#Each batch is identified by a hash of its users' account names, so saved progress can be matched to it, and
+#has its own password parameter under the tenant's AD stack
+def chunkUsers(users, chunkSize=PROVISIONING_CHUNK_SIZE, domainName='example.com', tenant=DEFAULT_TENANT):
+    pending = [users[start:start + chunkSize] for start in range(0, len(users), chunkSize)]
+    chunks = []
+    while(pending):
+        batchUsers = pending.pop(0)
+        chunkId = hashlib.sha256('\n'.join(user['samAccountName'].lower() for user in batchUsers).encode('utf-8')).hexdigest()[:12]
+        passwordParameter = PASSWORD_PARAMETER_FORMAT % (getStackNames(tenant)['ad'], chunkId)
+        if(len(batchUsers) > 1 and (len(renderUserScript(batchUsers, domainName, passwordParameter).encode('utf-8')) > MAX_PROVISIONING_SCRIPT_BYTES
+                                    or len(renderPasswordParameter(batchUsers).encode('utf-8')) > MAX_PASSWORD_PARAMETER_BYTES)):
+            middle = len(batchUsers) // 2
+            pending[0:0] = [batchUsers[:middle], batchUsers[middle:]]
+            continue
+        chunks.append({'id' : chunkId, 'users' : batchUsers, 'passwordParameter' : passwordParameter})
+    return chunks
+
+#Read the counts and failed users a provisioning script wrote to its output
+#Returns (counts, failures); counts is None if the script never got as far as its result line
+def parseProvisioningOutput(output):
+    counts = None
+    failures = {}
+    for line in output.splitlines():
+        if(line.startswith(PROVISIONING_RESULT_PREFIX + ' ')):
+            counts = {name : int(value) for name, value in re.findall(r'(\w+)=(\d+)', line)}
+        elif(line.startswith(PROVISIONING_FAILURE_PREFIX + ' ')):
+            samAccountName, separator, message = line[len(PROVISIONING_FAILURE_PREFIX) + 1:].partition(': ')
+            failures[samAccountName] = message.strip()
+    return counts, failures
+
+#Delete a batch's password parameter once its users exist (or have failed for good)
+def deletePasswordParameter(ssm, passwordParameter, sleep=time.sleep):
+    try:
+        callWithBackoff(lambda: ssm.delete_parameter(Name=passwordParameter), sleep)
+    except getClientError() as error:
+        if(error.response['Error']['Code'] != 'ParameterNotFound'):
+            raise
+
+def getProvisioningStatePath(tenant):
+    return os.path.join(PROVISIONING_DIRECTORY, '%s.json' % (tenant))
+
+#Find the instance each stage runs on from the tenant's stacks
+def getProvisioningInstances(tenant, client=None):
+    if(client is None):
+        client = getCloudFormationClient()
+    stackNames = getStackNames(tenant)
+    instanceIds = {}
+    for stage, (stackRole, logicalId) in PROVISIONING_STAGES.items():
+        resource = callWithBackoff(lambda: client.describe_stack_resource(StackName=stackNames[stackRole], LogicalResourceId=logicalId))
+        instanceIds[stage] = resource['StackResourceDetail']['PhysicalResourceId']
+    return instanceIds
+
+#Create the users in users (from loadUserCsv) in the tenant's domain and enable their mailboxes, in batches
+#sent to the tenant's servers with SSM Run Command, at most maxConcurrent batches per server at a time
+#Each batch first creates its users on the domain controller, then enables mailboxes for those that want
+#one on the Exchange server; failed batches are retried (for the users that failed) up to
+#PROVISIONING_MAX_ATTEMPTS times
+#Progress is saved after every batch so that, with resume, batches finished by an earlier run are skipped
+#Returns the process exit code
+def runProvisioning(tenant, users, domainName, instanceIds, ssm=None, organizationalUnit=DEFAULT_USER_OU, database=DEFAULT_MAILBOX_DATABASE,
+                    chunkSize=PROVISIONING_CHUNK_SIZE, maxConcurrent=DEFAULT_PROVISIONING_CONCURRENCY, resume=False, statePath=None, clock=time.monotonic, sleep=time.sleep):
+    if(ssm is None):
+        ssm = getSsmClient()
+    if(statePath is None):
+        statePath = getProvisioningStatePath(tenant)
+    print(SECTION_SEPARATOR)
+    chunks = chunkUsers(users, chunkSize, domainName, tenant)
+    chunksById = {chunk['id'] : chunk for chunk in chunks}
+    usersByAccount = {user['samAccountName'] : user for user in users}
+    state = {}
+    if(resume):
+        try:
+            with open(statePath) as stateFile:
+                state = json.load(stateFile)
+        except FileNotFoundError:
+            pass
+    def saveState():
+        os.makedirs(os.path.dirname(statePath), exist_ok=True)
+        with open(statePath + '.tmp', 'w') as stateFile:
+            stateFile.write(json.dumps(state))
+        os.replace(statePath + '.tmp', statePath)
+
+    #Servers that are not registered with Systems Manager would leave every command pending until it times out
+    managedIds = set()
+    for page in callWithBackoff(lambda: list(ssm.get_paginator('describe_instance_information').paginate(Filters=[{'Key' : 'InstanceIds', 'Values' : sorted(set(instanceIds.values()))}])), sleep):
+        managedIds.update(instance['InstanceId'] for instance in page['InstanceInformationList'] if instance.get('PingStatus') == 'Online')
+    unmanagedIds = sorted(set(instanceIds.values()) - managedIds)
+    if(unmanagedIds):
+        print('These servers are not online in Systems Manager: %s' % (', '.join(unmanagedIds)))
+        print('The AD and Exchange stacks give them an instance profile for Systems Manager, and they register a few minutes after starting.')
+        print('Servers built before the stacks had one need an instance profile with the AmazonSSMManagedInstanceCore policy attached; then try again.')
+        return 1
+
+    #Batches waiting for a slot on each stage's server, in order
+    queues = {stage : [] for stage in PROVISIONING_STAGES}
+    for chunkNumber, chunk in enumerate(chunks, start=1):
+        chunkState = state.setdefault(chunk['id'], {'number' : chunkNumber, 'stage' : 'users', 'attempts' : 0, 'pending' : [user['samAccountName'] for user in chunk['users']], 'created' : {}, 'existing' : {}, 'failed' : {}})
+        chunkState['number'] = chunkNumber
+        if(chunkState['stage'] == 'done'):
+            continue
+        if(chunkState['stage'] == 'failed'):
+            chunkState.update(stage='users', attempts=0, pending=[user['samAccountName'] for user in chunk['users']], created={}, existing={}, failed={})
+        queues[chunkState['stage']].append(chunk['id'])
+    skippedCount = len(chunks) - sum(len(queue) for queue in queues.values())
+    saveState()
+    print('Provisioning %d users for %s in %d batches of up to %d%s...' % (len(users), tenant, len(chunks), chunkSize, ' (%d already done)' % (skippedCount) if skippedCount else ''))
+
+    wallClockOffset = time.time() - clock()
+    startTime = clock()
+    apiCalls = 0
+    inFlight = {}
+    while(any(queues.values()) or inFlight):
+        #Start queued batches on every server with a free slot
+        for stage, queue in queues.items():
+            runningCount = len([task for task in inFlight.values() if task['stage'] == stage])
+            while(queue and runningCount < maxConcurrent):
+                chunkId = queue.pop(0)
+                chunkState = state[chunkId]
+                runningCount += 1
+                stageUsers = [usersByAccount[samAccountName] for samAccountName in chunkState['pending']]
+                if(stage == 'users'):
+                    #Written again for every attempt, so a resumed run never relies on a parameter an earlier run deleted
+                    chunk = chunksById[chunkId]
+                    callWithBackoff(lambda: ssm.put_parameter(Name=chunk['passwordParameter'], Value=renderPasswordParameter(chunk['users']), Type='SecureString', Overwrite=True), sleep)
+                    apiCalls += 1
+                    script = renderUserScript(stageUsers, domainName, chunk['passwordParameter'], organizationalUnit)
+                else:
+                    script = renderMailboxScript(stageUsers, database, '%s.%s' % (PROVISIONING_STAGES['users'][1], domainName))
+                command = callWithBackoff(lambda: ssm.send_command(
+                    InstanceIds=[instanceIds[stage]],
+                    DocumentName='AWS-RunPowerShellScript',
+                    Comment='SBIT %s %s batch %d' % (tenant, stage, chunkState['number']),
+                    TimeoutSeconds=PROVISIONING_COMMAND_TIMEOUT,
+                    Parameters={'commands' : [script], 'executionTimeout' : [str(PROVISIONING_COMMAND_TIMEOUT)]},
+                ), sleep)['Command']
+                apiCalls += 1
+                chunkState['attempts'] += 1
+                inFlight[command['CommandId']] = {'chunkId' : chunkId, 'stage' : stage, 'startTime' : clock()}
+
+        sleep(PROVISIONING_POLL_INTERVAL)
+        commandCount = len(inFlight)
+        for commandId, task in list(inFlight.items()):
+            chunkState = state[task['chunkId']]
+            try:
+                invocation = callWithBackoff(lambda: ssm.get_command_invocation(CommandId=commandId, InstanceId=instanceIds[task['stage']]), sleep)
+            except getClientError() as error:
+                #A command that was just sent may not have reached the instance yet
+                if(error.response['Error']['Code'] == 'InvocationDoesNotExist'):
+                    continue
+                raise
+            finally:
+                apiCalls += 1
+            if(invocation['Status'] in ['Pending', 'InProgress', 'Delayed']):
+                continue
+            del inFlight[commandId]
+            counts, failures = parseProvisioningOutput(invocation.get('StandardOutputContent', ''))
+            seconds = clock() - task['startTime']
+            buildMetrics.addSpan('provision', wallClockOffset + task['startTime'], seconds, tenant=tenant, role=task['stage'], batch=chunkState['number'], status=invocation['Status'])
+            if(counts is None):
+                #The script did not finish (ex. it timed out or the server restarted), so every user is retried
+                failures = {samAccountName : invocation.get('StatusDetails', invocation['Status']) for samAccountName in chunkState['pending']}
+            else:
+                chunkState['created'][task['stage']] = chunkState['created'].get(task['stage'], 0) + counts.get('created', 0)
+                chunkState['existing'][task['stage']] = chunkState['existing'].get(task['stage'], 0) + counts.get('existing', 0)
+            if(failures and chunkState['attempts'] < PROVISIONING_MAX_ATTEMPTS):
+                print('Batch %d (%s): %d failed, retrying them (attempt %d of %d)' % (chunkState['number'], task['stage'], len(failures), chunkState['attempts'] + 1, PROVISIONING_MAX_ATTEMPTS))
+                chunkState['pending'] = [samAccountName for samAccountName in chunkState['pending'] if samAccountName in failures]
+                queues[task['stage']].append(task['chunkId'])
+                continue
+            chunkState['failed'].update(failures)
+            chunk = chunksById[task['chunkId']]
+            if(task['stage'] == 'users'):
+                deletePasswordParameter(ssm, chunk['passwordParameter'], sleep)
+                apiCalls += 1
+                print('Batch %d: %d users ready%s' % (chunkState['number'], len(chunk['users']) - len(chunkState['failed']), ', %d failed' % (len(chunkState['failed'])) if chunkState['failed'] else ''))
+                mailboxUsers = [user['samAccountName'] for user in chunk['users'] if user['mailbox'] and user['samAccountName'] not in chunkState['failed']]
+                if(mailboxUsers):
+                    chunkState.update(stage='mailboxes', attempts=0, pending=mailboxUsers, mailboxCount=len(mailboxUsers))
+                    queues['mailboxes'].append(task['chunkId'])
+                    continue
+            else:
+                print('Batch %d: %d mailboxes ready%s' % (chunkState['number'], chunkState['mailboxCount'] - len(failures), ', %d failed' % (len(failures)) if failures else ''))
+            chunkState['stage'] = 'failed' if chunkState['failed'] else 'done'
+        if(len(inFlight) < commandCount):
+            saveState()
+
+    failedUsers = {samAccountName : message for chunkState in state.values() for samAccountName, message in chunkState['failed'].items()}
+    print('\n%d of %d users provisioned in %s (%d created, %d already existed; %d mailboxes created), %d Systems Manager API calls' % (
+        len(users) - len(failedUsers), len(users), formatDuration(clock() - startTime),
+        sum(chunkState['created'].get('users', 0) for chunkState in state.values()), sum(chunkState['existing'].get('users', 0) for chunkState in state.values()),
+        sum(chunkState['created'].get('mailboxes', 0) for chunkState in state.values()), apiCalls))
+    if(failedUsers):
+        print('These users could not be provisioned; fix them and run provision again with --resume:')
+        for samAccountName, message in sorted(failedUsers.items()):
+            print('  %-20s %s' % (samAccountName, message))
+        return 1
+    return 0
+
+#Provision every user in a CSV for a tenant: check the file, find the tenant's domain (from its checkpoint) and
+#servers (from its stacks) unless they are given, then run runProvisioning; returns the process exit code
+#With dryRun only the file is checked and the batches it would be sent in are listed
+def provisionUsers(csvPath, tenant=DEFAULT_TENANT, domainName=None, instanceIds=None, organizationalUnit=DEFAULT_USER_OU, database=DEFAULT_MAILBOX_DATABASE,
+                   chunkSize=PROVISIONING_CHUNK_SIZE, maxConcurrent=DEFAULT_PROVISIONING_CONCURRENCY, dryRun=False, resume=False):
+    print(SECTION_SEPARATOR)
+    print('SBIT user provisioning: %s' % (csvPath))
+    users, errors = loadUserCsv(csvPath)
+    if(domainName is None):
+        checkpoint = loadCheckpoint(tenant)
+        if(checkpoint is None):
+            errors.append('No build of tenant %s was found on this computer; give its domain with --domain.' % (tenant))
+        else:
+            domainName = checkpoint['environment']['domainName']
+    if(domainName is not None and not isValidDomainName(domainName)):
+        errors.append('Domain %s: %s' % (domainName, INVALID_DOMAIN_NAME_MESSAGE))
+    if(errors):
+        print('\nThe file has %d problem%s; no users were provisioned:' % (len(errors), '' if len(errors) == 1 else 's'))
+        for error in errors:
+            print('  ' + error)
+        return 1
+    chunks = chunkUsers(users, chunkSize, domainName, tenant)
+    print('%d users validated for %s; %d batches, %d mailboxes.' % (len(users), domainName, len(chunks), len([user for user in users if user['mailbox']])))
+    if(dryRun):
+        for chunkNumber, chunk in enumerate(chunks, start=1):
+            print('  Batch %-4d %4d users (%s to %s), %5.1f KB script' % (chunkNumber, len(chunk['users']), chunk['users'][0]['samAccountName'], chunk['users'][-1]['samAccountName'], len(renderUserScript(chunk['users'], domainName, chunk['passwordParameter'], organizationalUnit).encode('utf-8')) / 1024))
+        return 0
+    instanceIds = dict(getProvisioningInstances(tenant), **{stage : instanceId for stage, instanceId in (instanceIds or {}).items() if instanceId})
+    return runProvisioning(tenant, users, domainName, instanceIds, organizationalUnit=organizationalUnit, database=database, chunkSize=chunkSize, maxConcurrent=maxConcurrent, resume=resume)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#What gets pre-installed on each role's golden AMI, in PowerShell
+#install runs on the stock image; finish runs after the restart that install ends with, just before sysprep
+#bakedFiles are cfn-init downloads already on the image, so the stack's template no longer fetches them
+#bakedCommands are the template's cfn-init commands that install what the image already has; they are dropped too
+BAKE_RECIPES = {
+    'ad' : {
+        'imageParameter' : 'DCImage',
+        'install' : ['Install-WindowsFeature AD-Domain-Services, rsat-adds -IncludeAllSubFeature'],
+        'finish' : [],
+        'bakedFiles' : [],
+        'bakedCommands' : ['a-install-Domain-Services', 'a-install-domain-services'],
+    },
+    'fs' : {
+        'imageParameter' : 'FSImage',
+        'install' : [
+            'Install-WindowsFeature FS-Resource-Manager -IncludeManagementTools',
+            'Install-WindowsFeature FS-DFS-Namespace,FS-DFS-Replication,FS-FileServer,RSAT-DFS-Mgmt-Con -IncludeAllSubFeature',
+        ],
+        'finish' : [],
+        'bakedFiles' : [],
+        'bakedCommands' : ['a-install-fsrm', 'a-install-dfs'],
+    },
+    'exchange' : {
+        'imageParameter' : 'ExchImage',
+        'install' : [
+            'Install-WindowsFeature NET-Framework-45-Features, RPC-over-HTTP-proxy, RSAT-Clustering, RSAT-Clustering-CmdInterface, '
+            'RSAT-Clustering-Mgmt, RSAT-Clustering-PowerShell, Web-Mgmt-Console, WAS-Process-Model, Web-Asp-Net45, Web-Basic-Auth, '
+            'Web-Client-Auth, Web-Digest-Auth, Web-Dir-Browsing, Web-Dyn-Compression, Web-Http-Errors, Web-Http-Logging, '
+            'Web-Http-Redirect, Web-Http-Tracing, Web-ISAPI-Ext, Web-ISAPI-Filter, Web-Lgcy-Mgmt-Console, Web-Metabase, '
+            'Web-Mgmt-Service, Web-Net-Ext45, Web-Request-Monitor, Web-Server, Web-Stat-Compression, Web-Static-Content, '
+            'Web-Windows-Auth, Web-WMI, Windows-Identity-Foundation, RSAT-ADDS',
+        ],
+        'finish' : ['Start-Process c:\\cfn\\downloads\\UcmaRuntimeSetup.exe -ArgumentList "/passive /norestart" -Wait'],
+        'bakedFiles' : ['c:\\cfn\\downloads\\UcmaRuntimeSetup.exe', 'c:\\cfn\\downloads\\ExchangeServer2016-x64-cu8.iso'],
+        #The prerequisites end with a restart, so dropping them also saves a reboot
+        'bakedCommands' : ['a-install-prereqs', 'b-install-ucma-runtime'],
+    },
+}
+
+#cfn-init file definitions for every instance in a template, as (path, definition) pairs
+def getTemplateFiles(template):
+    for resource in template['Resources'].values():
+        initConfig = resource.get('Metadata', {}).get('AWS::CloudFormation::Init', {})
+        for configName, config in initConfig.items():
+            if(configName != 'configSets'):
+                yield from config.get('files', {}).items()
+
+#UserData that bakes a role's image: install, restart, finish, then sysprep (which shuts the instance down)
+#Downloads are taken from the template itself so the image holds exactly the files the stack would fetch
+def getBakeScript(stackRole):
+    recipe = BAKE_RECIPES[stackRole]
+    fileSources = {path : definition['source'] for path, definition in getTemplateFiles(getParsedTemplate(stackRole)[1]) if 'source' in definition}
+    install = ['New-Item -ItemType Directory -Path c:\\cfn\\downloads -Force | Out-Null']
+    for path in recipe['bakedFiles']:
+        install.append("Invoke-WebRequest -Uri '%s' -OutFile '%s' -UseBasicParsing" % (fileSources[path], path))
+    install += recipe['install']
+    lines = ['<powershell>', '$ProgressPreference = "SilentlyContinue"', 'if(-not (Test-Path c:\\sbit-bake\\installed)){']
+    lines += ['    ' + command for command in install + ['New-Item -ItemType File -Path c:\\sbit-bake\\installed -Force | Out-Null', 'Restart-Computer -Force']]
+    lines += ['}', 'else {']
+    lines += ['    ' + command for command in recipe['finish'] + [
+        'Remove-Item -Path c:\\sbit-bake -Recurse -Force',
+        '& C:\\ProgramData\\Amazon\\EC2-Windows\\Launch\\Scripts\\InitializeInstance.ps1 -Schedule',
+        '& C:\\ProgramData\\Amazon\\EC2-Windows\\Launch\\Scripts\\SysprepInstance.ps1',
+    ]]
+    lines += ['}', '</powershell>', '<persist>true</persist>']
+    return '\n'.join(lines)
+
+#A baked image is only reused while its stock image and recipe are unchanged
+#Returns (sourceImage, version) where version is a short hash of both
+def getBakeVersion(stackRole):
+    sourceImage = getParsedTemplate(stackRole)[1]['Parameters'][BAKE_RECIPES[stackRole]['imageParameter']]['Default']
+    return sourceImage, hashlib.sha256((sourceImage + '\n' + getBakeScript(stackRole)).encode('utf-8')).hexdigest()[:12]
+
+def loadAmiCatalog(catalogPath=AMI_CATALOG_PATH):
+    try:
+        with open(catalogPath) as catalogFile:
+            return json.load(catalogFile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def saveAmiCatalog(catalog, catalogPath=AMI_CATALOG_PATH):
+    os.makedirs(os.path.dirname(catalogPath), exist_ok=True)
+    with open(catalogPath + '.tmp', 'w') as catalogFile:
+        json.dump(catalog, catalogFile, indent=2, sort_keys=True)
+    os.replace(catalogPath + '.tmp', catalogPath)
+
+#Baked image IDs for the current recipe versions in a region, as {role : imageId}
+def getBakedImages(region, catalogPath=AMI_CATALOG_PATH):
+    regionCatalog = loadAmiCatalog(catalogPath).get(region, {})
+    bakedImages = {}
+    for stackRole in BAKE_RECIPES:
+        entry = regionCatalog.get(stackRole, {}).get(getBakeVersion(stackRole)[1])
+        if(entry is not None):
+            bakedImages[stackRole] = entry['imageId']
+    return bakedImages
+
+#Build stacks from baked images where the catalog has one for this region
+#Stacks are given a template without the downloads and install commands their image already covers, and
+#their build times are kept apart from stock builds (see BAKED_TIMING_SUFFIX) so ETAs reflect the shorter build
+def applyBakedImages(stackGraph, region=None, catalogPath=AMI_CATALOG_PATH):
+    if(not os.path.exists(catalogPath)):
+        return {}
+    if(region is None):
+        region = getAwsSession().region_name
+    bakedImages = getBakedImages(region, catalogPath)
+    for node in stackGraph:
+        if(not node.get('role') in bakedImages):
+            continue
+        node['parameters'].append({'ParameterKey' : BAKE_RECIPES[node['role']]['imageParameter'], 'ParameterValue' : bakedImages[node['role']]})
+        node['template'] = renderBakedTemplate(node['role'], node.get('serverCount'))
+        instanceType, volumeSize, serverCount = node['timingKey']
+        node['timingKey'] = (instanceType + BAKED_TIMING_SUFFIX, volumeSize, serverCount)
+    return bakedImages
+
+#The template a stack uses with a baked image: the cfn-init downloads the image already holds, and the
+#commands that would install its prerequisites again, are dropped
+def renderBakedTemplate(stackRole, serverCount=None):
+    if(stackRole in SERVER_PREFIXES):
+        template = json.loads(json.dumps(renderServerTemplate(stackRole, serverCount)))
+    else:
+        template = json.loads(json.dumps(getParsedTemplate(stackRole)[1]))
+    recipe = BAKE_RECIPES[stackRole]
+    for resource in template['Resources'].values():
+        for configName, config in resource.get('Metadata', {}).get('AWS::CloudFormation::Init', {}).items():
+            if(configName != 'configSets'):
+                for path in recipe['bakedFiles']:
+                    config.get('files', {}).pop(path, None)
+                for commandName in recipe['bakedCommands']:
+                    config.get('commands', {}).pop(commandName, None)
+    return template
+
+#Bake a golden AMI for each role: launch a builder from the stock image, let it install the role's
+#prerequisites and sysprep itself, image it, then terminate it
+#All builders run at once and are watched with one describe call per poll, like stacks are
+#Images already baked for the current recipe version are reused unless force is set
+#Returns {role : imageId} for every role that has an image
+def bakeImages(stackRoles, ec2=None, catalogPath=AMI_CATALOG_PATH, subnetId=None, instanceType=BAKE_INSTANCE_TYPE, force=False, clock=time.monotonic, sleep=time.sleep):
+    if(ec2 is None):
+        ec2 = getEc2Client()
+    region = ec2.meta.region_name
+    catalog = loadAmiCatalog(catalogPath)
+    bakedImages = {}
+    builders = {}
+    #Builders are terminated however baking ends (ex. a timeout, an AWS error, or Ctrl+C), so none are left running
+    try:
+        for stackRole in stackRoles:
+            sourceImage, version = getBakeVersion(stackRole)
+            entry = catalog.get(region, {}).get(stackRole, {}).get(version)
+            if(entry is not None and not force):
+                print('%s: using %s (recipe %s, baked %s)' % (stackRole, entry['imageId'], version, entry['bakedAt']))
+                bakedImages[stackRole] = entry['imageId']
+                continue
+            launchArguments = {
+                'ImageId' : sourceImage,
+                'InstanceType' : instanceType,
+                'MinCount' : 1,
+                'MaxCount' : 1,
+                'UserData' : getBakeScript(stackRole),
+                'InstanceInitiatedShutdownBehavior' : 'stop',
+                'TagSpecifications' : [{'ResourceType' : 'instance', 'Tags' : [{'Key' : 'Name', 'Value' : 'sbit-bake-%s-%s' % (stackRole, version)}]}],
+            }
+            if(subnetId is not None):
+                launchArguments['SubnetId'] = subnetId
+            instanceId = callWithBackoff(lambda: ec2.run_instances(**launchArguments), sleep)['Instances'][0]['InstanceId']
+            print('%s: baking recipe %s from %s on %s...' % (stackRole, version, sourceImage, instanceId))
+            builders[stackRole] = {'instanceId' : instanceId, 'sourceImage' : sourceImage, 'version' : version, 'imageId' : None}
+
+        deadline = clock() + BAKE_TIMEOUT
+        failedRoles = []
+        while(builders):
+            if(clock() > deadline):
+                raise RuntimeError('Baking %s did not finish within %s' % (', '.join(builders), formatDuration(BAKE_TIMEOUT)))
+            sleep(BAKE_POLL_INTERVAL)
+            #Builders still configuring: image each one as soon as sysprep stops it
+            configuring = {builder['instanceId'] : stackRole for stackRole, builder in builders.items() if builder['imageId'] is None}
+            if(configuring):
+                reservations = callWithBackoff(lambda: ec2.describe_instances(InstanceIds=list(configuring)), sleep)['Reservations']
+                for instance in [instance for reservation in reservations for instance in reservation['Instances']]:
+                    stackRole = configuring[instance['InstanceId']]
+                    builder = builders[stackRole]
+                    if(instance['State']['Name'] == 'stopped'):
+                        imageName = 'sbit-%s-%s-%d' % (stackRole, builder['version'], time.time())
+                        builder['imageId'] = callWithBackoff(lambda: ec2.create_image(InstanceId=builder['instanceId'], Name=imageName, Description='SBIT golden image for %s (recipe %s)' % (stackRole, builder['version'])), sleep)['ImageId']
+                        print('%s: configured, creating image %s...' % (stackRole, builder['imageId']))
+                    elif(instance['State']['Name'] in ['shutting-down', 'terminated']):
+                        print('%s: builder %s was terminated before it finished' % (stackRole, builder['instanceId']))
+                        failedRoles.append(stackRole)
+                        del builders[stackRole]
+            #Images being written: record each one once it is available
+            imaging = {builder['imageId'] : stackRole for stackRole, builder in builders.items() if builder['imageId'] is not None}
+            if(imaging):
+                for image in callWithBackoff(lambda: ec2.describe_images(ImageIds=list(imaging)), sleep)['Images']:
+                    stackRole = imaging[image['ImageId']]
+                    builder = builders[stackRole]
+                    if(image['State'] == 'pending'):
+                        continue
+                    callWithBackoff(lambda: ec2.terminate_instances(InstanceIds=[builder['instanceId']]), sleep)
+                    del builders[stackRole]
+                    if(image['State'] != 'available'):
+                        print('%s: image %s failed (%s)' % (stackRole, image['ImageId'], image.get('StateReason', {}).get('Message', image['State'])))
+                        failedRoles.append(stackRole)
+                        continue
+                    print('%s: %s is ready' % (stackRole, image['ImageId']))
+                    catalog.setdefault(region, {}).setdefault(stackRole, {})[builder['version']] = {
+                        'imageId' : image['ImageId'],
+                        'sourceImage' : builder['sourceImage'],
+                        'bakedAt' : datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                    }
+                    #Save after each image so a later failure does not lose it
+                    saveAmiCatalog(catalog, catalogPath)
+                    bakedImages[stackRole] = image['ImageId']
+    finally:
+        if(builders):
+            instanceIds = sorted(builder['instanceId'] for builder in builders.values())
+            print('Terminating builder%s %s' % ('' if len(instanceIds) == 1 else 's', ', '.join(instanceIds)))
+            callWithBackoff(lambda: ec2.terminate_instances(InstanceIds=instanceIds), sleep)
+    if(failedRoles):
+        raise RuntimeError('Could not bake images for: %s' % (', '.join(failedRoles)))
+    return bakedImages
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#Target number of ready network stacks, as set by "sbit-master.py pool --size"; 0 turns the pool off
+def loadNetworkPoolSize(poolPath=NETWORK_POOL_PATH):
+    try:
+        with open(poolPath) as poolFile:
+            return json.load(poolFile).get('size', 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def saveNetworkPoolSize(size, poolPath=NETWORK_POOL_PATH):
+    os.makedirs(os.path.dirname(poolPath), exist_ok=True)
+    with open(poolPath + '.tmp', 'w') as poolFile:
+        json.dump({'size' : size}, poolFile)
+    os.replace(poolPath + '.tmp', poolPath)
+
+#Pool stacks in the account, found with one paginated listing and sorted oldest first
+#A claim that rolled back leaves the stack as the pool built it, so it is available again; stacks still tagged
+#available in any other state (ex. UPDATE_IN_PROGRESS) are being claimed by a build right now
+#Returns {'available' : [...], 'warming' : [...], 'claiming' : [...], 'failed' : [...]} lists of describe_stacks entries
+def listNetworkPool(client, sleep=time.sleep):
+    pool = {'available' : [], 'warming' : [], 'claiming' : [], 'failed' : []}
+    for page in callWithBackoff(lambda: list(client.get_paginator('describe_stacks').paginate()), sleep):
+        for stack in page['Stacks']:
+            tags = {tag['Key'] : tag['Value'] for tag in stack.get('Tags', [])}
+            if(tags.get(POOL_TAG) != 'available'):
+                continue
+            if(stack['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']):
+                pool['available'].append(stack)
+            elif(stack['StackStatus'] == 'CREATE_IN_PROGRESS'):
+                pool['warming'].append(stack)
+            elif(stack['StackStatus'] in POOL_FAILED_STATUSES):
+                pool['failed'].append(stack)
+            elif(stack['StackStatus'] != 'DELETE_IN_PROGRESS'):
+                pool['claiming'].append(stack)
+    for stacks in pool.values():
+        stacks.sort(key=lambda stack: str(stack.get('CreationTime', '')))
+    return pool
+
+#Start enough new pool stacks to bring available plus warming stacks back up to targetSize, and clear
+#out any that failed; stacks being claimed are left to the builds claiming them
+#CloudFormation builds the new stacks while the caller carries on
+#Returns the names of the stacks started
+def refillNetworkPool(client, targetSize, templateUrl, pool=None, sleep=time.sleep):
+    if(pool is None):
+        pool = listNetworkPool(client, sleep)
+    for stack in pool['failed']:
+        callWithBackoff(lambda: client.delete_stack(StackName=stack['StackId']), sleep)
+    startedStacks = []
+    for stackNumber in range(targetSize - len(pool['available']) - len(pool['warming'])):
+        stackName = NETWORK_POOL_NAME_FORMAT % (hashlib.sha256(os.urandom(16)).hexdigest()[:10])
+        callWithBackoff(lambda: client.create_stack(
+            StackName = stackName,
+            TemplateURL = templateUrl,
+            Parameters = getNetworkStackParameters(POOL_PLACEHOLDER_IP),
+            OnFailure = 'DO_NOTHING',
+            Tags = [{'Key' : POOL_TAG, 'Value' : 'available'}]
+        ), sleep)
+        startedStacks.append(stackName)
+    return startedStacks
+
+#Give each environment's network a ready stack from the pool where one is available, then refill the pool
+#A claimed stack only has its customer gateway IP updated, and since the other stacks only import its
+#VPC and subnet IDs, AD starts as soon as the claim succeeds instead of waiting out a 4-6 minute network build
+#The claim stays the network node of the graph; if another build claims the stack first, the claim moves on
+#to the next pool stack nobody was given, and builds the tenant's own network stack once those run out
+#Any other rejected update skips the tenant's other stacks instead of building them in a VPC that isn't theirs
+#Every claim is recorded in buildHistory as a hit or miss; returns (hits, misses)
+def claimPooledNetworks(stackGraph, environments, buildHistory, client=None, poolPath=NETWORK_POOL_PATH, sleep=time.sleep):
+    targetSize = loadNetworkPoolSize(poolPath)
+    if(targetSize == 0 or not environments):
+        return 0, 0
+    if(client is None):
+        client = getCloudFormationClient()
+    networkNodes = {node.get('group') : node for node in stackGraph if node['role'] == 'network'}
+    #Pool stacks are built from the same uploaded template as the environments' own network stacks
+    templateUrl = networkNodes[environments[0]['tenant']]['templateUrl']
+    pool = listNetworkPool(client, sleep)
+    hits = misses = 0
+    for environment in environments:
+        networkNode = networkNodes[environment['tenant']]
+        networkBuild = {key : networkNode[key] for key in ['name', 'parameters', 'templateUrl', 'timingKey', 'expectedSeconds', 'eta'] if key in networkNode}
+        if(not pool['available']):
+            misses += 1
+            buildHistory.recordPoolClaim(environment['tenant'], None)
+            continue
+        hits += 1
+        poolStack = pool['available'].pop(0)
+        buildHistory.recordPoolClaim(environment['tenant'], poolStack['StackName'])
+        environment['networkStackName'] = poolStack['StackName']
+        for node in stackGraph:
+            if(networkNode['name'] in node['dependsOn']):
+                node['dependsOn'][node['dependsOn'].index(networkNode['name'])] = poolStack['StackName']
+                for parameter in node['parameters']:
+                    if(parameter['ParameterKey'] == 'NetworkStackName'):
+                        parameter['ParameterValue'] = poolStack['StackName']
+        networkNode.pop('eta', None)
+        networkNode.update({
+            'name' : poolStack['StackName'],
+            'action' : 'Claim',
+            'timingKey' : ('claim', 0, 0),
+            'expectedSeconds' : POOL_CLAIM_SECONDS,
+            'dependentsStartOnCreate' : True,
+            'create' : (lambda networkNode, environment, networkBuild: lambda: claimPooledNetwork(client, stackGraph, networkNode, environment, pool['available'], networkBuild))(networkNode, environment, networkBuild),
+        })
+    buildHistory.commit()
+    startedStacks = refillNetworkPool(client, targetSize, templateUrl, pool, sleep)
+    print('\nNetwork pool: %d hit%s, %d miss%s; %d stack%s started to refill it.' % (hits, '' if hits == 1 else 's', misses, '' if misses == 1 else 'es', len(startedStacks), '' if len(startedStacks) == 1 else 's'))
+    return hits, misses
+
+#Run an environment's network node claim, retrying with spareStacks (pool stacks no environment was given) while
+#other builds keep claiming them first; once none are left, the node goes back to building the tenant's own
+#network stack as described by networkBuild (the node's values from before it was pointed at the pool)
+#The graph keeps the node under its pool stack's name; the stacks that import the network are told its real name
+def claimPooledNetwork(client, stackGraph, networkNode, environment, spareStacks, networkBuild):
+    stackName = networkNode['name']
+    while(True):
+        try:
+            return claimNetworkStack(client, stackName, environment['publicIp'], environment['tenant'])
+        except getClientError() as error:
+            if(not isPoolClaimConflict(error)):
+                raise
+            print('Pool stack %s is being claimed by another build.' % (stackName))
+        try:
+            stackName = spareStacks.pop(0)['StackName']
+        except IndexError:
+            break
+        setNetworkStackName(stackGraph, networkNode, environment, stackName)
+    print('No pool stacks left, building %s instead.' % (networkBuild['name']))
+    setNetworkStackName(stackGraph, networkNode, environment, networkBuild['name'])
+    environment.pop('networkStackName', None)
+    networkNode.update({key : value for key, value in networkBuild.items() if key != 'name'})
+    networkNode.update({'action' : 'Build', 'dependentsStartOnCreate' : False})
+    return buildNetworkStack(networkBuild['name'], networkBuild['parameters'], networkBuild.get('templateUrl'))
+
+#Point the stacks that import the network node's VPC at stackName instead
+def setNetworkStackName(stackGraph, networkNode, environment, stackName):
+    environment['networkStackName'] = stackName
+    for node in stackGraph:
+        if(networkNode['name'] in node['dependsOn']):
+            for parameter in node['parameters']:
+                if(parameter['ParameterKey'] == 'NetworkStackName'):
+                    parameter['ParameterValue'] = stackName
+
+#Another build claimed the stack between our tag check and update_stack (so the update was rejected because
+#the stack is mid-update), or got it first and has already finished or deleted it
+def isPoolClaimConflict(error):
+    code = error.response['Error']['Code']
+    message = error.response['Error'].get('Message', '')
+    return code == 'PoolStackClaimed' or (code == 'ValidationError' and ('IN_PROGRESS' in message or 'does not exist' in message))
+
+#Hand a pool stack to a tenant: set its customer gateway IP and tag it as theirs
+#Everything else keeps its pool values, which are the same fixed CIDRs every network stack uses
+def claimNetworkStack(client, stackName, publicIp, tenant):
+    print('\n' + SECTION_SEPARATOR)
+    print('Claiming pooled AWS Networking (%s)...' % (stackName))
+    stack = client.describe_stacks(StackName=stackName)['Stacks'][0]
+    if({tag['Key'] : tag['Value'] for tag in stack.get('Tags', [])}.get(POOL_TAG) != 'available' or stack['StackStatus'] not in ['CREATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']):
+        raise getClientError()({'Error' : {'Code' : 'PoolStackClaimed', 'Message' : 'Pool stack %s was claimed by another build' % (stackName)}}, 'UpdateStack')
+    parameters = []
+    for parameter in getNetworkStackParameters(publicIp):
+        if(parameter['ParameterKey'] == 'CustPubIp'):
+            parameters.append(parameter)
+        else:
+            parameters.append({'ParameterKey' : parameter['ParameterKey'], 'UsePreviousValue' : True})
+    try:
+        return client.update_stack(
+            StackName = stackName,
+            UsePreviousTemplate = True,
+            Parameters = parameters,
+            Tags = [{'Key' : POOL_TAG, 'Value' : 'claimed'}, {'Key' : TENANT_TAG, 'Value' : tenant}]
+        )
+    except getClientError() as error:
+        #Only possible if the tenant's IP is the pool's placeholder; the stack is already right
+        if('No updates are to be performed' in error.response['Error'].get('Message', '')):
+            return {'StackId' : stack['StackId']}
+        raise
+
+#Show the pool's current state and its hit rate
+def printNetworkPoolStatus(client=None, buildHistory=None):
+    if(client is None):
+        client = getCloudFormationClient()
+    pool = listNetworkPool(client)
+    print(SECTION_SEPARATOR)
+    print('Network pool target size: %d' % (loadNetworkPoolSize()))
+    for state in ['available', 'warming', 'claiming', 'failed']:
+        print('  %-10s %d %s' % (state + ':', len(pool[state]), ', '.join(stack['StackName'] for stack in pool[state])))
+    if(buildHistory is not None):
+        for label, sinceTime in [('Last 7 days', time.time() - 7*24*60*60), ('All time', 0)]:
+            hits, misses = buildHistory.poolClaimCounts(sinceTime)
+            print('%-12s %d hits, %d misses (%s hit rate)' % (label + ':', hits, misses, '%.0f%%' % (100 * hits / (hits + misses)) if hits + misses else '-'))
+    print(SECTION_SEPARATOR)
+    return pool
+
+#Parse command line arguments; with no arguments the interactive build is run
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description='SBIT: The Small Business IT Server Builder')
+    subparsers = parser.add_subparsers(dest='command')
+    parser.add_argument('--resume', action='store_true', help='Finish an interrupted or failed interactive build instead of starting over')
+    buildParser = subparsers.add_parser('build', help='Interactively build a new environment (default)')
+    buildParser.add_argument('--resume', action='store_true', default=argparse.SUPPRESS, help='Finish an interrupted or failed build instead of starting over')
+    batchParser = subparsers.add_parser('batch', help='Build every environment listed in a CSV or YAML manifest')
+    batchParser.add_argument('manifest', help='Path to a .csv, .yaml, or .yml manifest with one environment per row')
+    batchParser.add_argument('--max-concurrent', type=int, default=DEFAULT_BATCH_CONCURRENCY, help='Environments built at once; each uses four stacks (default: %d)' % (DEFAULT_BATCH_CONCURRENCY))
+    batchParser.add_argument('--dry-run', action='store_true', help='Validate the manifest without building anything')
+    batchParser.add_argument('--resume', action='store_true', help='Finish an earlier run of this manifest instead of starting over')
+    updateParser = subparsers.add_parser('update', help='Change settings on a built environment using CloudFormation change sets')
+    updateParser.add_argument('--tenant', default=DEFAULT_TENANT, help='Tenant whose environment to update (default: %s)' % (DEFAULT_TENANT))
+    updateParser.add_argument('--volume-size', dest='volumeSize', help='New file server storage size in GiBs')
+    updateParser.add_argument('--exch-volume-size', dest='exchVolumeSize', help='New Exchange server storage size in GiBs')
+    updateParser.add_argument('--dc-instance-type', dest='dcInstanceType', help='New instance type for Domain Controllers')
+    updateParser.add_argument('--fs-instance-type', dest='fsInstanceType', help='New instance type for File Servers')
+    updateParser.add_argument('--exch-instance-type', dest='exchInstanceType', help='New instance type for the Exchange server')
+    updateParser.add_argument('--yes', action='store_true', help='Apply the changes without asking for confirmation')
+    poolParser = subparsers.add_parser('pool', help='Show or resize the warm pool of ready network stacks that new builds claim')
+    poolParser.add_argument('--size', type=int, help='Number of ready network stacks to keep; 0 turns the pool off')
+    poolParser.add_argument('--drain', action='store_true', help='Delete every unclaimed pool stack and turn the pool off')
+    provisionParser = subparsers.add_parser('provision', help='Create users and their mailboxes in a built environment from a CSV, in batches')
+    provisionParser.add_argument('users', help='Path to a .csv with columns %s' % (', '.join(field for field, validator, message in USER_FIELDS)))
+    provisionParser.add_argument('--tenant', default=DEFAULT_TENANT, help='Tenant whose environment to add the users to (default: %s)' % (DEFAULT_TENANT))
+    provisionParser.add_argument('--domain', help='Domain of the environment (default: the one it was built with)')
+    provisionParser.add_argument('--ou', default=DEFAULT_USER_OU, help='Organizational unit to create the users in (default: %s)' % (DEFAULT_USER_OU))
+    provisionParser.add_argument('--database', default=DEFAULT_MAILBOX_DATABASE, help='Mailbox database for new mailboxes (default: %s)' % (DEFAULT_MAILBOX_DATABASE))
+    provisionParser.add_argument('--chunk-size', type=int, default=PROVISIONING_CHUNK_SIZE, help='Users per batch (default: %d)' % (PROVISIONING_CHUNK_SIZE))
+    provisionParser.add_argument('--max-concurrent', type=int, default=DEFAULT_PROVISIONING_CONCURRENCY, help='Batches run at once on each server (default: %d)' % (DEFAULT_PROVISIONING_CONCURRENCY))
+    provisionParser.add_argument('--dc-instance-id', help='Instance to create users on (default: the environment\'s first Domain Controller)')
+    provisionParser.add_argument('--exchange-instance-id', help='Instance to enable mailboxes on (default: the environment\'s Exchange server)')
+    provisionParser.add_argument('--dry-run', action='store_true', help='Check the file and list the batches without provisioning anything')
+    provisionParser.add_argument('--resume', action='store_true', help='Skip batches an earlier run of this file finished')
+    destroyParser = subparsers.add_parser('destroy', help='Delete environments in dependency order, and optionally every failed SBIT stack')
+    destroyParser.add_argument('--tenant', action='append', help='Tenant whose environment to delete; repeat for several (default: %s, unless --manifest or --orphans is given)' % (DEFAULT_TENANT))
+    destroyParser.add_argument('--manifest', help='Delete the environment of every tenant in this batch manifest')
+    destroyParser.add_argument('--orphans', action='store_true', help='Also delete SBIT stacks of any tenant that were left in a failed state')
+    destroyParser.add_argument('--yes', action='store_true', help='Delete without asking for confirmation')
+    adviseParser = subparsers.add_parser('advise', help='Recommend the cheapest instance types that fit an environment\'s users and storage')
+    adviseParser.add_argument('--users', type=int, required=True, help='Number of users the environment will have')
+    adviseParser.add_argument('--storage', type=int, default=0, help='Storage on each file server in GiBs (default: 0)')
+    adviseParser.add_argument('--num-dcs', type=int, default=MIN_DCS, help='Domain Controllers in the environment (default: %d)' % (MIN_DCS))
+    adviseParser.add_argument('--num-file-servers', type=int, default=MIN_DCS, help='File Servers in the environment (default: %d)' % (MIN_DCS))
+    adviseParser.add_argument('--top', type=int, default=3, help='Types to list for each role (default: 3)')
+    metricsParser = subparsers.add_parser('metrics', help='Show where build time and AWS API calls went in recent runs')
+    metricsParser.add_argument('--hours', type=int, default=24*7, help='Include runs from this many hours back (default: %d)' % (24*7))
+    metricsParser.add_argument('--top', type=int, default=10, help='Number of slowest tenants to list (default: 10)')
+    bakeParser = subparsers.add_parser('bake', help='Bake golden AMIs with each role\'s prerequisites installed; later builds use them automatically')
+    bakeParser.add_argument('--role', action='append', choices=list(BAKE_RECIPES), help='Role to bake; repeat for several (default: all)')
+    bakeParser.add_argument('--subnet-id', help='Subnet to launch builders in (default: the default VPC)')
+    bakeParser.add_argument('--instance-type', default=BAKE_INSTANCE_TYPE, help='Instance type for builders (default: %s)' % (BAKE_INSTANCE_TYPE))
+    bakeParser.add_argument('--force', action='store_true', help='Bake again even if the catalog has an image for the current recipe')
+    return parser.parse_args(argv)
+
 
 if __name__ == "__main__":
-    main()
+    arguments = parseArguments(sys.argv[1:])
+    #Commands that never call AWS have no metrics to export
+    if(arguments.command not in ['metrics', 'advise']):
+        atexit.register(buildMetrics.export)
+    if(arguments.command == 'pool'):
+        if(arguments.drain):
+            saveNetworkPoolSize(0)
+            pool = listNetworkPool(getCloudFormationClient())
+            for stack in pool['available'] + pool['warming'] + pool['failed']:
+                callWithBackoff(lambda: getCloudFormationClient().delete_stack(StackName=stack['StackId']))
+                print('Deleting %s' % (stack['StackName']))
+        elif(arguments.size is not None):
+            saveNetworkPoolSize(max(arguments.size, 0))
+            networkTemplateUrl = publishTemplates({'NetworkStackForCapstone' : getParsedTemplate('network')[1]})['NetworkStackForCapstone']
+            for stackName in refillNetworkPool(getCloudFormationClient(), max(arguments.size, 0), networkTemplateUrl):
+                print('Started %s' % (stackName))
+        history = BuildHistory()
+        try:
+            printNetworkPoolStatus(buildHistory=history)
+        finally:
+            history.close()
+    elif(arguments.command == 'bake'):
+        bakedImages = bakeImages(arguments.role or list(BAKE_RECIPES), subnetId=arguments.subnet_id, instanceType=arguments.instance_type, force=arguments.force)
+        print('\nCatalog: %s' % (AMI_CATALOG_PATH))
+        for stackRole, imageId in sorted(bakedImages.items()):
+            print('  %-10s %s' % (stackRole, imageId))
+    elif(arguments.command == 'metrics'):
+        printMetricsSummary(sinceHours=arguments.hours, top=arguments.top)
+    elif(arguments.command == 'advise'):
+        printInstanceAdvice(max(arguments.users, 1), max(arguments.storage, 0), arguments.num_dcs, arguments.num_file_servers, max(arguments.top, 1))
+    elif(arguments.command == 'provision'):
+        instanceIds = {'users' : arguments.dc_instance_id, 'mailboxes' : arguments.exchange_instance_id}
+        sys.exit(provisionUsers(arguments.users, arguments.tenant, arguments.domain, instanceIds, arguments.ou, arguments.database, max(arguments.chunk_size, 1), max(arguments.max_concurrent, 1), arguments.dry_run, arguments.resume))
+    elif(arguments.command == 'destroy'):
+        tenants = list(arguments.tenant or [])
+        if(arguments.manifest):
+            tenants += [str(row.get('tenant', '')).strip() for row in loadManifest(arguments.manifest)]
+        if(not tenants and not arguments.orphans):
+            tenants = [DEFAULT_TENANT]
+        sys.exit(runDestroy(tenants, arguments.orphans, arguments.yes))
+    elif(arguments.command == 'update'):
+        sys.exit(runUpdate(arguments.tenant, {field : getattr(arguments, field) for field, validator, message in UPDATABLE_FIELDS}, arguments.yes))
+    elif(arguments.command == 'batch'):
+        sys.exit(runBatch(arguments.manifest, arguments.max_concurrent, arguments.dry_run, arguments.resume))
+    else:
+        main(arguments.resume)
@@ -0,0 +1,526 @@
+#Offline benchmarks and simulations of the whole build pipeline, against the stand-ins in simulation.py
+#Run "python tests/benchmark.py --help" for the options; nothing here needs AWS credentials
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from simulation import sbit, SBIT_PATH, VirtualClock, FakeCloudFormationClient, FakeEc2Client, FakeS3Client, FakeSsmClient, getBenchmarkEnvironment, getFakeSession
+from simulation import BENCHMARK_STACK_MINUTES, BENCHMARK_DELETE_MINUTES, BENCHMARK_BAKE_MINUTES, BENCHMARK_IMAGE_MINUTES, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS
+
+#Tenant counts simulated by --suite, each with every tenant built at once
+SIMULATION_TENANT_COUNTS = [1, 10, 100]
+#Simulated stacks take their BENCHMARK_STACK_MINUTES time, varied by up to this fraction either way
+SIMULATION_JITTER = 0.1
+#How much worse than the baseline a result may be before the suite reports a regression
+SIMULATION_REGRESSION_TOLERANCE = 0.1
+
+#Compare the original waiter-per-stack build against runStackGraph and StackPoller using a stubbed
+#CloudFormation client on a simulated clock, reporting wall time and API calls for each
+def benchmarkStackGraph(throttleRate=0.0):
+    stackSeconds = {name : minutes * 60 for name, minutes in BENCHMARK_STACK_MINUTES.items()}
+    realClient = sbit.cloudFormationClient
+    try:
+        #Baseline, in the original script's order: network and AD are each waited on in turn, then FS and
+        #Exchange are both created and waited on one after the other, each with its own waiter
+        clock = VirtualClock()
+        client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock)
+        for stackName in [sbit.networkStackName, sbit.adStackName]:
+            client.create_stack(StackName=stackName)
+            client.get_waiter('stack_create_complete').wait(StackName=stackName)
+        client.create_stack(StackName=sbit.fsStackName)
+        client.create_stack(StackName=sbit.exchStackName)
+        client.get_waiter('stack_create_complete').wait(StackName=sbit.fsStackName)
+        client.get_waiter('stack_create_complete').wait(StackName=sbit.exchStackName, WaiterConfig={'Delay':30,'MaxAttempts':200})
+        waiterSeconds, waiterCalls = clock.now(), client.apiCalls
+
+        clock = VirtualClock()
+        client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, throttleRate)
+        stackGraph = [
+            {'name' : sbit.networkStackName, 'label' : 'AWS Networking', 'dependsOn' : []},
+            {'name' : sbit.adStackName, 'label' : 'Active Directory', 'dependsOn' : [sbit.networkStackName]},
+            {'name' : sbit.fsStackName, 'label' : 'File Servers', 'dependsOn' : [sbit.networkStackName, sbit.adStackName]},
+            {'name' : sbit.exchStackName, 'label' : 'Exchange Server', 'dependsOn' : [sbit.networkStackName, sbit.adStackName], 'timeoutSeconds' : 3*60*60},
+        ]
+        for node in stackGraph:
+            node['create'] = (lambda name: lambda: sbit.cloudFormationClient.create_stack(StackName=name))(node['name'])
+            node['expectedSeconds'] = stackSeconds[node['name']]
+        sbit.runStackGraph(stackGraph, sbit.StackPoller(clock=clock.now, sleep=clock.sleep))
+        graphSeconds, graphCalls = clock.now(), client.apiCalls
+    finally:
+        sbit.cloudFormationClient = realClient
+
+    criticalPathSeconds = sbit.estimateCriticalPath(stackGraph)
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Critical path (network, AD, Exchange): %.1f min.' % (criticalPathSeconds / 60))
+    print('Waiter per stack:   %6.1f min. (+%ds), %4d API calls' % (waiterSeconds / 60, waiterSeconds - criticalPathSeconds, waiterCalls))
+    print('Batched stack graph: %5.1f min. (+%ds), %4d API calls' % (graphSeconds / 60, graphSeconds - criticalPathSeconds, graphCalls))
+    print('API calls reduced by %.0f%%' % (100 * (1 - graphCalls / waiterCalls)))
+    #Both finish on the critical path, so a single build's time can only differ by how late each finish is noticed
+    print('The original script already built File Servers and Exchange in parallel, so one environment takes the')
+    print('same time either way; the graph saves API calls here and builds tenants side by side (see --tenants).')
+    print(sbit.SECTION_SEPARATOR)
+    return (waiterSeconds, waiterCalls), (graphSeconds, graphCalls)
+
+#Measure batch throughput (environments per hour) building tenantCount environments against a stubbed
+#CloudFormation client on a simulated clock, maxConcurrent at a time
+def benchmarkBatch(tenantCount, maxConcurrent=sbit.DEFAULT_BATCH_CONCURRENCY):
+    environments = []
+    stackSeconds = {}
+    for tenantNumber in range(1, tenantCount + 1):
+        tenant = 'Bench%03d' % (tenantNumber)
+        environments.append(getBenchmarkEnvironment(tenant))
+        for role, stackName in sbit.getStackNames(tenant).items():
+            stackSeconds[stackName] = BENCHMARK_STACK_MINUTES[sbit.STACK_NAME_FORMATS[role] % (sbit.DEFAULT_TENANT)] * 60
+
+    realClient = sbit.cloudFormationClient
+    clock = VirtualClock()
+    client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock)
+    try:
+        stackGraph = []
+        for environment in environments:
+            stackGraph.extend(sbit.createStackGraph(environment))
+        #Per-stack progress for every tenant is not interesting here, only the totals
+        with contextlib.redirect_stdout(io.StringIO()):
+            sbit.runStackGraph(stackGraph, sbit.StackPoller(clock=clock.now, sleep=clock.sleep), maxConcurrentGroups=maxConcurrent, raiseOnFailure=False)
+    finally:
+        sbit.cloudFormationClient = realClient
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('%d environments, %d at a time: %s (%.2f environments/hour)' % (tenantCount, maxConcurrent, sbit.formatDuration(clock.now()), tenantCount / clock.now() * 3600))
+    print('CloudFormation API calls: %d (%.1f per environment)' % (client.apiCalls, client.apiCalls / tenantCount))
+    print(sbit.SECTION_SEPARATOR)
+    return tenantCount / clock.now() * 3600
+
+#Drive buildCount environment builds at once on one event loop, following every stack's events, against a
+#stubbed CloudFormation client on a simulated clock; reports throughput, API calls, threads, and memory
+def benchmarkLoad(buildCount=100, throttleRate=0.0):
+    environments = [getBenchmarkEnvironment('Load%03d' % (buildNumber)) for buildNumber in range(1, buildCount + 1)]
+    stackSeconds = {}
+    for environment in environments:
+        for role, stackName in sbit.getStackNames(environment['tenant']).items():
+            stackSeconds[stackName] = BENCHMARK_STACK_MINUTES[sbit.STACK_NAME_FORMATS[role] % (sbit.DEFAULT_TENANT)] * 60
+
+    realClient, realMetrics = sbit.cloudFormationClient, sbit.buildMetrics
+    sbit.buildMetrics = sbit.BuildMetrics()
+    clock = VirtualClock()
+    client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, throttleRate)
+    poller = sbit.StackPoller(client, clock.now, clock.sleep, sbit.StackEventTail(client))
+    peakThreads = [threading.active_count()]
+    def sampleThreads(graph, node):
+        peakThreads.append(threading.active_count())
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    try:
+        stackGraph = []
+        for environment in environments:
+            stackGraph.extend(sbit.createStackGraph(environment))
+        with contextlib.redirect_stdout(io.StringIO()):
+            sbit.runStackGraph(stackGraph, poller, raiseOnFailure=False, onProgress=sampleThreads)
+        realSeconds = time.perf_counter() - startTime
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        loadMetrics = sbit.buildMetrics
+    finally:
+        tracemalloc.stop()
+        sbit.cloudFormationClient, sbit.buildMetrics = realClient, realMetrics
+
+    builtCount = len([environment for environment in environments if all(node['status'] == 'CREATE_COMPLETE' for node in stackGraph if node['group'] == environment['tenant'])])
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('%d environment builds (%d stacks) on one event loop:' % (buildCount, len(stackGraph)))
+    print('  Built:         %d of %d in %s simulated (%.1f environments/hour)' % (builtCount, buildCount, sbit.formatDuration(clock.now()), builtCount / clock.now() * 3600))
+    print('  Real time:     %.2f s' % (realSeconds))
+    print('  API calls:     %d (%.1f per environment; %d describe_stacks, %d throttled; %d stack events)' % (client.apiCalls, client.apiCalls / buildCount, poller.apiCalls, poller.throttles, poller.eventTail.apiCalls))
+    print('  Threads:       %d at most (%d boto3 workers)' % (max(peakThreads), sbit.MAX_AWS_WORKERS))
+    print('  Peak memory:   %.1f MB allocated by Python (%.0f KB per environment)' % (peakBytes / 2**20, peakBytes / 1024 / buildCount))
+    #The same spans and counters a real run exports, summarised as "sbit-master.py metrics" would
+    with tempfile.TemporaryDirectory() as metricsDirectory:
+        loadMetrics.export(os.path.join(metricsDirectory, 'trace.jsonl'), os.path.join(metricsDirectory, 'sbit.prom'))
+        sbit.printMetricsSummary(os.path.join(metricsDirectory, 'trace.jsonl'), top=3)
+    return builtCount
+
+#Run the bake pipeline against a stubbed EC2 client on a simulated clock, then bake again to show the
+#catalog being reused, and show the image IDs a build would pass to its stacks
+def benchmarkBake():
+    clock = VirtualClock()
+    ec2 = FakeEc2Client({role : minutes * 60 for role, minutes in BENCHMARK_BAKE_MINUTES.items()}, BENCHMARK_IMAGE_MINUTES * 60, clock)
+    with tempfile.TemporaryDirectory() as catalogDirectory:
+        catalogPath = os.path.join(catalogDirectory, 'ami-catalog.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            bakedImages = sbit.bakeImages(list(sbit.BAKE_RECIPES), ec2, catalogPath, clock=clock.now, sleep=clock.sleep)
+        bakeSeconds, bakeCalls = clock.now(), ec2.apiCalls
+        with contextlib.redirect_stdout(io.StringIO()):
+            sbit.bakeImages(list(sbit.BAKE_RECIPES), ec2, catalogPath, clock=clock.now, sleep=clock.sleep)
+        stackGraph = sbit.createStackGraph(getBenchmarkEnvironment(sbit.DEFAULT_TENANT))
+        sbit.applyBakedImages(stackGraph, ec2.meta.region_name, catalogPath)
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Baked %d images in %s (simulated), %d EC2 API calls' % (len(bakedImages), sbit.formatDuration(bakeSeconds), bakeCalls))
+    print('Baking again reused the catalog: %d more EC2 API calls' % (ec2.apiCalls - bakeCalls))
+    for node in stackGraph:
+        imageParameters = ['%s=%s' % (parameter['ParameterKey'], parameter['ParameterValue']) for parameter in node['parameters'] if parameter['ParameterKey'].endswith('Image')]
+        if(imageParameters):
+            print('%-20s %s (template without baked downloads and installs)' % (node['label'], ', '.join(imageParameters)))
+    print(sbit.SECTION_SEPARATOR)
+    return bakedImages
+
+#Build tenantCount environments against a stubbed CloudFormation client with poolSize network stacks
+#already warm, reporting how soon each tenant's AD stack started for pool hits and for misses
+def benchmarkPool(tenantCount=5, poolSize=3):
+    networkSeconds = BENCHMARK_STACK_MINUTES[sbit.networkStackName] * 60
+    environments = [getBenchmarkEnvironment('Bench%03d' % (tenantNumber)) for tenantNumber in range(1, tenantCount + 1)]
+    stackSeconds = {}
+    for environment in environments:
+        for role, stackName in sbit.getStackNames(environment['tenant']).items():
+            stackSeconds[stackName] = BENCHMARK_STACK_MINUTES[sbit.STACK_NAME_FORMATS[role] % (sbit.DEFAULT_TENANT)] * 60
+
+    realClient = sbit.cloudFormationClient
+    clock = VirtualClock()
+    client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, defaultStackSeconds=networkSeconds, updateSeconds=sbit.POOL_CLAIM_SECONDS)
+    buildHistory = sbit.BuildHistory(':memory:')
+    try:
+        with tempfile.TemporaryDirectory() as poolDirectory:
+            poolPath = os.path.join(poolDirectory, 'network-pool.json')
+            sbit.saveNetworkPoolSize(poolSize, poolPath)
+            stackGraph = []
+            for environment in environments:
+                stackGraph.extend(sbit.createStackGraph(environment))
+            with contextlib.redirect_stdout(io.StringIO()):
+                sbit.publishStackTemplates(stackGraph, FakeS3Client(), 'sbit-benchmark')
+            sbit.refillNetworkPool(client, poolSize, stackGraph[0]['templateUrl'], sleep=clock.sleep)
+            clock.sleep(networkSeconds)
+            startTime = clock.now()
+            with contextlib.redirect_stdout(io.StringIO()):
+                hits, misses = sbit.claimPooledNetworks(stackGraph, environments, buildHistory, client, poolPath, clock.sleep)
+                sbit.runStackGraph(stackGraph, sbit.StackPoller(clock=clock.now, sleep=clock.sleep), raiseOnFailure=False)
+            refilled = len(sbit.listNetworkPool(client, clock.sleep)['available'])
+    finally:
+        sbit.cloudFormationClient = realClient
+        buildHistory.close()
+
+    firstDcSeconds = {True : [], False : []}
+    for environment in environments:
+        adNode = [node for node in stackGraph if node['group'] == environment['tenant'] and node['role'] == 'ad'][0]
+        firstDcSeconds['networkStackName' in environment].append(adNode['startTime'] - startTime)
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('%d environments, %d warm network stacks: %d hits, %d misses' % (tenantCount, poolSize, hits, misses))
+    for hit, label in [(True, 'Pool hit'), (False, 'Pool miss')]:
+        if(firstDcSeconds[hit]):
+            print('%-10s AD started after %s on average' % (label + ':', sbit.formatDuration(statistics.mean(firstDcSeconds[hit]))))
+    print('Pool refilled to %d ready stacks in the background' % (refilled))
+    print(sbit.SECTION_SEPARATOR)
+    return hits, misses
+
+#Upload the templates and scripts for a stock environment and an 8 DC / 4 file server one to a local S3
+#stand-in, one at a time and then in parallel, then again as a repeat build would
+def benchmarkUpload(putSeconds=0.2):
+    stackGraph = sbit.createStackGraph(getBenchmarkEnvironment(sbit.DEFAULT_TENANT))
+    stackGraph += sbit.createStackGraph(dict(getBenchmarkEnvironment('Scaled'), numDcs=sbit.MAX_DCS, numFileServers=4))
+    timings = []
+    for label, maxWorkers in [('One at a time', 1), ('%d at a time' % (sbit.ARTIFACT_UPLOAD_WORKERS), sbit.ARTIFACT_UPLOAD_WORKERS), ('Repeat build', sbit.ARTIFACT_UPLOAD_WORKERS)]:
+        if(label != 'Repeat build'):
+            s3 = FakeS3Client(putSeconds)
+        apiCallsBefore = s3.apiCalls
+        startTime = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            sbit.publishStackTemplates(stackGraph, s3, 'sbit-benchmark', maxWorkers)
+        timings.append((label, time.perf_counter() - startTime, s3.apiCalls - apiCallsBefore))
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('%d templates and scripts, %.0f ms per upload:' % (len(s3.objects), putSeconds * 1000))
+    for label, seconds, apiCalls in timings:
+        print('  %-15s %6.2f s, %3d S3 calls' % (label + ':', seconds, apiCalls))
+    print(sbit.SECTION_SEPARATOR)
+    return timings
+
+#Tear down tenantCount environments on a stubbed CloudFormation client, first the way it is done by hand
+#(one stack at a time in dependency order, each with its own waiter) and then with runTeardownGraph
+def benchmarkDestroy(tenantCount=10):
+    tenants = ['Bench%03d' % (tenantNumber) for tenantNumber in range(1, tenantCount + 1)]
+    deleteSeconds = {}
+    for tenant in tenants:
+        for role, stackName in sbit.getStackNames(tenant).items():
+            deleteSeconds[stackName] = BENCHMARK_DELETE_MINUTES[role] * 60
+    results = []
+    for useConcurrency in [False, True]:
+        clock = VirtualClock()
+        client = FakeCloudFormationClient({}, clock, deleteSeconds=deleteSeconds)
+        for stackName in deleteSeconds:
+            client.create_stack(StackName=stackName)
+        client.apiCalls = 0
+        if(useConcurrency):
+            with contextlib.redirect_stdout(io.StringIO()):
+                poller = sbit.StackPoller(client, clock.now, clock.sleep)
+                sbit.runTeardownGraph(sbit.createTeardownGraph(tenants, poller=poller), poller)
+        else:
+            for tenant in tenants:
+                stackNames = sbit.getStackNames(tenant)
+                for role in ['exchange', 'fs', 'ad', 'network']:
+                    client.delete_stack(StackName=stackNames[role])
+                    client.get_waiter('stack_delete_complete').wait(StackName=stackNames[role])
+        results.append((clock.now(), client.apiCalls))
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Tearing down %d environments:' % (tenantCount))
+    for label, (seconds, apiCalls) in zip(['One stack at a time', 'Dependency-aware teardown'], results):
+        print('  %-26s %s (%.1f environments/hour), %4d API calls' % (label + ':', sbit.formatDuration(seconds), tenantCount / seconds * 3600, apiCalls))
+    print(sbit.SECTION_SEPARATOR)
+    return results
+
+#Provision userCount users on a stubbed Systems Manager client, first one user per command, one command at a
+#time (as running the cmdlets by hand does), then in batches with runProvisioning's defaults
+#Command and per-user times are modeled, so the comparison shows how much waiting batching removes
+#One user at a time takes the same time for every user, so it is run for sampleCount users and scaled up
+def benchmarkProvisioning(userCount=2000, failureRate=0.0, sampleCount=100):
+    users = [{
+        'samAccountName' : 'user%05d' % (userNumber), 'firstName' : 'Bench', 'lastName' : 'User %d' % (userNumber), 'password' : 'Bench-Pass1',
+        'department' : 'Sales', 'title' : '', 'groups' : ['AllEmployees'], 'mailbox' : True,
+    } for userNumber in range(1, userCount + 1)]
+    instanceIds = {'users' : 'i-0000000000000dc01', 'mailboxes' : 'i-00000000000exch01'}
+    results = []
+    with tempfile.TemporaryDirectory() as stateDirectory:
+        for label, chunkSize, maxConcurrent in [('One user at a time', 1, 1), ('Batches of %d, %d at a time' % (sbit.PROVISIONING_CHUNK_SIZE, sbit.DEFAULT_PROVISIONING_CONCURRENCY), sbit.PROVISIONING_CHUNK_SIZE, sbit.DEFAULT_PROVISIONING_CONCURRENCY)]:
+            runUsers = users[:sampleCount] if chunkSize == 1 else users
+            scale = len(users) / len(runUsers)
+            clock = VirtualClock()
+            ssm = FakeSsmClient(clock, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS, failureRate)
+            with contextlib.redirect_stdout(io.StringIO()):
+                exitCode = sbit.runProvisioning('Bench', runUsers, 'bench.example.com', instanceIds, ssm, chunkSize=chunkSize, maxConcurrent=maxConcurrent,
+                                           statePath=os.path.join(stateDirectory, '%d.json' % (chunkSize)), clock=clock.now, sleep=clock.sleep)
+            results.append((label + (' (scaled up from %d)' % (len(runUsers)) if scale > 1 else ''), clock.now() * scale, round(ssm.apiCalls * scale), round(len(ssm.commands) * scale), exitCode))
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Provisioning %d users with mailboxes (%.0f s per command, %.1f s per user, %.1f s per mailbox):' % (userCount, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS['users'], BENCHMARK_USER_SECONDS['mailboxes']))
+    for label, seconds, apiCalls, commandCount, exitCode in results:
+        print('  %-42s %12s, %5d commands, %5d SSM calls%s' % (label + ':', sbit.formatDuration(seconds), commandCount, apiCalls, '' if exitCode == 0 else ' (some users failed)'))
+    print(sbit.SECTION_SEPARATOR)
+    return results
+
+#Time loading the instance type catalog and recommending types for every role at many user counts
+def benchmarkAdvisor(lookups=10000):
+    sbit.instanceCatalog = None
+    startTime = time.perf_counter()
+    catalog = sbit.getInstanceCatalog()
+    loadSeconds = time.perf_counter() - startTime
+    userCounts = [random.randint(1, sbit.MAX_USER_COUNT // 10) for lookup in range(lookups)]
+    startTime = time.perf_counter()
+    for userCount in userCounts:
+        sbit.getDefaultInstanceTypes(userCount, random.randint(sbit.MIN_VOLUME_SIZE, sbit.MAX_VOLUME_SIZE))
+    lookupSeconds = time.perf_counter() - startTime
+
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Instance type catalog: %d types (%d can run Windows)' % (len(catalog.instanceTypes), len(catalog.byWindowsPrice)))
+    print('  Load and index:                 %8.2f ms' % (loadSeconds * 1000))
+    print('  Recommend all three roles:      %8.1f us per environment (%d environments)' % (lookupSeconds / lookups * 1000000, lookups))
+    print(sbit.SECTION_SEPARATOR)
+    return loadSeconds, lookupSeconds / lookups
+
+#Run one simulated batch build of tenantCount environments, end to end through runBatch, in a child process
+#whose home directory is a temporary sandbox, so checkpoints, caches, and history never touch the real ones
+#and no AWS credentials are visible to it; returns the results written by simulateBatch
+def runSimulation(tenantCount, maxConcurrent=sbit.DEFAULT_BATCH_CONCURRENCY, throttleRate=0.0, failureRate=0.0, jitter=SIMULATION_JITTER, poolSize=0, seed=0, showOutput=True):
+    with tempfile.TemporaryDirectory() as sandboxDirectory:
+        resultsPath = os.path.join(sandboxDirectory, 'results.json')
+        command = [sys.executable, os.path.abspath(__file__), 'simulate', '--tenants', str(tenantCount), '--max-concurrent', str(maxConcurrent),
+            '--throttle-rate', str(throttleRate), '--failure-rate', str(failureRate), '--jitter', str(jitter), '--pool-size', str(poolSize),
+            '--seed', str(seed), '--sandbox-results', resultsPath]
+        childEnvironment = {name : value for name, value in os.environ.items() if not name.startswith('AWS_')}
+        childEnvironment.update({'HOME' : sandboxDirectory, 'USERPROFILE' : sandboxDirectory, 'AWS_DEFAULT_REGION' : 'us-east-2', sbit.ARTIFACT_BUCKET_VARIABLE : 'sbit-simulation'})
+        completed = subprocess.run(command, env=childEnvironment, stdout=None if showOutput else subprocess.DEVNULL)
+        if(not os.path.exists(resultsPath)):
+            raise RuntimeError('The simulation of %d tenants did not finish (exit code %d)' % (tenantCount, completed.returncode))
+        with open(resultsPath) as resultsFile:
+            return json.load(resultsFile)
+
+#Inside the sandbox: replace the AWS clients with stand-ins on a simulated clock, write a manifest of tenantCount
+#environments, and build it with runBatch exactly as "sbit-master.py batch" would
+#Each stack takes its BENCHMARK_STACK_MINUTES time, varied by up to +/- jitter; each fails with probability
+#failureRate; and create_stack and describe_stacks calls are throttled at throttleRate
+def simulateBatch(tenantCount, maxConcurrent=sbit.DEFAULT_BATCH_CONCURRENCY, throttleRate=0.0, failureRate=0.0, jitter=SIMULATION_JITTER, poolSize=0, seed=0):
+    random.seed(seed)
+    environments = [getBenchmarkEnvironment('Sim%03d' % (tenantNumber)) for tenantNumber in range(1, tenantCount + 1)]
+    stackSeconds = {}
+    for environment in environments:
+        for role, stackName in sbit.getStackNames(environment['tenant']).items():
+            stackSeconds[stackName] = BENCHMARK_STACK_MINUTES[sbit.STACK_NAME_FORMATS[role] % (sbit.DEFAULT_TENANT)] * 60 * random.uniform(1 - jitter, 1 + jitter)
+    failingStacks = [stackName for stackName in sorted(stackSeconds) if random.random() < failureRate]
+
+    clock = VirtualClock()
+    networkSeconds = BENCHMARK_STACK_MINUTES[sbit.networkStackName] * 60
+    sbit.awsSession = getFakeSession()
+    sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, throttleRate, failingStacks, defaultStackSeconds=networkSeconds, updateSeconds=sbit.POOL_CLAIM_SECONDS)
+    sbit.ec2Client = FakeEc2Client({role : minutes * 60 for role, minutes in BENCHMARK_BAKE_MINUTES.items()}, BENCHMARK_IMAGE_MINUTES * 60, clock)
+    sbit.s3Client = FakeS3Client()
+    manifestPath = os.path.join(os.path.expanduser('~'), 'simulation.csv')
+    with open(manifestPath, 'w', newline='') as manifestFile:
+        writer = csv.DictWriter(manifestFile, [field for field, validator, message in sbit.MANIFEST_FIELDS])
+        writer.writeheader()
+        writer.writerows(environments)
+    if(poolSize):
+        sbit.saveNetworkPoolSize(poolSize)
+        networkTemplateUrl = sbit.publishTemplates({'NetworkStackForCapstone' : sbit.getParsedTemplate('network')[1]})['NetworkStackForCapstone']
+        sbit.refillNetworkPool(sbit.cloudFormationClient, poolSize, networkTemplateUrl, sleep=clock.sleep)
+        clock.sleep(networkSeconds)
+        sbit.cloudFormationClient.apiCalls = 0
+
+    poller = sbit.StackPoller(sbit.cloudFormationClient, clock.now, clock.sleep)
+    tracemalloc.start()
+    simulatedStartTime = clock.now()
+    realStartTime = time.perf_counter()
+    exitCode = sbit.runBatch(manifestPath, maxConcurrent, poller=poller)
+    realSeconds = time.perf_counter() - realStartTime
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    builtCount = 0
+    for environment in environments:
+        stackStatuses = [stack['status'] for stack in sbit.loadCheckpoint(environment['tenant'])['stacks'].values()]
+        builtCount += 1 if all(stackStatus in sbit.STACK_BUILT_STATUSES for stackStatus in stackStatuses) else 0
+    apiCallsByOperation = {}
+    for (name, labels), value in sbit.buildMetrics.counters.items():
+        if(name == 'sbit_aws_api_calls_total'):
+            apiCallsByOperation[dict(labels)['operation']] = value
+    simulatedSeconds = clock.now() - simulatedStartTime
+    return {
+        'tenants' : tenantCount,
+        'maxConcurrent' : maxConcurrent,
+        'exitCode' : exitCode,
+        'built' : builtCount,
+        #Stacks drawn to fail but never created (network stacks replaced by pool claims, or skipped after a parent failed) don't count
+        'failingStacks' : len([stackName for stackName in failingStacks if stackName in sbit.cloudFormationClient.stackStartTimes]),
+        'simulatedSeconds' : simulatedSeconds,
+        'environmentsPerHour' : builtCount / simulatedSeconds * 3600,
+        'apiCalls' : sbit.cloudFormationClient.apiCalls,
+        'apiCallsPerBuild' : sbit.cloudFormationClient.apiCalls / tenantCount,
+        'apiCallsByOperation' : apiCallsByOperation,
+        'throttles' : poller.throttles,
+        'realSeconds' : realSeconds,
+        'peakMemoryBytes' : peakBytes,
+    }
+
+#Simulate batch builds of 1, 10, and 100 tenants, all built at once, and print a table of the results
+#With baselinePath, results worse than the saved baseline by more than SIMULATION_REGRESSION_TOLERANCE in
+#simulated build time or API calls per build are reported as regressions; returns the process exit code
+def benchmarkSuite(throttleRate=0.0, failureRate=0.0, baselinePath=None, saveBaselinePath=None):
+    results = [runSimulation(tenantCount, tenantCount, throttleRate, failureRate, showOutput=False) for tenantCount in SIMULATION_TENANT_COUNTS]
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Simulated batch builds (throttle rate %.2f, failure rate %.2f):' % (throttleRate, failureRate))
+    print('  %-8s %-9s %-14s %-9s %-16s %-10s %-10s %s' % ('Tenants', 'Built', 'Build time', 'Env/hr', 'API calls/build', 'Throttled', 'Real time', 'Peak memory'))
+    for result in results:
+        print('  %-8d %-9s %-14s %-9.1f %-16.1f %-10d %-10s %.1f MB' % (result['tenants'], '%d/%d' % (result['built'], result['tenants']), sbit.formatDuration(result['simulatedSeconds']), result['environmentsPerHour'], result['apiCallsPerBuild'], result['throttles'], '%.2f s' % (result['realSeconds']), result['peakMemoryBytes'] / 2**20))
+
+    regressions = []
+    if(baselinePath is not None):
+        with open(baselinePath) as baselineFile:
+            baselineResults = {result['tenants'] : result for result in json.load(baselineFile)}
+        for result in results:
+            baseline = baselineResults.get(result['tenants'])
+            if(baseline is None):
+                continue
+            for field, label in [('simulatedSeconds', 'build time'), ('apiCallsPerBuild', 'API calls per build')]:
+                if(result[field] > baseline[field] * (1 + SIMULATION_REGRESSION_TOLERANCE)):
+                    regressions.append('%d tenants: %s went from %.1f to %.1f (+%.0f%%)' % (result['tenants'], label, baseline[field], result[field], 100 * (result[field] / baseline[field] - 1)))
+        print('\nCompared with %s: %s' % (baselinePath, '%d regression%s' % (len(regressions), '' if len(regressions) == 1 else 's') if regressions else 'no regressions'))
+        for regression in regressions:
+            print('  ' + regression)
+    if(saveBaselinePath is not None):
+        with open(saveBaselinePath, 'w') as baselineFile:
+            json.dump(results, baselineFile, indent=2)
+        print('\nBaseline saved to %s' % (saveBaselinePath))
+    print(sbit.SECTION_SEPARATOR)
+    return 1 if regressions else 0
+
+#Measure how long the CLI takes to start, compared with the cost of importing boto3 that it now defers
+def benchmarkStartup(runs=5):
+    def medianSeconds(command):
+        timings = []
+        for run in range(runs):
+            startTime = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - startTime)
+        return statistics.median(timings)
+
+    interpreterSeconds = medianSeconds([sys.executable, '-c', 'pass'])
+    helpSeconds = medianSeconds([sys.executable, SBIT_PATH, '--help'])
+    boto3Seconds = medianSeconds([sys.executable, '-c', 'import boto3; boto3.session.Session().client("cloudformation"); boto3.session.Session().client("ec2")'])
+    print('\n' + sbit.SECTION_SEPARATOR)
+    print('Python interpreter start:            %4.0f ms' % (interpreterSeconds * 1000))
+    print('sbit-master.py --help:               %4.0f ms' % (helpSeconds * 1000))
+    print('boto3 import and client setup alone: %4.0f ms (now deferred until AWS is first used)' % (boto3Seconds * 1000))
+    print(sbit.SECTION_SEPARATOR)
+    return helpSeconds
+
+
+
+#Parse command line arguments; with no subcommand the benchmarks selected by the options are run
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description='Benchmark SBIT against simulated AWS services, without credentials')
+    subparsers = parser.add_subparsers(dest='command')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of create, describe, and stack event calls the stub throttles (default: 0.0)')
+    parser.add_argument('--startup', action='store_true', help='Also benchmark CLI startup time')
+    parser.add_argument('--tenants', type=int, default=0, help='Also benchmark batch throughput building this many environments')
+    parser.add_argument('--max-concurrent', type=int, default=sbit.DEFAULT_BATCH_CONCURRENCY, help='Environments built at once in the batch benchmark (default: %d)' % (sbit.DEFAULT_BATCH_CONCURRENCY))
+    parser.add_argument('--pool', action='store_true', help='Also benchmark claiming network stacks from a warm pool')
+    parser.add_argument('--upload', action='store_true', help='Also benchmark uploading templates and scripts to a local S3 stand-in')
+    parser.add_argument('--bake', action='store_true', help='Also run the golden AMI bake pipeline against a stubbed EC2 client')
+    parser.add_argument('--load', type=int, nargs='?', const=100, default=0, help='Also drive this many environment builds at once on one event loop (default when given: 100)')
+    parser.add_argument('--suite', action='store_true', help='Also run the simulated batch suite at %s tenants' % ('/'.join(str(tenantCount) for tenantCount in SIMULATION_TENANT_COUNTS)))
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of stacks that fail in the simulated suite (default: 0.0)')
+    parser.add_argument('--baseline', help='Report suite results worse than this saved baseline as regressions (exit code 1)')
+    parser.add_argument('--save-baseline', help='Save the suite results as a baseline for later runs')
+    parser.add_argument('--destroy', action='store_true', help='Also benchmark tearing down environments')
+    parser.add_argument('--advisor', action='store_true', help='Also benchmark instance type recommendations over the bundled catalog')
+    parser.add_argument('--provision', type=int, nargs='?', const=2000, default=0, help='Also benchmark provisioning this many users and mailboxes (default when given: 2000)')
+    simulateParser = subparsers.add_parser('simulate', help='Run a batch build end to end against simulated AWS services')
+    simulateParser.add_argument('--tenants', type=int, default=10, help='Number of environments in the simulated manifest (default: 10)')
+    simulateParser.add_argument('--max-concurrent', type=int, default=sbit.DEFAULT_BATCH_CONCURRENCY, help='Environments built at once (default: %d)' % (sbit.DEFAULT_BATCH_CONCURRENCY))
+    simulateParser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of create and describe calls that are throttled (default: 0.0)')
+    simulateParser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of stacks that fail to build (default: 0.0)')
+    simulateParser.add_argument('--jitter', type=float, default=SIMULATION_JITTER, help='How much each stack\'s build time varies, as a fraction (default: %.1f)' % (SIMULATION_JITTER))
+    simulateParser.add_argument('--pool-size', type=int, default=0, help='Warm network stacks ready before the build (default: 0)')
+    simulateParser.add_argument('--seed', type=int, default=0, help='Random seed for build times, failures, and throttling (default: 0)')
+    simulateParser.add_argument('--sandbox-results', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parseArguments(sys.argv[1:])
+    if(arguments.command is None):
+        benchmarkStackGraph(arguments.throttle_rate)
+        if(arguments.tenants > 0):
+            benchmarkBatch(arguments.tenants, arguments.max_concurrent)
+        if(arguments.load > 0):
+            benchmarkLoad(arguments.load, arguments.throttle_rate)
+        if(arguments.pool):
+            benchmarkPool()
+        if(arguments.upload):
+            benchmarkUpload()
+        if(arguments.bake):
+            benchmarkBake()
+        if(arguments.destroy):
+            benchmarkDestroy()
+        if(arguments.provision > 0):
+            benchmarkProvisioning(arguments.provision)
+        if(arguments.advisor):
+            benchmarkAdvisor()
+        if(arguments.startup):
+            benchmarkStartup()
+        if(arguments.suite):
+            sys.exit(benchmarkSuite(arguments.throttle_rate, arguments.failure_rate, arguments.baseline, arguments.save_baseline))
+    elif(arguments.command == 'simulate'):
+        if(arguments.sandbox_results):
+            results = simulateBatch(arguments.tenants, arguments.max_concurrent, arguments.throttle_rate, arguments.failure_rate, arguments.jitter, arguments.pool_size, arguments.seed)
+            with open(arguments.sandbox_results, 'w') as resultsFile:
+                json.dump(results, resultsFile, indent=2)
+        else:
+            results = runSimulation(arguments.tenants, arguments.max_concurrent, arguments.throttle_rate, arguments.failure_rate, arguments.jitter, arguments.pool_size, arguments.seed)
+            print('\nSimulated %d environments (%d failing stack%s): %d built in %s (%.1f environments/hour), %d CloudFormation API calls (%.1f per environment), %d throttled; %.2f s real time' % (results['tenants'], results['failingStacks'], '' if results['failingStacks'] == 1 else 's', results['built'], sbit.formatDuration(results['simulatedSeconds']), results['environmentsPerHour'], results['apiCalls'], results['apiCallsPerBuild'], results['throttles'], results['realSeconds']))
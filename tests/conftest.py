@@ -0,0 +1,25 @@
+#sbit-master.py keeps its caches, checkpoints, and history under the home directory, and works out those
+#paths when it is loaded, so the tests get a throwaway home directory (and no AWS settings) before it is
+import os
+import sys
+import tempfile
+
+import pytest
+
+for name in list(os.environ):
+    if(name.startswith('AWS_')):
+        del os.environ[name]
+os.environ['HOME'] = os.environ['USERPROFILE'] = tempfile.mkdtemp(prefix='sbit-tests-')
+os.environ['AWS_DEFAULT_REGION'] = 'us-east-2'
+os.environ['SBIT_ARTIFACT_BUCKET'] = 'sbit-tests'
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulation import sbit
+
+#Put back the module-level AWS session and clients each test replaces with stand-ins
+@pytest.fixture(autouse=True)
+def restoreClients():
+    clients = {name : getattr(sbit, name) for name in ['awsSession', 'cloudFormationClient', 'ec2Client', 's3Client', 'ssmClient']}
+    yield
+    for name, client in clients.items():
+        setattr(sbit, name, client)
@@ -0,0 +1,467 @@
+#Offline stand-ins for the AWS services SBIT uses, on a simulated clock, shared by the tests and benchmark.py
+#sbit-master.py is a script rather than a package, so it is loaded from its path as the module "sbit"
+import datetime
+import hashlib
+import json
+import importlib.util
+import os
+import random
+import re
+import threading
+import time
+import types
+
+SBIT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sbit-master.py')
+
+def loadSbit():
+    spec = importlib.util.spec_from_file_location('sbit', SBIT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+sbit = loadSbit()
+
+#The stand-ins raise botocore's ClientError as AWS would; without botocore installed they raise this local
+#equivalent instead, and sbit catches it in its place, since nothing else could raise a ClientError
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            self.response = error_response
+            self.operation_name = operation_name
+            super().__init__('An error occurred (%s) when calling the %s operation: %s' % (error_response['Error']['Code'], operation_name, error_response['Error'].get('Message')))
+    sbit.getClientError = lambda: ClientError
+
+#Typical build time of each stack in minutes
+BENCHMARK_STACK_MINUTES = {
+    sbit.networkStackName : 5,
+    sbit.adStackName : 28,
+    sbit.fsStackName : 12,
+    sbit.exchStackName : 110,
+}
+
+#Stand-in for the boto3 session, which SBIT only asks for the profile and region it resolved (the clients are
+#stand-ins of their own)
+def getFakeSession(profileName='simulation', region='us-east-2'):
+    return types.SimpleNamespace(profile_name=profileName, region_name=region)
+
+#Simulated clock so the benchmark can "wait" for hours of build time instantly
+class VirtualClock:
+    def __init__(self):
+        self.currentTime = 0.0
+
+    def now(self):
+        return self.currentTime
+
+    def sleep(self, seconds):
+        self.currentTime += seconds
+
+#Stand-in for the CloudFormation client that "builds" each stack in a fixed, configurable amount of time
+#Allows scheduling and polling to be exercised without AWS credentials or hours of real build time
+#Stacks named in failingStacks end in CREATE_FAILED instead of CREATE_COMPLETE
+#A throttleRate fraction of create_stack, describe_stacks, and describe_stack_events calls fail with a Throttling error
+#Stacks missing from stackSeconds (ex. network pool stacks) take defaultStackSeconds; updates take updateSeconds
+#Deleting a stack takes deleteSeconds[stackName] (default: instant), after which it disappears from describe_stacks
+#setStackStatus puts a stack in any other state (ex. one left behind by an earlier run) until it is deleted
+#Like CloudFormation, update_stack rejects a stack that is mid-operation with a ValidationError
+#Change sets are described as soon as they are created; executing one updates the stack's parameters
+class FakeCloudFormationClient:
+    def __init__(self, stackSeconds, clock, throttleRate=0.0, failingStacks=(), defaultStackSeconds=0, updateSeconds=0, deleteSeconds=None):
+        self.stackSeconds = stackSeconds
+        self.clock = clock
+        self.throttleRate = throttleRate
+        self.failingStacks = set(failingStacks)
+        self.defaultStackSeconds = defaultStackSeconds
+        self.updateSeconds = updateSeconds
+        self.deleteSeconds = deleteSeconds or {}
+        self.stackStartTimes = {}
+        self.updateStartTimes = {}
+        self.deleteStartTimes = {}
+        self.stackTags = {}
+        self.stackParameters = {}
+        self.statusOverrides = {}
+        self.changeSets = {}
+        self.apiCalls = 0
+        #Builds call the client from several threads at once
+        self.lock = threading.Lock()
+
+    def create_stack(self, StackName, Tags=(), Parameters=(), **kwargs):
+        with self.lock:
+            throttled = random.random() < self.throttleRate
+            self.countCall('CreateStack', 'Throttling' if throttled else None)
+            if(throttled):
+                raise ClientError({'Error' : {'Code' : 'Throttling', 'Message' : 'Rate exceeded'}}, 'CreateStack')
+            self.purgeDeletedStacks()
+            if(StackName in self.stackStartTimes):
+                raise ClientError({'Error' : {'Code' : 'AlreadyExistsException', 'Message' : 'Stack [%s] already exists' % (StackName)}}, 'CreateStack')
+            self.stackStartTimes[StackName] = self.clock.now()
+            self.stackTags[StackName] = list(Tags)
+            self.stackParameters[StackName] = {parameter['ParameterKey'] : str(parameter['ParameterValue']) for parameter in Parameters}
+            return {'StackId' : StackName}
+
+    def update_stack(self, StackName, Tags=None, **kwargs):
+        with self.lock:
+            self.countCall('UpdateStack')
+            self.purgeDeletedStacks()
+            if(not StackName in self.stackStartTimes):
+                raise ClientError({'Error' : {'Code' : 'ValidationError', 'Message' : 'Stack [%s] does not exist' % (StackName)}}, 'UpdateStack')
+            if(self.stackStatus(StackName).endswith('_IN_PROGRESS')):
+                raise ClientError({'Error' : {'Code' : 'ValidationError', 'Message' : 'Stack:%s is in %s state and can not be updated.' % (StackName, self.stackStatus(StackName))}}, 'UpdateStack')
+            self.updateStartTimes[StackName] = self.clock.now()
+            if(Tags is not None):
+                self.stackTags[StackName] = list(Tags)
+            return {'StackId' : StackName}
+
+    def delete_stack(self, StackName):
+        with self.lock:
+            self.countCall('DeleteStack')
+            if(StackName in self.stackStartTimes):
+                self.deleteStartTimes.setdefault(StackName, self.clock.now())
+            return {}
+
+    def create_change_set(self, StackName, ChangeSetName, Parameters=(), **kwargs):
+        with self.lock:
+            self.countCall('CreateChangeSet')
+            parameters = dict(self.stackParameters[StackName])
+            for parameter in Parameters:
+                if(not parameter.get('UsePreviousValue')):
+                    parameters[parameter['ParameterKey']] = str(parameter['ParameterValue'])
+            self.changeSets[(StackName, ChangeSetName)] = parameters
+            return {'Id' : ChangeSetName, 'StackId' : StackName}
+
+    #Every changed parameter is reported as a change to the stack's single resource
+    def describe_change_set(self, ChangeSetName, StackName):
+        with self.lock:
+            self.countCall('DescribeChangeSet')
+            parameters = self.changeSets[(StackName, ChangeSetName)]
+            if(parameters == self.stackParameters[StackName]):
+                return {'Status' : 'FAILED', 'StatusReason' : "The submitted information didn't contain changes. Submit different information to create a change set."}
+            changes = [{'ResourceChange' : {'Action' : 'Modify', 'LogicalResourceId' : StackName, 'ResourceType' : 'AWS::CloudFormation::Stack', 'Replacement' : 'False'}}]
+            return {'Status' : 'CREATE_COMPLETE', 'Changes' : changes}
+
+    def execute_change_set(self, ChangeSetName, StackName):
+        with self.lock:
+            self.countCall('ExecuteChangeSet')
+            self.stackParameters[StackName] = self.changeSets.pop((StackName, ChangeSetName))
+            self.updateStartTimes[StackName] = self.clock.now()
+            return {}
+
+    def delete_change_set(self, ChangeSetName, StackName):
+        with self.lock:
+            self.countCall('DeleteChangeSet')
+            self.changeSets.pop((StackName, ChangeSetName), None)
+            return {}
+
+    #Report stackStatus for the stack from afterSeconds from now until it is deleted
+    def setStackStatus(self, stackName, stackStatus, afterSeconds=0):
+        self.statusOverrides.setdefault(stackName, []).append((self.clock.now() + afterSeconds, stackStatus))
+
+    #Calls are counted here and in the run's metrics, as boto3 calls would be
+    def countCall(self, operation, errorCode=None):
+        self.apiCalls += 1
+        sbit.recordAwsCall('cloudformation', operation, errorCode)
+
+    #Forget stacks whose deletion has finished
+    def purgeDeletedStacks(self):
+        for stackName, deleteStartTime in list(self.deleteStartTimes.items()):
+            if(self.clock.now() >= deleteStartTime + self.deleteSeconds.get(stackName, 0)):
+                for stackValues in [self.stackStartTimes, self.updateStartTimes, self.deleteStartTimes, self.stackTags, self.stackParameters, self.statusOverrides]:
+                    stackValues.pop(stackName, None)
+
+    def stackStatus(self, stackName):
+        if(stackName in self.deleteStartTimes):
+            return 'DELETE_IN_PROGRESS'
+        currentOverrides = [stackStatus for startTime, stackStatus in self.statusOverrides.get(stackName, []) if startTime <= self.clock.now()]
+        if(currentOverrides):
+            return currentOverrides[-1]
+        if(stackName in self.updateStartTimes):
+            return 'UPDATE_IN_PROGRESS' if self.clock.now() < self.updateStartTimes[stackName] + self.updateSeconds else 'UPDATE_COMPLETE'
+        if(self.clock.now() < self.stackStartTimes[stackName] + self.stackSeconds.get(stackName, self.defaultStackSeconds)):
+            return 'CREATE_IN_PROGRESS'
+        return 'CREATE_FAILED' if stackName in self.failingStacks else 'CREATE_COMPLETE'
+
+    def describe_stacks(self, StackName=None):
+        with self.lock:
+            throttled = random.random() < self.throttleRate
+            self.countCall('DescribeStacks', 'Throttling' if throttled else None)
+            if(throttled):
+                raise ClientError({'Error' : {'Code' : 'Throttling', 'Message' : 'Rate exceeded'}}, 'DescribeStacks')
+            self.purgeDeletedStacks()
+            if(StackName is not None and not StackName in self.stackStartTimes):
+                raise ClientError({'Error' : {'Code' : 'ValidationError', 'Message' : 'Stack with id %s does not exist' % (StackName)}}, 'DescribeStacks')
+            stackNames = [StackName] if StackName is not None else list(self.stackStartTimes)
+            stacks = []
+            for stackName in stackNames:
+                stacks.append({'StackId' : stackName, 'StackName' : stackName, 'StackStatus' : self.stackStatus(stackName), 'Tags' : self.stackTags.get(stackName, []), 'Parameters' : [{'ParameterKey' : parameterName, 'ParameterValue' : parameterValue} for parameterName, parameterValue in self.stackParameters.get(stackName, {}).items()], 'CreationTime' : self.stackStartTimes[stackName]})
+            return {'Stacks' : stacks}
+
+    #Each fake stack reports a single resource: the stack itself, created then completed
+    def describe_stack_events(self, StackName):
+        with self.lock:
+            throttled = random.random() < self.throttleRate
+            self.countCall('DescribeStackEvents', 'Throttling' if throttled else None)
+            if(throttled):
+                raise ClientError({'Error' : {'Code' : 'Throttling', 'Message' : 'Rate exceeded'}}, 'DescribeStackEvents')
+            startTime = self.stackStartTimes[StackName]
+            events = [(startTime, 'CREATE_IN_PROGRESS')]
+            if(self.stackStatus(StackName) != 'CREATE_IN_PROGRESS'):
+                events.append((startTime + self.stackSeconds.get(StackName, self.defaultStackSeconds), self.stackStatus(StackName)))
+            stackEvents = []
+            for eventTime, resourceStatus in reversed(events):
+                stackEvents.append({
+                    'EventId' : '%s-%s' % (StackName, resourceStatus),
+                    'LogicalResourceId' : StackName,
+                    'ResourceType' : 'AWS::CloudFormation::Stack',
+                    'ResourceStatus' : resourceStatus,
+                    'Timestamp' : datetime.datetime.fromtimestamp(eventTime, datetime.timezone.utc),
+                })
+            return {'StackEvents' : stackEvents}
+
+    def get_paginator(self, operationName):
+        if(operationName == 'describe_stack_events'):
+            return FakePaginator(self.describe_stack_events)
+        return FakePaginator(self.describe_stacks)
+
+    def get_waiter(self, waiterName):
+        return FakeStackWaiter(self, waiterName)
+
+class FakePaginator:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        yield self.operation(**kwargs)
+
+#Mimics the polling behaviour of the boto3 stack_create_complete and stack_delete_complete waiters
+class FakeStackWaiter:
+    def __init__(self, client, waiterName='stack_create_complete'):
+        self.client = client
+        self.waiterName = waiterName
+
+    def wait(self, StackName, WaiterConfig=None):
+        delay = (WaiterConfig or {}).get('Delay', 30)
+        if(self.waiterName == 'stack_delete_complete'):
+            #The delete waiter succeeds once describe_stacks reports the stack no longer exists
+            while(True):
+                try:
+                    self.client.describe_stacks(StackName=StackName)
+                except ClientError:
+                    return
+                self.client.clock.sleep(delay)
+        while(self.client.describe_stacks(StackName=StackName)['Stacks'][0]['StackStatus'] != 'CREATE_COMPLETE'):
+            self.client.clock.sleep(delay)
+
+#Simulated time to delete each role's stack, in minutes
+BENCHMARK_DELETE_MINUTES = {'network' : 3, 'ad' : 7, 'fs' : 5, 'exchange' : 12}
+
+#Simulated time for a builder to install and sysprep each role, and for EC2 to write an image, in minutes
+BENCHMARK_BAKE_MINUTES = {'ad' : 15, 'fs' : 15, 'exchange' : 50}
+BENCHMARK_IMAGE_MINUTES = 10
+
+#Modeled Run Command times: delivering a command and starting PowerShell, then creating one user or mailbox
+BENCHMARK_COMMAND_SECONDS = 4
+BENCHMARK_USER_SECONDS = {'users' : 0.5, 'mailboxes' : 2.0}
+
+#Stand-in for the EC2 client used by bakeImages: builders stop (as sysprep would) after a fixed time per
+#role, read from their sbit-bake-<role>-<version> Name tag, and images become available after imageSeconds
+class FakeEc2Client:
+    def __init__(self, configureSeconds, imageSeconds, clock, region='us-east-2', keyPairs=('bench',)):
+        self.configureSeconds = configureSeconds
+        self.imageSeconds = imageSeconds
+        self.clock = clock
+        self.keyPairs = list(keyPairs)
+        self.meta = types.SimpleNamespace(region_name=region)
+        self.instances = {}
+        self.images = {}
+        self.apiCalls = 0
+
+    def run_instances(self, TagSpecifications, **kwargs):
+        self.apiCalls += 1
+        instanceId = 'i-%017x' % (len(self.instances) + 1)
+        stackRole = TagSpecifications[0]['Tags'][0]['Value'].split('-')[2]
+        self.instances[instanceId] = {'stopTime' : self.clock.now() + self.configureSeconds[stackRole], 'terminated' : False}
+        return {'Instances' : [{'InstanceId' : instanceId}]}
+
+    def describe_instances(self, InstanceIds):
+        self.apiCalls += 1
+        instances = []
+        for instanceId in InstanceIds:
+            instance = self.instances[instanceId]
+            if(instance['terminated']):
+                state = 'terminated'
+            else:
+                state = 'stopped' if self.clock.now() >= instance['stopTime'] else 'running'
+            instances.append({'InstanceId' : instanceId, 'State' : {'Name' : state}})
+        return {'Reservations' : [{'Instances' : instances}]}
+
+    def create_image(self, InstanceId, Name, Description=None):
+        self.apiCalls += 1
+        imageId = 'ami-%017x' % (len(self.images) + 1)
+        self.images[imageId] = self.clock.now() + self.imageSeconds
+        return {'ImageId' : imageId}
+
+    def describe_images(self, ImageIds):
+        self.apiCalls += 1
+        return {'Images' : [{'ImageId' : imageId, 'State' : 'available' if self.clock.now() >= self.images[imageId] else 'pending'} for imageId in ImageIds]}
+
+    def terminate_instances(self, InstanceIds):
+        self.apiCalls += 1
+        for instanceId in InstanceIds:
+            self.instances[instanceId]['terminated'] = True
+        return {}
+
+    def describe_key_pairs(self):
+        self.apiCalls += 1
+        return {'KeyPairs' : [{'KeyName' : keyName} for keyName in self.keyPairs]}
+
+#Local stand-in for S3: objects are kept in memory and every put takes putSeconds of real time, so the
+#effect of uploading in parallel can be measured without AWS
+class FakeS3Client:
+    def __init__(self, putSeconds=0.0, region='us-east-2'):
+        self.putSeconds = putSeconds
+        self.meta = types.SimpleNamespace(region_name=region)
+        self.objects = {}
+        self.apiCalls = 0
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        time.sleep(self.putSeconds)
+        with self.lock:
+            self.apiCalls += 1
+            self.objects[(Bucket, Key)] = Body
+        return {}
+
+    #Signing happens locally, so it is not an API call
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return '%s?X-Amz-Expires=%d&X-Amz-Signature=%s' % (sbit.getArtifactUrl(Params['Bucket'], self.meta.region_name, Params['Key']), ExpiresIn, hashlib.sha256(os.urandom(16)).hexdigest())
+
+    def list_objects_v2(self, Bucket, Prefix=''):
+        with self.lock:
+            self.apiCalls += 1
+        return {'Contents' : [{'Key' : key} for bucket, key in sorted(self.objects) if bucket == Bucket and key.startswith(Prefix)]}
+
+    def get_paginator(self, operationName):
+        return FakePaginator(self.list_objects_v2)
+
+#Stand-in for the Systems Manager client that "runs" provisioning scripts on a simulated clock
+#Each command takes commandSeconds (delivery, PowerShell start, and module load) plus userSeconds[stage] per user
+#A failureRate fraction of users fail each time they are run; users and mailboxes that were created are
+#remembered, so retried and repeated scripts skip them as the real scripts do
+#A throttleRate fraction of send_command calls fail with a ThrottlingException
+class FakeSsmClient:
+    def __init__(self, clock, commandSeconds, userSeconds, failureRate=0.0, throttleRate=0.0, offlineIds=()):
+        self.clock = clock
+        self.commandSeconds = commandSeconds
+        self.userSeconds = userSeconds
+        self.failureRate = failureRate
+        self.throttleRate = throttleRate
+        self.offlineIds = set(offlineIds)
+        self.instanceIds = set()
+        self.created = {'users' : set(), 'mailboxes' : set()}
+        self.parameters = {}
+        self.commands = {}
+        self.apiCalls = 0
+
+    def describe_instance_information(self, Filters=()):
+        self.apiCalls += 1
+        instanceIds = [instanceId for instanceFilter in Filters if instanceFilter['Key'] == 'InstanceIds' for instanceId in instanceFilter['Values']]
+        return {'InstanceInformationList' : [{'InstanceId' : instanceId, 'PingStatus' : 'ConnectionLost' if instanceId in self.offlineIds else 'Online'} for instanceId in instanceIds]}
+
+    def get_paginator(self, operationName):
+        return FakePaginator(getattr(self, operationName))
+
+    def put_parameter(self, Name, Value, Type='String', Overwrite=False, **kwargs):
+        self.apiCalls += 1
+        if(Name in self.parameters and not Overwrite):
+            raise ClientError({'Error' : {'Code' : 'ParameterAlreadyExists', 'Message' : 'The parameter already exists.'}}, 'PutParameter')
+        self.parameters[Name] = {'Value' : Value, 'Type' : Type}
+        return {'Version' : 1}
+
+    def delete_parameter(self, Name):
+        self.apiCalls += 1
+        if(self.parameters.pop(Name, None) is None):
+            raise ClientError({'Error' : {'Code' : 'ParameterNotFound', 'Message' : 'Parameter %s not found.' % (Name)}}, 'DeleteParameter')
+        return {}
+
+    #User scripts fail every user if the password parameter they read is missing, as Get-SSMParameter would
+    def send_command(self, InstanceIds, Parameters, **kwargs):
+        self.apiCalls += 1
+        if(random.random() < self.throttleRate):
+            raise ClientError({'Error' : {'Code' : 'ThrottlingException', 'Message' : 'Rate exceeded'}}, 'SendCommand')
+        script = Parameters['commands'][0]
+        stage = 'mailboxes' if 'Enable-Mailbox' in script else 'users'
+        accountNames = [name.replace("\'\'", "\'") for name in re.findall(r"@\{Sam='((?:[^']|'')*)'", script)]
+        passwordParameter = re.search(r"Get-SSMParameter -Name '([^']*)'", script)
+        passwords = json.loads(self.parameters[passwordParameter.group(1)]['Value']) if passwordParameter and passwordParameter.group(1) in self.parameters else {}
+        output = []
+        counts = {'created' : 0, 'existing' : 0, 'failed' : 0}
+        for accountName in accountNames:
+            if(accountName in self.created[stage]):
+                counts['existing'] += 1
+            elif(stage == 'users' and accountName not in passwords):
+                counts['failed'] += 1
+                output.append('%s %s: ParameterNotFound' % (sbit.PROVISIONING_FAILURE_PREFIX, accountName))
+            elif(random.random() < self.failureRate):
+                counts['failed'] += 1
+                output.append('%s %s: The server is not operational' % (sbit.PROVISIONING_FAILURE_PREFIX, accountName))
+            else:
+                counts['created'] += 1
+                self.created[stage].add(accountName)
+        output.append('%s created=%d existing=%d failed=%d' % (sbit.PROVISIONING_RESULT_PREFIX, counts['created'], counts['existing'], counts['failed']))
+        commandId = '%08x-0000-0000-0000-000000000000' % (len(self.commands) + 1)
+        self.commands[commandId] = {
+            'finishTime' : self.clock.now() + self.commandSeconds + self.userSeconds[stage] * len(accountNames),
+            'status' : 'Failed' if counts['failed'] else 'Success',
+            'output' : '\n'.join(output) + '\n',
+            'script' : script,
+        }
+        return {'Command' : {'CommandId' : commandId, 'InstanceIds' : InstanceIds}}
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        self.apiCalls += 1
+        command = self.commands[CommandId]
+        if(self.clock.now() < command['finishTime']):
+            return {'CommandId' : CommandId, 'InstanceId' : InstanceId, 'Status' : 'InProgress', 'StandardOutputContent' : ''}
+        return {'CommandId' : CommandId, 'InstanceId' : InstanceId, 'Status' : command['status'], 'StatusDetails' : command['status'], 'StandardOutputContent' : command['output']}
+
+#Valid settings for one benchmark tenant's environment
+def getBenchmarkEnvironment(tenant):
+    return {
+        'tenant' : tenant, 'domainName' : '%s.example.com' % (tenant.lower()), 'netBiosName' : tenant.upper(),
+        'keyPair' : 'bench', 'numDcs' : sbit.MIN_DCS, 'numFileServers' : sbit.MIN_DCS, 'volumeSize' : '50', 'exchVolumeSize' : '64',
+        'dcInstanceType' : 't2.micro', 'fsInstanceType' : 't2.micro', 'exchInstanceType' : 'r4.large',
+        'adminUsername' : 'benchadmin', 'adminPassword' : 'Bench-Pass1', 'restoreModePassword' : 'Bench-Pass1', 'publicIp' : '203.0.113.10',
+    }
+
+#One tenant's four stacks, wired as createStackGraph wires them, each creating a stack on the stand-in client
+#(without the templates and parameters a real build needs)
+def getBenchmarkStackGraph(tenant):
+    stackNames = sbit.getStackNames(tenant)
+    stackGraph = []
+    for role, parentRoles in [('network', []), ('ad', ['network']), ('fs', ['network', 'ad']), ('exchange', ['network', 'ad'])]:
+        stackGraph.append({
+            'name' : stackNames[role],
+            'label' : '%s: %s' % (tenant, sbit.STACK_LABELS[role]),
+            'group' : tenant,
+            'role' : role,
+            'dependsOn' : [stackNames[parentRole] for parentRole in parentRoles],
+            'expectedSeconds' : getBenchmarkStackSeconds(role),
+            'timeoutSeconds' : 3*60*60,
+            'create' : (lambda name: lambda: sbit.cloudFormationClient.create_stack(StackName=name))(stackNames[role]),
+        })
+    return stackGraph
+
+#Typical build time of a stack of the given role, in seconds
+def getBenchmarkStackSeconds(role):
+    return BENCHMARK_STACK_MINUTES[sbit.STACK_NAME_FORMATS[role] % (sbit.DEFAULT_TENANT)] * 60
+
+#Build stackGraph on a stand-in client and a simulated clock, with a StackPoller that follows stack events
+#Returns the clock, client, and poller, for checking when each stack started and what the build cost
+def runBenchmarkStackGraph(stackGraph, failingStacks=(), maxConcurrentGroups=None, throttleRate=0.0):
+    clock = VirtualClock()
+    stackSeconds = {node['name'] : getBenchmarkStackSeconds(node['role']) for node in stackGraph}
+    client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, throttleRate, failingStacks)
+    poller = sbit.StackPoller(client, clock.now, clock.sleep, sbit.StackEventTail(client))
+    sbit.runStackGraph(stackGraph, poller, maxConcurrentGroups=maxConcurrentGroups, raiseOnFailure=False)
+    return clock, client, poller
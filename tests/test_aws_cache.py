@@ -0,0 +1,16 @@
+from simulation import sbit, getFakeSession
+
+def testEntriesAreKeptApartBySessionProfileAndRegion(monkeypatch):
+    lookups = []
+    def lookup():
+        lookups.append((sbit.awsSession.profile_name, sbit.awsSession.region_name))
+        return 'value %d' % (len(lookups))
+    #The environment is the same for every session; only what each session resolved differs
+    monkeypatch.setattr(sbit, 'awsSession', getFakeSession('default', 'us-east-2'))
+    assert sbit.getCachedAwsValue('cache-test', lookup) == 'value 1'
+    assert sbit.getCachedAwsValue('cache-test', lookup) == 'value 1'
+    monkeypatch.setattr(sbit, 'awsSession', getFakeSession('default', 'eu-west-1'))
+    assert sbit.getCachedAwsValue('cache-test', lookup) == 'value 2'
+    monkeypatch.setattr(sbit, 'awsSession', getFakeSession('customer', 'us-east-2'))
+    assert sbit.getCachedAwsValue('cache-test', lookup) == 'value 3'
+    assert lookups == [('default', 'us-east-2'), ('default', 'eu-west-1'), ('customer', 'us-east-2')]
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from simulation import sbit, VirtualClock, FakeEc2Client, BENCHMARK_BAKE_MINUTES, BENCHMARK_IMAGE_MINUTES
+
+def getEc2Client(clock, bakeMinutes=BENCHMARK_BAKE_MINUTES):
+    return FakeEc2Client({role : minutes * 60 for role, minutes in bakeMinutes.items()}, BENCHMARK_IMAGE_MINUTES * 60, clock)
+
+def bake(tmp_path, ec2, clock):
+    return sbit.bakeImages(list(sbit.BAKE_RECIPES), ec2, os.path.join(tmp_path, 'ami-catalog.json'), clock=clock.now, sleep=clock.sleep)
+
+def testBakedImagesAreCataloguedAndBuildersTerminated(tmp_path):
+    clock = VirtualClock()
+    ec2 = getEc2Client(clock)
+    assert sorted(bake(tmp_path, ec2, clock)) == sorted(sbit.BAKE_RECIPES)
+    assert all(instance['terminated'] for instance in ec2.instances.values())
+    apiCalls = ec2.apiCalls
+    bake(tmp_path, ec2, clock)
+    assert ec2.apiCalls == apiCalls
+
+def testBuildersAreTerminatedWhenBakingTimesOut(tmp_path):
+    clock = VirtualClock()
+    ec2 = getEc2Client(clock, dict(BENCHMARK_BAKE_MINUTES, exchange=sbit.BAKE_TIMEOUT // 60 * 2))
+    with pytest.raises(RuntimeError):
+        bake(tmp_path, ec2, clock)
+    assert len(ec2.instances) == len(sbit.BAKE_RECIPES)
+    assert all(instance['terminated'] for instance in ec2.instances.values())
+
+def testBuildersAreTerminatedWhenAnAwsCallFails(tmp_path):
+    clock = VirtualClock()
+    ec2 = getEc2Client(clock)
+    def failCreateImage(**kwargs):
+        raise RuntimeError('create_image failed')
+    ec2.create_image = failCreateImage
+    with pytest.raises(RuntimeError):
+        bake(tmp_path, ec2, clock)
+    assert ec2.instances
+    assert all(instance['terminated'] for instance in ec2.instances.values())
@@ -0,0 +1,36 @@
+import csv
+import os
+
+from simulation import sbit, VirtualClock, FakeCloudFormationClient, FakeEc2Client, FakeS3Client, getBenchmarkEnvironment, getBenchmarkStackSeconds, getFakeSession
+
+#Build a manifest of tenantCount environments with runBatch against the stand-ins
+#Returns runBatch's exit code and the poller it was given
+def runManifest(tmp_path, tenants, poller=None):
+    environments = [getBenchmarkEnvironment(tenant) for tenant in tenants]
+    stackSeconds = {stackName : getBenchmarkStackSeconds(role) for tenant in tenants for role, stackName in sbit.getStackNames(tenant).items()}
+    clock = VirtualClock()
+    sbit.awsSession = getFakeSession()
+    sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock)
+    sbit.ec2Client = FakeEc2Client({}, 0, clock)
+    sbit.s3Client = FakeS3Client()
+    manifestPath = os.path.join(tmp_path, 'manifest.csv')
+    with open(manifestPath, 'w', newline='') as manifestFile:
+        writer = csv.DictWriter(manifestFile, [field for field, validator, message in sbit.MANIFEST_FIELDS])
+        writer.writeheader()
+        writer.writerows(environments)
+    if(poller is None):
+        poller = sbit.StackPoller(sbit.cloudFormationClient, clock.now, clock.sleep)
+    return sbit.runBatch(manifestPath, poller=poller), poller
+
+def testBatchRecordsTimingsFromTheEventTailItFollowed(tmp_path, monkeypatch):
+    recordedTails = []
+    recordBuildTimings = sbit.recordBuildTimings
+    def recordTail(stackGraph, eventTail, buildHistory):
+        recordedTails.append(eventTail)
+        return recordBuildTimings(stackGraph, eventTail, buildHistory)
+    monkeypatch.setattr(sbit, 'recordBuildTimings', recordTail)
+    exitCode, poller = runManifest(tmp_path, ['Batch1', 'Batch2'])
+    assert exitCode == 0
+    assert recordedTails == [poller.eventTail]
+    followedStacks = set(stackName for stackName, logicalId in poller.eventTail.resourceTimings)
+    assert followedStacks == set(stackName for tenant in ['Batch1', 'Batch2'] for stackName in sbit.getStackNames(tenant).values())
@@ -0,0 +1,41 @@
+import random
+
+import benchmark
+from simulation import sbit, getBenchmarkStackGraph, runBenchmarkStackGraph
+
+def getBatchGraph(tenantCount):
+    stackGraph = []
+    for tenantNumber in range(1, tenantCount + 1):
+        stackGraph.extend(getBenchmarkStackGraph('Poll%03d' % (tenantNumber)))
+    return stackGraph
+
+def testOneDescribeCallWatchesEveryStack():
+    clock, client, singlePoller = runBenchmarkStackGraph(getBatchGraph(1))
+    clock, client, batchPoller = runBenchmarkStackGraph(getBatchGraph(25))
+    assert batchPoller.apiCalls <= singlePoller.apiCalls * 1.5
+
+def testPollsSlowDownWhileStacksAreFarFromDone():
+    clock, client, poller = runBenchmarkStackGraph(getBatchGraph(1))
+    assert poller.apiCalls < clock.now() / sbit.MIN_POLL_INTERVAL / 4
+
+def testThrottledPollsBackOffAndFinish():
+    random.seed(0)
+    stackGraph = getBatchGraph(5)
+    clock, client, poller = runBenchmarkStackGraph(stackGraph, throttleRate=0.2)
+    assert all(node['status'] == 'CREATE_COMPLETE' for node in stackGraph)
+    assert poller.throttles > 0
+    assert clock.now() <= sbit.estimateCriticalPath(stackGraph) + 10 * sbit.MAX_POLL_INTERVAL
+
+def testEveryStackEventIsFollowedOnce():
+    stackGraph = getBatchGraph(10)
+    clock, client, poller = runBenchmarkStackGraph(stackGraph)
+    eventTail = poller.eventTail
+    assert not eventTail.followedStacks
+    assert not poller.trackedStacks
+    for node in stackGraph:
+        timing = eventTail.resourceTimings[(node['name'], node['name'])]
+        assert timing['status'] == 'CREATE_COMPLETE'
+        assert (timing['end'] - timing['start']).total_seconds() == client.stackSeconds[node['name']]
+
+def testLoadOfManyBuildsFinishes():
+    assert benchmark.benchmarkLoad(50) == 50
@@ -0,0 +1,65 @@
+import os
+
+from simulation import sbit, VirtualClock, FakeCloudFormationClient, FakeS3Client, getBenchmarkEnvironment, getBenchmarkStackSeconds
+
+#Warm poolSize network stacks, give the tenant's network node one of them, and have another build start
+#claiming that stack before this build gets to it
+#Returns the clock, client, environment, stack graph, and the stolen stack's name, after the graph is built
+def buildWithStolenPoolStack(tmp_path, poolSize, tenant='Pool1'):
+    environment = getBenchmarkEnvironment(tenant)
+    stackSeconds = {stackName : getBenchmarkStackSeconds(role) for role, stackName in sbit.getStackNames(tenant).items()}
+    clock = VirtualClock()
+    client = sbit.cloudFormationClient = FakeCloudFormationClient(stackSeconds, clock, defaultStackSeconds=getBenchmarkStackSeconds('network'), updateSeconds=sbit.POOL_CLAIM_SECONDS)
+    poolPath = os.path.join(tmp_path, 'network-pool.json')
+    sbit.saveNetworkPoolSize(poolSize, poolPath)
+    stackGraph = sbit.createStackGraph(environment)
+    sbit.publishStackTemplates(stackGraph, FakeS3Client(), 'sbit-tests')
+    sbit.refillNetworkPool(client, poolSize, stackGraph[0]['templateUrl'], sleep=clock.sleep)
+    clock.sleep(getBenchmarkStackSeconds('network'))
+    sbit.claimPooledNetworks(stackGraph, [environment], sbit.BuildHistory(':memory:'), client, poolPath, clock.sleep)
+    stolenStackName = environment['networkStackName']
+    client.update_stack(StackName=stolenStackName, UsePreviousTemplate=True)
+    sbit.runStackGraph(stackGraph, sbit.StackPoller(client, clock.now, clock.sleep), raiseOnFailure=False)
+    return clock, client, environment, stackGraph, stolenStackName
+
+def getNetworkStackParameter(node):
+    return [parameter['ParameterValue'] for parameter in node['parameters'] if parameter['ParameterKey'] == 'NetworkStackName'][0]
+
+def testClaimMovesOnToTheNextPoolStack(tmp_path):
+    clock, client, environment, stackGraph, stolenStackName = buildWithStolenPoolStack(tmp_path, 3)
+    claimedStackName = environment['networkStackName']
+    assert claimedStackName != stolenStackName
+    assert {tag['Key'] : tag['Value'] for tag in client.stackTags[claimedStackName]} == {sbit.POOL_TAG : 'claimed', sbit.TENANT_TAG : 'Pool1'}
+    for node in stackGraph:
+        if(node['role'] != 'network'):
+            assert getNetworkStackParameter(node) == claimedStackName
+        assert node['status'] in sbit.STACK_BUILT_STATUSES
+
+def testClaimBuildsTheTenantsNetworkOnceThePoolRunsOut(tmp_path):
+    clock, client, environment, stackGraph, stolenStackName = buildWithStolenPoolStack(tmp_path, 1)
+    networkStackName = sbit.getStackNames('Pool1')['network']
+    assert 'networkStackName' not in environment
+    assert client.stackParameters[networkStackName]['CustPubIp'] == environment['publicIp']
+    networkNode = [node for node in stackGraph if node['role'] == 'network'][0]
+    assert networkNode['action'] == 'Build'
+    for node in stackGraph:
+        if(node['role'] != 'network'):
+            assert getNetworkStackParameter(node) == networkStackName
+            #A fresh network stack has to finish before anything imports its VPC
+            assert node['startTime'] >= networkNode['startTime'] + getBenchmarkStackSeconds('network')
+        assert node['status'] == 'CREATE_COMPLETE'
+
+def testRefillOnlyDeletesFailedPoolStacks(tmp_path):
+    clock = VirtualClock()
+    client = FakeCloudFormationClient({}, clock, updateSeconds=60)
+    sbit.refillNetworkPool(client, 3, 'https://sbit-tests.s3.amazonaws.com/network.yaml', sleep=clock.sleep)
+    claimingStackName, rolledBackStackName, failedStackName = sorted(client.stackStartTimes)
+    client.update_stack(StackName=claimingStackName)
+    client.setStackStatus(rolledBackStackName, 'UPDATE_ROLLBACK_COMPLETE')
+    client.setStackStatus(failedStackName, 'ROLLBACK_COMPLETE')
+    pool = sbit.listNetworkPool(client, clock.sleep)
+    assert [[stack['StackName'] for stack in pool[state]] for state in ['available', 'claiming', 'failed']] == [[rolledBackStackName], [claimingStackName], [failedStackName]]
+    sbit.refillNetworkPool(client, 3, 'https://sbit-tests.s3.amazonaws.com/network.yaml', pool, clock.sleep)
+    client.purgeDeletedStacks()
+    assert claimingStackName in client.stackStartTimes and rolledBackStackName in client.stackStartTimes
+    assert failedStackName not in client.stackStartTimes
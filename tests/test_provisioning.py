@@ -0,0 +1,75 @@
+import os
+
+from simulation import sbit, VirtualClock, FakeSsmClient, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS
+
+INSTANCE_IDS = {'users' : 'i-0000000000000dc01', 'mailboxes' : 'i-00000000000exch01'}
+
+def getUsers(userCount):
+    return [{
+        'samAccountName' : 'user%05d' % (userNumber), 'firstName' : 'Test', 'lastName' : 'User %d' % (userNumber), 'password' : 'Test-Pass1',
+        'department' : 'Sales', 'title' : '', 'groups' : ['AllEmployees'], 'mailbox' : True,
+    } for userNumber in range(1, userCount + 1)]
+
+def provision(tmp_path, users, ssm, clock):
+    return sbit.runProvisioning('Provision', users, 'provision.example.com', INSTANCE_IDS, ssm, statePath=os.path.join(tmp_path, 'state.json'), clock=clock.now, sleep=clock.sleep)
+
+#Run Command only reaches servers whose instance profile lets the SSM agent register
+def testProvisionedServersHaveAnSsmInstanceProfile():
+    for stage, (stackRole, logicalId) in sbit.PROVISIONING_STAGES.items():
+        resources = sbit.getParsedTemplate(stackRole)[1]['Resources']
+        profileName = resources[logicalId]['Properties']['IamInstanceProfile']['Ref']
+        assert resources[profileName]['Type'] == 'AWS::IAM::InstanceProfile'
+        roleName = resources[profileName]['Properties']['Roles'][0]['Ref']
+        role = resources[roleName]
+        assert role['Type'] == 'AWS::IAM::Role'
+        assert any(policyArn['Fn::Sub'].endswith(':iam::aws:policy/AmazonSSMManagedInstanceCore') for policyArn in role['Properties']['ManagedPolicyArns'])
+        assert role['Properties']['AssumeRolePolicyDocument']['Statement'][0]['Principal']['Service'] == {'Fn::Sub' : 'ec2.${AWS::URLSuffix}'}
+
+def testServersOfflineInSystemsManagerStopProvisioning(tmp_path):
+    clock = VirtualClock()
+    ssm = FakeSsmClient(clock, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS, offlineIds=[INSTANCE_IDS['mailboxes']])
+    assert provision(tmp_path, getUsers(10), ssm, clock) == 1
+    assert not ssm.commands
+
+def testUsersAndMailboxesAreCreatedInBatches(tmp_path):
+    clock = VirtualClock()
+    ssm = FakeSsmClient(clock, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS)
+    users = getUsers(250)
+    assert provision(tmp_path, users, ssm, clock) == 0
+    assert ssm.created['users'] == ssm.created['mailboxes'] == set(user['samAccountName'] for user in users)
+    assert len(ssm.commands) == 2 * 3
+
+def testPasswordsOnlyTravelInSecureStringParameters(tmp_path):
+    clock = VirtualClock()
+    ssm = FakeSsmClient(clock, BENCHMARK_COMMAND_SECONDS, BENCHMARK_USER_SECONDS)
+    putParameter = ssm.put_parameter
+    parameterTypes = set()
+    def recordParameterType(**kwargs):
+        parameterTypes.add(kwargs['Type'])
+        return putParameter(**kwargs)
+    ssm.put_parameter = recordParameterType
+    users = getUsers(150)
+    for user in users:
+        user['password'] = 'Secret-%s!' % (user['samAccountName'])
+    assert provision(tmp_path, users, ssm, clock) == 0
+    assert parameterTypes == {'SecureString'}
+    assert not any(user['password'] in command['script'] for command in ssm.commands.values() for user in users)
+    #Every batch's parameter is deleted once its users exist
+    assert not ssm.parameters
+
+def testDomainControllerMayReadOnlyItsStacksPasswords():
+    resources = sbit.getParsedTemplate('ad')[1]['Resources']
+    statement = resources['DC1InstanceRole']['Properties']['Policies'][0]['PolicyDocument']['Statement'][0]
+    assert statement['Action'] == 'ssm:GetParameter'
+    assert statement['Resource']['Fn::Sub'].endswith(':parameter/sbit/${AWS::StackName}/*')
+    for chunk in sbit.chunkUsers(getUsers(10), tenant='Provision'):
+        assert chunk['passwordParameter'].startswith('/sbit/%s/' % (sbit.getStackNames('Provision')['ad']))
+
+def testBatchesSplitWhenPasswordsOutgrowAParameter():
+    users = getUsers(100)
+    for user in users:
+        user['password'] = 'Long-Passw0rd-' + 'x' * 50
+    chunks = sbit.chunkUsers(users)
+    assert len(chunks) > 1
+    assert sum(len(chunk['users']) for chunk in chunks) == 100
+    assert all(len(sbit.renderPasswordParameter(chunk['users']).encode('utf-8')) <= sbit.MAX_PASSWORD_PARAMETER_BYTES for chunk in chunks)
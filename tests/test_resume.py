@@ -0,0 +1,96 @@
+import pytest
+
+import benchmark
+from simulation import sbit, VirtualClock, FakeCloudFormationClient, BENCHMARK_DELETE_MINUTES, getBenchmarkStackGraph
+
+#A tenant's stacks as an earlier build left them: every stack built, then put in the given states
+#Returns the graph to resume, the stand-in client, and a poller on its simulated clock
+def getLeftoverStacks(tenant, stackStatuses):
+    clock = VirtualClock()
+    stackNames = sbit.getStackNames(tenant)
+    client = sbit.cloudFormationClient = FakeCloudFormationClient({}, clock, deleteSeconds={stackNames[role] : minutes * 60 for role, minutes in BENCHMARK_DELETE_MINUTES.items()})
+    for stackName in stackNames.values():
+        client.create_stack(StackName=stackName)
+    for role, stackStatus in stackStatuses.items():
+        if(isinstance(stackStatus, tuple)):
+            #(status now, seconds until it settles, status it settles in)
+            client.setStackStatus(stackNames[role], stackStatus[0])
+            client.setStackStatus(stackNames[role], stackStatus[2], stackStatus[1])
+        else:
+            client.setStackStatus(stackNames[role], stackStatus)
+    return getBenchmarkStackGraph(tenant), client, sbit.StackPoller(client, clock.now, clock.sleep)
+
+def resumeStacks(tenant, stackStatuses):
+    stackGraph, client, poller = getLeftoverStacks(tenant, stackStatuses)
+    nodesToCreate = sbit.inspectExistingStacks(stackGraph, poller)
+    existingStatuses = {node['role'] : node['existingStatus'] for node in stackGraph if 'existingStatus' in node}
+    return [node['role'] for node in nodesToCreate], existingStatuses, client
+
+def testBuiltStacksAreKept():
+    rebuiltRoles, existingStatuses, client = resumeStacks('Resume1', {})
+    assert rebuiltRoles == []
+    assert existingStatuses == {role : 'CREATE_COMPLETE' for role in ['network', 'ad', 'fs', 'exchange']}
+    assert not client.deleteStartTimes
+
+def testRolledBackUpdateIsKept():
+    rebuiltRoles, existingStatuses, client = resumeStacks('Resume2', {'network' : 'UPDATE_ROLLBACK_COMPLETE'})
+    assert rebuiltRoles == []
+    assert existingStatuses['network'] == 'UPDATE_ROLLBACK_COMPLETE'
+    assert not client.deleteStartTimes
+
+def testUpdateRollingBackIsWaitedOnThenKept():
+    rebuiltRoles, existingStatuses, client = resumeStacks('Resume3', {'ad' : ('UPDATE_ROLLBACK_IN_PROGRESS', 300, 'UPDATE_ROLLBACK_COMPLETE')})
+    assert rebuiltRoles == []
+    assert existingStatuses['ad'] == 'UPDATE_ROLLBACK_COMPLETE'
+    assert client.clock.now() >= 300
+
+def testStackStillBuildingIsReattached():
+    rebuiltRoles, existingStatuses, client = resumeStacks('Resume4', {'exchange' : 'CREATE_IN_PROGRESS'})
+    assert rebuiltRoles == []
+    assert existingStatuses['exchange'] == 'CREATE_IN_PROGRESS'
+
+@pytest.mark.parametrize('stackStatus', ['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED', ('ROLLBACK_IN_PROGRESS', 300, 'ROLLBACK_COMPLETE')])
+def testFailedStackIsRebuiltWithItsDependents(stackStatus):
+    stackGraph, client, poller = getLeftoverStacks('Resume5', {'ad' : stackStatus})
+    nodesToCreate = sbit.inspectExistingStacks(stackGraph, poller)
+    assert [node['role'] for node in nodesToCreate] == ['ad', 'fs', 'exchange']
+    assert stackGraph[0]['existingStatus'] == 'CREATE_COMPLETE'
+    #The FS and Exchange stacks import AD's exports, so they are gone before AD is deleted
+    stackNames = sbit.getStackNames('Resume5')
+    assert sorted(client.stackStartTimes) == [stackNames['network']]
+    assert client.clock.now() >= (BENCHMARK_DELETE_MINUTES['exchange'] + BENCHMARK_DELETE_MINUTES['ad']) * 60
+
+def testStackResumingCannotFixStopsTheResume():
+    stackGraph, client, poller = getLeftoverStacks('Resume6', {'fs' : 'UPDATE_ROLLBACK_FAILED'})
+    with pytest.raises(RuntimeError):
+        sbit.inspectExistingStacks(stackGraph, poller)
+    assert not client.deleteStartTimes
+
+def testTeardownDeletesDependentsFirst():
+    tenants = ['Teardown1', 'Teardown2']
+    clock = VirtualClock()
+    deleteSeconds = {}
+    for tenant in tenants:
+        for role, stackName in sbit.getStackNames(tenant).items():
+            deleteSeconds[stackName] = BENCHMARK_DELETE_MINUTES[role] * 60
+    client = FakeCloudFormationClient({}, clock, deleteSeconds=deleteSeconds)
+    for stackName in deleteSeconds:
+        client.create_stack(StackName=stackName)
+    poller = sbit.StackPoller(client, clock.now, clock.sleep)
+    teardownGraph = sbit.createTeardownGraph(tenants, poller=poller)
+    sbit.runTeardownGraph(teardownGraph, poller)
+    assert all(node['status'] == 'DELETE_COMPLETE' for node in teardownGraph)
+    assert not client.stackStartTimes
+    for tenant in tenants:
+        nodesByRole = {node['role'] : node for node in teardownGraph if node['group'] == tenant}
+        for role, blockerRoles in sbit.TEARDOWN_DEPENDENCIES.items():
+            for blockerRole in blockerRoles:
+                blocker = nodesByRole[blockerRole]
+                assert nodesByRole[role]['startTime'] >= blocker['startTime'] + blocker['deleteSeconds']
+        #Tenants are torn down side by side, not one after another
+        assert nodesByRole['exchange']['startTime'] == 0
+
+def testTeardownIsFasterThanOneStackAtATime():
+    (serialSeconds, serialCalls), (graphSeconds, graphCalls) = benchmark.benchmarkDestroy(5)
+    assert graphSeconds < serialSeconds / 4
+    assert graphCalls < serialCalls
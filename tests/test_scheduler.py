@@ -0,0 +1,44 @@
+import benchmark
+from simulation import sbit, getBenchmarkStackGraph, getBenchmarkStackSeconds, runBenchmarkStackGraph
+
+def testGraphTakesAsLongAsWaitersWithFewerApiCalls():
+    (waiterSeconds, waiterCalls), (graphSeconds, graphCalls) = benchmark.benchmarkStackGraph()
+    assert graphSeconds <= waiterSeconds
+    assert graphCalls < waiterCalls / 2
+
+def testStacksStartAsSoonAsTheirParentsFinish():
+    stackGraph = getBenchmarkStackGraph('Sched1')
+    clock, client, poller = runBenchmarkStackGraph(stackGraph)
+    finishTimes = {node['name'] : client.stackStartTimes[node['name']] + getBenchmarkStackSeconds(node['role']) for node in stackGraph}
+    assert all(node['status'] == 'CREATE_COMPLETE' for node in stackGraph)
+    for node in stackGraph:
+        parentsFinished = max([finishTimes[parent] for parent in node['dependsOn']] or [0])
+        assert parentsFinished <= client.stackStartTimes[node['name']] <= parentsFinished + sbit.MAX_POLL_INTERVAL
+    assert clock.now() <= sbit.estimateCriticalPath(stackGraph) + 3 * sbit.MAX_POLL_INTERVAL
+
+def testAtMostMaxConcurrentGroupsBuildAtOnce():
+    stackGraph = []
+    tenants = ['Sched%d' % (tenantNumber) for tenantNumber in range(1, 5)]
+    for tenant in tenants:
+        stackGraph.extend(getBenchmarkStackGraph(tenant))
+    clock, client, poller = runBenchmarkStackGraph(stackGraph, maxConcurrentGroups=2)
+    assert all(node['status'] == 'CREATE_COMPLETE' for node in stackGraph)
+    buildTimes = {}
+    for node in stackGraph:
+        startTime = client.stackStartTimes[node['name']]
+        finishTime = startTime + getBenchmarkStackSeconds(node['role'])
+        groupStart, groupFinish = buildTimes.get(node['group'], (startTime, finishTime))
+        buildTimes[node['group']] = (min(groupStart, startTime), max(groupFinish, finishTime))
+    for tenant, (startTime, finishTime) in buildTimes.items():
+        buildingAtStart = [other for other, (otherStart, otherFinish) in buildTimes.items() if otherStart <= startTime < otherFinish]
+        assert len(buildingAtStart) <= 2, tenant
+    assert sorted(startTime for startTime, finishTime in buildTimes.values())[2] > 0
+
+def testStacksWhoseParentFailedAreSkipped():
+    stackGraph = getBenchmarkStackGraph('Sched5')
+    stackNames = sbit.getStackNames('Sched5')
+    clock, client, poller = runBenchmarkStackGraph(stackGraph, failingStacks=[stackNames['ad']])
+    statuses = {node['role'] : node['status'] for node in stackGraph}
+    assert statuses == {'network' : 'CREATE_COMPLETE', 'ad' : 'CREATE_FAILED', 'fs' : 'SKIPPED', 'exchange' : 'SKIPPED'}
+    assert stackNames['fs'] not in client.stackStartTimes
+    assert stackNames['exchange'] not in client.stackStartTimes
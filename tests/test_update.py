@@ -0,0 +1,57 @@
+from simulation import sbit, VirtualClock, FakeCloudFormationClient, getBenchmarkEnvironment
+
+#A tenant's environment as a finished build leaves it: every stack built with the environment's
+#parameters, and a checkpoint of the settings
+#Returns the stand-in client and a poller on its simulated clock
+def getBuiltEnvironment(tenant):
+    clock = VirtualClock()
+    client = sbit.cloudFormationClient = FakeCloudFormationClient({}, clock)
+    environment = getBenchmarkEnvironment(tenant)
+    stackGraph = sbit.createStackGraph(environment)
+    for node in stackGraph:
+        client.create_stack(StackName=node['name'], Parameters=node['parameters'])
+        node['status'] = 'CREATE_COMPLETE'
+    sbit.saveCheckpoint(environment, stackGraph)
+    return client, sbit.StackPoller(client, clock.now, clock.sleep)
+
+def testOnlyChangedParametersAreReported():
+    client, poller = getBuiltEnvironment('Update1')
+    environment = dict(getBenchmarkEnvironment('Update1'), volumeSize='80', adminPassword='Other-Pass2')
+    fsNode = [node for node in sbit.createStackGraph(environment) if node['role'] == 'fs'][0]
+    assert sbit.getChangedParameters(client, fsNode, poller) == {'FSVolumeSize' : ('50', '80')}
+
+def testUpdateChangesOnlyTheStacksThatDiffer():
+    client, poller = getBuiltEnvironment('Update2')
+    stackNames = sbit.getStackNames('Update2')
+    assert sbit.runUpdate('Update2', {'volumeSize' : '80'}, assumeYes=True, poller=poller) == 0
+    assert list(client.updateStartTimes) == [stackNames['fs']]
+    assert client.stackParameters[stackNames['fs']]['FSVolumeSize'] == '80'
+    #Passwords are never asked for again; the stack keeps the ones it was built with
+    assert client.stackParameters[stackNames['fs']]['DomainAdminPassword'] == getBenchmarkEnvironment('Update2')['adminPassword']
+    assert not client.changeSets
+    assert sbit.loadCheckpoint('Update2')['environment']['volumeSize'] == '80'
+
+def testNothingToUpdateChangesNothing():
+    client, poller = getBuiltEnvironment('Update3')
+    assert sbit.runUpdate('Update3', {'volumeSize' : '50'}, assumeYes=True, poller=poller) == 0
+    assert not client.updateStartTimes
+    assert not client.changeSets
+
+def testSecretsAreSentWithUsePreviousValueAndSkippedByPreflight(monkeypatch):
+    client, poller = getBuiltEnvironment('Update4')
+    sentParameters = []
+    createChangeSet = client.create_change_set
+    def recordParameters(**kwargs):
+        sentParameters.extend(kwargs['Parameters'])
+        return createChangeSet(**kwargs)
+    monkeypatch.setattr(client, 'create_change_set', recordParameters)
+    preflightedParameters = []
+    checkStackParameters = sbit.checkStackParameters
+    def recordPreflight(stackRole, parameters, serverCount=None):
+        preflightedParameters.extend(parameters)
+        return checkStackParameters(stackRole, parameters, serverCount)
+    monkeypatch.setattr(sbit, 'checkStackParameters', recordPreflight)
+    assert sbit.runUpdate('Update4', {'volumeSize' : '80'}, assumeYes=True, poller=poller) == 0
+    for parameters in [sentParameters, preflightedParameters]:
+        secretParameters = [parameter for parameter in parameters if parameter['ParameterKey'] in sbit.SECRET_PARAMETERS]
+        assert secretParameters and all(parameter == {'ParameterKey' : parameter['ParameterKey'], 'UsePreviousValue' : True} for parameter in secretParameters)
@@ -0,0 +1,35 @@
+import json
+
+from simulation import sbit, FakeS3Client, getBenchmarkEnvironment
+
+def publish(s3):
+    stackGraph = sbit.createStackGraph(getBenchmarkEnvironment('Upload1'))
+    sbit.publishStackTemplates(stackGraph, s3, 'sbit-tests')
+    return {node['role'] : node['templateUrl'] for node in stackGraph}
+
+def getScriptKeys(s3):
+    return sorted(key for bucket, key in s3.objects if key.startswith(sbit.ARTIFACT_PREFIX + '/scripts/'))
+
+def getTemplate(s3, templateUrl):
+    return json.loads(s3.objects[('sbit-tests', templateUrl.split('.amazonaws.com/', 1)[1])])
+
+def testEveryBuildSignsItsOwnScriptUrls():
+    s3 = FakeS3Client()
+    firstUrls = publish(s3)
+    scriptKeys = getScriptKeys(s3)
+    secondUrls = publish(s3)
+    assert scriptKeys
+    assert getScriptKeys(s3) == scriptKeys
+    for role, templateUrl in firstUrls.items():
+        firstSources = [definition['source'] for path, definition in sbit.getTemplateFiles(getTemplate(s3, templateUrl)) if sbit.ARTIFACT_PREFIX + '/scripts/' in str(definition.get('source'))]
+        secondSources = [definition['source'] for path, definition in sbit.getTemplateFiles(getTemplate(s3, secondUrls[role])) if sbit.ARTIFACT_PREFIX + '/scripts/' in str(definition.get('source'))]
+        assert len(firstSources) == len(secondSources)
+        assert not set(firstSources) & set(secondSources)
+
+def testObjectsDeletedFromTheBucketAreUploadedAgain():
+    s3 = FakeS3Client()
+    publish(s3)
+    scriptKeys = getScriptKeys(s3)
+    del s3.objects[('sbit-tests', scriptKeys[0])]
+    publish(s3)
+    assert getScriptKeys(s3) == scriptKeys
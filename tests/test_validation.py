@@ -0,0 +1,14 @@
+from simulation import sbit, VirtualClock, FakeEc2Client, getBenchmarkEnvironment, getFakeSession
+
+def testExchangeVolumePromptAsksAgainBelowTheInstallSize(monkeypatch, capsys):
+    answers = iter([str(sbit.MIN_EXCH_VOLUME_SIZE - 1), 'lots', str(sbit.MIN_EXCH_VOLUME_SIZE)])
+    monkeypatch.setattr('builtins.input', lambda message: next(answers))
+    assert sbit.getExchVolumeSize('Exchange storage: ') == str(sbit.MIN_EXCH_VOLUME_SIZE)
+    assert capsys.readouterr().out.count(sbit.INVALID_EXCH_VOLUME_SIZE_MESSAGE) == 2
+
+def testManifestRejectsAnExchangeVolumeTooSmallToInstall():
+    sbit.awsSession = getFakeSession()
+    sbit.ec2Client = FakeEc2Client({}, 0, VirtualClock())
+    environment = dict(getBenchmarkEnvironment('Small'), volumeSize=str(sbit.MIN_EXCH_VOLUME_SIZE - 1), exchVolumeSize=str(sbit.MIN_EXCH_VOLUME_SIZE - 1))
+    environments, errors = sbit.validateManifest([environment])
+    assert errors == ['Row 1 (Small), exchVolumeSize: %s' % (sbit.INVALID_EXCH_VOLUME_SIZE_MESSAGE)]